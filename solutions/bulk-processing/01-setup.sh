@@ -9,6 +9,9 @@ export ZONE="us-central1-a"
 export INGEST_BUCKET="${PROJECT_ID}-ingest"
 export UNPACK_BUCKET="${PROJECT_ID}-unpack"
 export TRANSFORM_BUCKET="${PROJECT_ID}-transform"
+export DEDUP_BUCKET="${PROJECT_ID}-dedup"
+# Worker bundles and startup scripts, kept out of the ingest bucket whose uploads notify the unpack workers
+export ARTIFACTS_BUCKET="${PROJECT_ID}-artifacts"
 
 # Pub/Sub Configuration
 export INGEST_TOPIC="data-ingest"
@@ -33,6 +36,17 @@ export TRANSFORM_MIG="transform-workers"
 export MIN_INSTANCES=1
 export MAX_INSTANCES=10
 export TARGET_QUEUE_DEPTH=5
+# queue-depth scales on undelivered messages, backlog-seconds on the seconds of work in the backlog
+# that the workers estimate and write every BACKLOG_METRIC_INTERVAL seconds
+export AUTOSCALING_METRIC="queue-depth"
+export TARGET_BACKLOG_SECONDS=300
+export BACKLOG_METRIC_INTERVAL=60
+
+# Worker Configuration (passed to workers as instance metadata)
+export CALLBACK_WORKERS=10
+export FLOW_MAX_MESSAGES=20
+export FLOW_MAX_BYTES=104857600
+export FLOW_MAX_LEASE_SECONDS=3600
 
 # Set your project ID
 gcloud config set project $PROJECT_ID
@@ -67,6 +81,8 @@ echo 'Storage Buckets:'
 echo "  INGEST_BUCKET: ${INGEST_BUCKET}"
 echo "  UNPACK_BUCKET: ${UNPACK_BUCKET}"
 echo "  TRANSFORM_BUCKET: ${TRANSFORM_BUCKET}"
+echo "  DEDUP_BUCKET: ${DEDUP_BUCKET}"
+echo "  ARTIFACTS_BUCKET: ${ARTIFACTS_BUCKET}"
 echo ''
 echo 'Pub/Sub Topics:'
 echo "  INGEST_TOPIC: ${INGEST_TOPIC}"
@@ -86,6 +102,15 @@ echo 'Autoscaling Configuration:'
 echo "  MIN_INSTANCES: ${MIN_INSTANCES}"
 echo "  MAX_INSTANCES: ${MAX_INSTANCES}"
 echo "  TARGET_QUEUE_DEPTH: ${TARGET_QUEUE_DEPTH}"
+echo "  AUTOSCALING_METRIC: ${AUTOSCALING_METRIC}"
+echo "  TARGET_BACKLOG_SECONDS: ${TARGET_BACKLOG_SECONDS}"
+echo "  BACKLOG_METRIC_INTERVAL: ${BACKLOG_METRIC_INTERVAL}"
+echo ''
+echo 'Worker Configuration:'
+echo "  CALLBACK_WORKERS: ${CALLBACK_WORKERS}"
+echo "  FLOW_MAX_MESSAGES: ${FLOW_MAX_MESSAGES}"
+echo "  FLOW_MAX_BYTES: ${FLOW_MAX_BYTES}"
+echo "  FLOW_MAX_LEASE_SECONDS: ${FLOW_MAX_LEASE_SECONDS}"
 echo ''
 echo 'Setup complete.'
 echo ''
@@ -106,6 +131,8 @@ ZONE="${ZONE}"
 INGEST_BUCKET="${INGEST_BUCKET}"
 UNPACK_BUCKET="${UNPACK_BUCKET}"
 TRANSFORM_BUCKET="${TRANSFORM_BUCKET}"
+DEDUP_BUCKET="${DEDUP_BUCKET}"
+ARTIFACTS_BUCKET="${ARTIFACTS_BUCKET}"
 
 # Pub/Sub Configuration
 INGEST_TOPIC="${INGEST_TOPIC}"
@@ -130,6 +157,15 @@ TRANSFORM_MIG="${TRANSFORM_MIG}"
 MIN_INSTANCES=${MIN_INSTANCES}
 MAX_INSTANCES=${MAX_INSTANCES}
 TARGET_QUEUE_DEPTH=${TARGET_QUEUE_DEPTH}
+AUTOSCALING_METRIC="${AUTOSCALING_METRIC}"
+TARGET_BACKLOG_SECONDS=${TARGET_BACKLOG_SECONDS}
+BACKLOG_METRIC_INTERVAL=${BACKLOG_METRIC_INTERVAL}
+
+# Worker Configuration
+CALLBACK_WORKERS=${CALLBACK_WORKERS}
+FLOW_MAX_MESSAGES=${FLOW_MAX_MESSAGES}
+FLOW_MAX_BYTES=${FLOW_MAX_BYTES}
+FLOW_MAX_LEASE_SECONDS=${FLOW_MAX_LEASE_SECONDS}
 ENV_EOF
 
 echo "Environment variables saved to ${SCRIPT_DIR}/.env"
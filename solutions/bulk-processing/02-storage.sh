@@ -25,5 +25,23 @@ gcloud storage buckets create gs://$TRANSFORM_BUCKET \
 
 echo "✓ Created transform bucket: gs://$TRANSFORM_BUCKET"
 
+# Create dedup bucket, markers of processed messages are only needed while redeliveries are possible
+gcloud storage buckets create gs://$DEDUP_BUCKET \
+    --location=$REGION \
+    --uniform-bucket-level-access
+cat > /tmp/dedup-lifecycle.json <<EOF
+{"rule": [{"action": {"type": "Delete"}, "condition": {"age": 7}}]}
+EOF
+gcloud storage buckets update gs://$DEDUP_BUCKET --lifecycle-file=/tmp/dedup-lifecycle.json
+rm /tmp/dedup-lifecycle.json
+echo "✓ Created dedup bucket: gs://$DEDUP_BUCKET"
+
+# Create artifacts bucket for the worker bundles, it has no notification so builds do not reach the workers
+gcloud storage buckets create gs://$ARTIFACTS_BUCKET \
+    --location=$REGION \
+    --uniform-bucket-level-access
+
+echo "✓ Created artifacts bucket: gs://$ARTIFACTS_BUCKET"
+
 echo ""
 echo "All storage buckets created successfully."
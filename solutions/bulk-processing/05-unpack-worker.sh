@@ -4,21 +4,22 @@
 
 echo "Preparing unpack worker application..."
 
-# Create temporary directory for worker files
+# Create temporary directory for the startup script
 WORKER_DIR=$(mktemp -d)
 
-# Copy worker files
-cp ../../tasks/bulk-processing/unpack.py $WORKER_DIR/
-cp ../../tasks/bulk-processing/requirements.txt $WORKER_DIR/
-
 # Create startup script
 cat > $WORKER_DIR/startup.sh << 'EOF'
 #!/bin/bash
 set -e
 
-# Install Python and pip
-apt-get update
-apt-get install -y python3 python3-pip zip unzip
+# Boot time of the instance, the worker reports how long after it the first message was processed
+BOOT_TIME=$(awk '/^btime/ {print $2}' /proc/stat)
+
+# The worker bundle carries all Python dependencies, only Python itself comes from the image
+if ! command -v python3 > /dev/null; then
+    apt-get update
+    apt-get install -y python3
+fi
 
 # Get metadata
 PROJECT_ID=$(curl -s -H "Metadata-Flavor: Google" http://metadata.google.internal/computeMetadata/v1/project/project-id)
@@ -26,42 +27,88 @@ SUBSCRIPTION=$(curl -s -H "Metadata-Flavor: Google" http://metadata.google.inter
 TOPIC=$(curl -s -H "Metadata-Flavor: Google" http://metadata.google.internal/computeMetadata/v1/instance/attributes/topic)
 BUCKET=$(curl -s -H "Metadata-Flavor: Google" http://metadata.google.internal/computeMetadata/v1/instance/attributes/bucket)
 
+# Optional tuning attributes, the worker falls back to its defaults when they are empty
+getAttribute() {
+    curl -sf -H "Metadata-Flavor: Google" "http://metadata.google.internal/computeMetadata/v1/instance/attributes/$1" || true
+}
+CALLBACK_WORKERS=$(getAttribute callback-workers)
+FLOW_MAX_MESSAGES=$(getAttribute flow-max-messages)
+FLOW_MAX_BYTES=$(getAttribute flow-max-bytes)
+FLOW_MAX_LEASE_SECONDS=$(getAttribute flow-max-lease-seconds)
+METRICS_PORT=$(getAttribute metrics-port)
+TRACING=$(getAttribute tracing)
+DEDUP_BUCKET=$(getAttribute dedup-bucket)
+DEDUP_CACHE_SIZE=$(getAttribute dedup-cache-size)
+LEASE_STALL_SECONDS=$(getAttribute lease-stall-seconds)
+LEASE_MAX_SECONDS=$(getAttribute lease-max-seconds)
+RUNTIME=$(getAttribute runtime)
+ASYNC_MAX_REQUESTS=$(getAttribute async-max-requests)
+WORKER_PROCESSES=$(getAttribute worker-processes)
+DRAIN_SECONDS=$(getAttribute drain-seconds)
+BACKLOG_METRIC_INTERVAL=$(getAttribute backlog-metric-interval)
+UNCHANGED_MEMBERS=$(getAttribute unchanged-members)
+
 # Create working directory
 mkdir -p /opt/worker
 cd /opt/worker
 
-# Download worker files from metadata
-curl -s -H "Metadata-Flavor: Google" http://metadata.google.internal/computeMetadata/v1/instance/attributes/worker-script > unpack.py
-curl -s -H "Metadata-Flavor: Google" http://metadata.google.internal/computeMetadata/v1/instance/attributes/requirements > requirements.txt
-
-# Install Python dependencies
-pip3 install -r requirements.txt
+# Download the worker bundle named in the template with the instance's service account, and check it
+WORKER_BUNDLE=$(getAttribute worker-bundle)
+WORKER_BUNDLE_SHA256=$(getAttribute worker-bundle-sha256)
+TOKEN=$(curl -s -H "Metadata-Flavor: Google" http://metadata.google.internal/computeMetadata/v1/instance/service-accounts/default/token | python3 -c 'import json, sys; print(json.load(sys.stdin)["access_token"])')
+curl -sf -H "Authorization: Bearer $TOKEN" -o bundle.tar.gz "https://storage.googleapis.com/${WORKER_BUNDLE#gs://}"
+echo "$WORKER_BUNDLE_SHA256  bundle.tar.gz" | sha256sum -c -
+rm -rf bundle
+mkdir bundle
+tar -xzf bundle.tar.gz -C bundle
+rm bundle.tar.gz
+echo "Worker bundle $(basename $WORKER_BUNDLE) ready $(( $(date +%s) - BOOT_TIME )) seconds after boot"
 
 # Set environment variables
+export PYTHONPATH=/opt/worker/bundle/site-packages
+export BOOT_TIME=$BOOT_TIME
 export PROJECT_ID=$PROJECT_ID
 export SUBSCRIPTION=$SUBSCRIPTION
 export TOPIC=$TOPIC
 export BUCKET=$BUCKET
-
-# Run worker in background with auto-restart
+export CALLBACK_WORKERS=$CALLBACK_WORKERS
+export FLOW_MAX_MESSAGES=$FLOW_MAX_MESSAGES
+export FLOW_MAX_BYTES=$FLOW_MAX_BYTES
+export FLOW_MAX_LEASE_SECONDS=$FLOW_MAX_LEASE_SECONDS
+export METRICS_PORT=$METRICS_PORT
+export TRACING=$TRACING
+export DEDUP_BUCKET=$DEDUP_BUCKET
+export DEDUP_CACHE_SIZE=$DEDUP_CACHE_SIZE
+export LEASE_STALL_SECONDS=$LEASE_STALL_SECONDS
+export LEASE_MAX_SECONDS=$LEASE_MAX_SECONDS
+export RUNTIME=$RUNTIME
+export ASYNC_MAX_REQUESTS=$ASYNC_MAX_REQUESTS
+# One worker process per CPU by default, the worker supervises and restarts them itself
+export WORKER_PROCESSES=${WORKER_PROCESSES:-$(nproc)}
+export DRAIN_SECONDS=$DRAIN_SECONDS
+export BACKLOG_METRIC_INTERVAL=$BACKLOG_METRIC_INTERVAL
+export UNCHANGED_MEMBERS=$UNCHANGED_MEMBERS
+
+# Run worker in background with auto-restart, the worker restarts its own crashed processes
 while true; do
     echo "Starting unpack worker..."
-    python3 unpack.py || echo "Worker crashed, restarting in 5 seconds..."
+    python3 bundle/unpack.py || echo "Worker crashed, restarting in 5 seconds..."
     sleep 5
 done
 EOF
 
 chmod +x $WORKER_DIR/startup.sh
 
-# Upload files to temporary bucket for distribution
-echo "Uploading worker files to gs://$INGEST_BUCKET/workers/..."
-gcloud storage cp $WORKER_DIR/unpack.py gs://$INGEST_BUCKET/workers/unpack.py
-gcloud storage cp $WORKER_DIR/requirements.txt gs://$INGEST_BUCKET/workers/requirements.txt
-gcloud storage cp $WORKER_DIR/startup.sh gs://$INGEST_BUCKET/workers/unpack-startup.sh
+# Build the worker bundle the instances download instead of installing packages
+./build-worker-bundle.sh unpack
+
+# Upload files to the artifacts bucket for distribution
+echo "Uploading worker files to gs://$ARTIFACTS_BUCKET/workers/..."
+gcloud storage cp $WORKER_DIR/startup.sh gs://$ARTIFACTS_BUCKET/workers/unpack-startup.sh
 
 # Cleanup
 rm -rf $WORKER_DIR
 
 echo "✓ Unpack worker application prepared"
 echo ""
-echo "Worker files available at: gs://$INGEST_BUCKET/workers/"
+echo "Worker files available at: gs://$ARTIFACTS_BUCKET/workers/"
@@ -4,18 +4,24 @@
 
 echo "Creating unpack worker instance template..."
 
-# Read worker files
-UNPACK_SCRIPT=$(gcloud storage cat gs://$INGEST_BUCKET/workers/unpack.py | base64 -w 0)
-REQUIREMENTS=$(gcloud storage cat gs://$INGEST_BUCKET/workers/requirements.txt | base64 -w 0)
+# Latest worker bundle and its SHA-256, built by 05-unpack-worker.sh. The template pins this
+# version, instances created later by the autoscaler start the same worker
+read UNPACK_BUNDLE UNPACK_BUNDLE_SHA256 <<< "$(gcloud storage cat gs://$ARTIFACTS_BUCKET/workers/unpack-bundle)"
+echo "Using worker bundle $UNPACK_BUNDLE"
 
 # Create startup script
 cat > /tmp/unpack-startup.sh << 'EOFSTARTUP'
 #!/bin/bash
 set -e
 
-# Install Python and pip
-apt-get update
-apt-get install -y python3 python3-pip zip unzip
+# Boot time of the instance, the worker reports how long after it the first message was processed
+BOOT_TIME=$(awk '/^btime/ {print $2}' /proc/stat)
+
+# The worker bundle carries all Python dependencies, only Python itself comes from the image
+if ! command -v python3 > /dev/null; then
+    apt-get update
+    apt-get install -y python3
+fi
 
 # Get metadata
 PROJECT_ID=$(curl -s -H "Metadata-Flavor: Google" http://metadata.google.internal/computeMetadata/v1/project/project-id)
@@ -23,31 +29,83 @@ SUBSCRIPTION=$(curl -s -H "Metadata-Flavor: Google" http://metadata.google.inter
 TOPIC=$(curl -s -H "Metadata-Flavor: Google" http://metadata.google.internal/computeMetadata/v1/instance/attributes/topic)
 BUCKET=$(curl -s -H "Metadata-Flavor: Google" http://metadata.google.internal/computeMetadata/v1/instance/attributes/bucket)
 
+# Optional tuning attributes, the worker falls back to its defaults when they are empty
+getAttribute() {
+    curl -sf -H "Metadata-Flavor: Google" "http://metadata.google.internal/computeMetadata/v1/instance/attributes/$1" || true
+}
+CALLBACK_WORKERS=$(getAttribute callback-workers)
+FLOW_MAX_MESSAGES=$(getAttribute flow-max-messages)
+FLOW_MAX_BYTES=$(getAttribute flow-max-bytes)
+FLOW_MAX_LEASE_SECONDS=$(getAttribute flow-max-lease-seconds)
+METRICS_PORT=$(getAttribute metrics-port)
+TRACING=$(getAttribute tracing)
+DEDUP_BUCKET=$(getAttribute dedup-bucket)
+DEDUP_CACHE_SIZE=$(getAttribute dedup-cache-size)
+LEASE_STALL_SECONDS=$(getAttribute lease-stall-seconds)
+LEASE_MAX_SECONDS=$(getAttribute lease-max-seconds)
+RUNTIME=$(getAttribute runtime)
+ASYNC_MAX_REQUESTS=$(getAttribute async-max-requests)
+WORKER_PROCESSES=$(getAttribute worker-processes)
+DRAIN_SECONDS=$(getAttribute drain-seconds)
+BACKLOG_METRIC_INTERVAL=$(getAttribute backlog-metric-interval)
+UNCHANGED_MEMBERS=$(getAttribute unchanged-members)
+
 # Create working directory
 mkdir -p /opt/worker
 cd /opt/worker
 
-# Download and decode worker files
-echo "$(curl -s -H 'Metadata-Flavor: Google' http://metadata.google.internal/computeMetadata/v1/instance/attributes/worker-script)" | base64 -d > unpack.py
-echo "$(curl -s -H 'Metadata-Flavor: Google' http://metadata.google.internal/computeMetadata/v1/instance/attributes/requirements)" | base64 -d > requirements.txt
-
-# Install Python dependencies
-pip3 install -r requirements.txt
+# Download the worker bundle named in the template with the instance's service account, and check it
+WORKER_BUNDLE=$(getAttribute worker-bundle)
+WORKER_BUNDLE_SHA256=$(getAttribute worker-bundle-sha256)
+TOKEN=$(curl -s -H "Metadata-Flavor: Google" http://metadata.google.internal/computeMetadata/v1/instance/service-accounts/default/token | python3 -c 'import json, sys; print(json.load(sys.stdin)["access_token"])')
+curl -sf -H "Authorization: Bearer $TOKEN" -o bundle.tar.gz "https://storage.googleapis.com/${WORKER_BUNDLE#gs://}"
+echo "$WORKER_BUNDLE_SHA256  bundle.tar.gz" | sha256sum -c -
+rm -rf bundle
+mkdir bundle
+tar -xzf bundle.tar.gz -C bundle
+rm bundle.tar.gz
+echo "Worker bundle $(basename $WORKER_BUNDLE) ready $(( $(date +%s) - BOOT_TIME )) seconds after boot"
 
 # Set environment variables
+export PYTHONPATH=/opt/worker/bundle/site-packages
+export BOOT_TIME=$BOOT_TIME
 export PROJECT_ID=$PROJECT_ID
 export SUBSCRIPTION=$SUBSCRIPTION
 export TOPIC=$TOPIC
 export BUCKET=$BUCKET
-
-# Run worker with auto-restart
+export CALLBACK_WORKERS=$CALLBACK_WORKERS
+export FLOW_MAX_MESSAGES=$FLOW_MAX_MESSAGES
+export FLOW_MAX_BYTES=$FLOW_MAX_BYTES
+export FLOW_MAX_LEASE_SECONDS=$FLOW_MAX_LEASE_SECONDS
+export METRICS_PORT=$METRICS_PORT
+export TRACING=$TRACING
+export DEDUP_BUCKET=$DEDUP_BUCKET
+export DEDUP_CACHE_SIZE=$DEDUP_CACHE_SIZE
+export LEASE_STALL_SECONDS=$LEASE_STALL_SECONDS
+export LEASE_MAX_SECONDS=$LEASE_MAX_SECONDS
+export RUNTIME=$RUNTIME
+export ASYNC_MAX_REQUESTS=$ASYNC_MAX_REQUESTS
+# One worker process per CPU by default, the worker supervises and restarts them itself
+export WORKER_PROCESSES=${WORKER_PROCESSES:-$(nproc)}
+export DRAIN_SECONDS=$DRAIN_SECONDS
+export BACKLOG_METRIC_INTERVAL=$BACKLOG_METRIC_INTERVAL
+export UNCHANGED_MEMBERS=$UNCHANGED_MEMBERS
+
+# Run worker with auto-restart, the worker restarts its own crashed processes
 while true; do
     echo "Starting unpack worker..."
-    python3 unpack.py || echo "Worker crashed, restarting in 5 seconds..."
+    python3 bundle/unpack.py || echo "Worker crashed, restarting in 5 seconds..."
     sleep 5
 done
 EOFSTARTUP
 
+# Workers only write the backlog metric when the autoscaler targets it
+if [ "$AUTOSCALING_METRIC" = "backlog-seconds" ]; then
+    WORKER_BACKLOG_METRIC_INTERVAL=$BACKLOG_METRIC_INTERVAL
+else
+    WORKER_BACKLOG_METRIC_INTERVAL=0
+fi
+
 # Create instance template
 gcloud compute instance-templates create $UNPACK_TEMPLATE \
     --machine-type=$MACHINE_TYPE \
@@ -55,7 +113,7 @@ gcloud compute instance-templates create $UNPACK_TEMPLATE \
     --image-project=$IMAGE_PROJECT \
     --scopes=cloud-platform \
     --metadata-from-file=startup-script=/tmp/unpack-startup.sh \
-    --metadata=subscription=$INGEST_SUBSCRIPTION,topic=$UNPACK_TOPIC,bucket=$UNPACK_BUCKET,worker-script=$UNPACK_SCRIPT,requirements=$REQUIREMENTS \
+    --metadata=subscription=$INGEST_SUBSCRIPTION,topic=$UNPACK_TOPIC,bucket=$UNPACK_BUCKET,worker-bundle=$UNPACK_BUNDLE,worker-bundle-sha256=$UNPACK_BUNDLE_SHA256,callback-workers=$CALLBACK_WORKERS,flow-max-messages=$FLOW_MAX_MESSAGES,flow-max-bytes=$FLOW_MAX_BYTES,flow-max-lease-seconds=$FLOW_MAX_LEASE_SECONDS,dedup-bucket=$DEDUP_BUCKET,backlog-metric-interval=$WORKER_BACKLOG_METRIC_INTERVAL \
     --tags=worker
 
 echo "✓ Created instance template: $UNPACK_TEMPLATE"
@@ -69,19 +127,35 @@ gcloud compute instance-groups managed create $UNPACK_MIG \
 
 echo "✓ Created managed instance group: $UNPACK_MIG"
 
-# Configure autoscaling based on Pub/Sub queue depth
-gcloud compute instance-groups managed set-autoscaling $UNPACK_MIG \
-    --zone=$ZONE \
-    --min-num-replicas=$MIN_INSTANCES \
-    --max-num-replicas=$MAX_INSTANCES \
-    --stackdriver-metric-filter="resource.type=pubsub_subscription AND resource.labels.subscription_id=$INGEST_SUBSCRIPTION" \
-    --stackdriver-metric-utilization-target=$TARGET_QUEUE_DEPTH \
-    --stackdriver-metric-single-instance-assignment=$TARGET_QUEUE_DEPTH
+# Configure autoscaling based on the estimated seconds of backlog work or on Pub/Sub queue depth
+if [ "$AUTOSCALING_METRIC" = "backlog-seconds" ]; then
+    # Every instance writes its share of the backlog, the group gets enough instances to finish the
+    # backlog within TARGET_BACKLOG_SECONDS
+    gcloud compute instance-groups managed set-autoscaling $UNPACK_MIG \
+        --zone=$ZONE \
+        --min-num-replicas=$MIN_INSTANCES \
+        --max-num-replicas=$MAX_INSTANCES \
+        --update-stackdriver-metric=custom.googleapis.com/bulk_processing/backlog_seconds \
+        --stackdriver-metric-utilization-target=$TARGET_BACKLOG_SECONDS \
+        --stackdriver-metric-utilization-target-type=gauge
+else
+    gcloud compute instance-groups managed set-autoscaling $UNPACK_MIG \
+        --zone=$ZONE \
+        --min-num-replicas=$MIN_INSTANCES \
+        --max-num-replicas=$MAX_INSTANCES \
+        --stackdriver-metric-filter="resource.type=pubsub_subscription AND resource.labels.subscription_id=$INGEST_SUBSCRIPTION" \
+        --stackdriver-metric-utilization-target=$TARGET_QUEUE_DEPTH \
+        --stackdriver-metric-single-instance-assignment=$TARGET_QUEUE_DEPTH
+fi
 
 echo "✓ Configured autoscaling for $UNPACK_MIG"
 echo "  Min instances: $MIN_INSTANCES"
 echo "  Max instances: $MAX_INSTANCES"
-echo "  Target queue depth: $TARGET_QUEUE_DEPTH messages per instance"
+if [ "$AUTOSCALING_METRIC" = "backlog-seconds" ]; then
+    echo "  Target backlog: $TARGET_BACKLOG_SECONDS seconds of work"
+else
+    echo "  Target queue depth: $TARGET_QUEUE_DEPTH messages per instance"
+fi
 
 # Cleanup
 rm /tmp/unpack-startup.sh
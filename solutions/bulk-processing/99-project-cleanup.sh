@@ -32,6 +32,8 @@ echo "Deleting storage buckets..."
 gcloud storage rm -r gs://$INGEST_BUCKET --quiet 2>/dev/null || echo "  Ingest bucket not found or already deleted"
 gcloud storage rm -r gs://$UNPACK_BUCKET --quiet 2>/dev/null || echo "  Unpack bucket not found or already deleted"
 gcloud storage rm -r gs://$TRANSFORM_BUCKET --quiet 2>/dev/null || echo "  Transform bucket not found or already deleted"
+gcloud storage rm -r gs://$DEDUP_BUCKET --quiet 2>/dev/null || echo "  Dedup bucket not found or already deleted"
+gcloud storage rm -r gs://$ARTIFACTS_BUCKET --quiet 2>/dev/null || echo "  Artifacts bucket not found or already deleted"
 
 echo ""
 echo "=========================================="
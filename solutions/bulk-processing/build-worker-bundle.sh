@@ -0,0 +1,57 @@
+#!/bin/bash
+
+# Build a self-contained worker bundle and upload it to the artifacts bucket
+#
+# Usage: ./build-worker-bundle.sh unpack|transform
+#
+# The bundle is a tarball of the worker script and a site-packages directory with the wheels of
+# requirements.txt for the Python of the worker image, so instances start the worker without apt or pip.
+# Bundles are versioned and never overwritten; gs://$ARTIFACTS_BUCKET/workers/<worker>-bundle points to the
+# latest one with its SHA-256, which the MIG scripts put into the instance template.
+
+set -e
+
+WORKER=$1
+if [ "$WORKER" != "unpack" ] && [ "$WORKER" != "transform" ]; then
+    echo "Usage: $0 unpack|transform"
+    exit 1
+fi
+
+SCRIPT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
+TASK_DIR="$SCRIPT_DIR/../../tasks/bulk-processing"
+# Python of the worker image, debian-11 ships 3.9
+PYTHON_VERSION=${BUNDLE_PYTHON_VERSION:-3.9}
+VERSION="$(date -u +%Y%m%d%H%M%S)-$(git -C "$SCRIPT_DIR" rev-parse --short HEAD 2>/dev/null || echo local)"
+BUNDLE="$WORKER-$VERSION.tar.gz"
+
+echo "Building $WORKER worker bundle $VERSION for Python $PYTHON_VERSION..."
+
+BUILD_DIR=$(mktemp -d)
+cp "$TASK_DIR/$WORKER.py" "$TASK_DIR/worker_common.py" "$TASK_DIR/requirements.txt" "$BUILD_DIR/"
+
+# Wheels for the image's platform and Python, whatever Python builds the bundle
+pip3 install --quiet --no-compile \
+    --target "$BUILD_DIR/site-packages" \
+    --platform manylinux2014_x86_64 \
+    --python-version "$PYTHON_VERSION" \
+    --implementation cp \
+    --only-binary=:all: \
+    -r "$BUILD_DIR/requirements.txt"
+
+# The exact versions that went into the bundle, including the ones requirements.txt does not pin
+pip3 freeze --path "$BUILD_DIR/site-packages" > "$BUILD_DIR/requirements.lock"
+cat > "$BUILD_DIR/bundle.json" <<BUNDLE_EOF
+{"worker": "$WORKER", "version": "$VERSION", "python": "$PYTHON_VERSION"}
+BUNDLE_EOF
+
+tar -czf "$BUILD_DIR/$BUNDLE" -C "$BUILD_DIR" "$WORKER.py" worker_common.py requirements.txt requirements.lock bundle.json site-packages
+SHA256=$(sha256sum "$BUILD_DIR/$BUNDLE" | cut -d' ' -f1)
+
+echo "Uploading gs://$ARTIFACTS_BUCKET/workers/bundles/$BUNDLE ($(du -h "$BUILD_DIR/$BUNDLE" | cut -f1))..."
+gcloud storage cp "$BUILD_DIR/$BUNDLE" "gs://$ARTIFACTS_BUCKET/workers/bundles/$BUNDLE"
+echo "gs://$ARTIFACTS_BUCKET/workers/bundles/$BUNDLE $SHA256" | gcloud storage cp - "gs://$ARTIFACTS_BUCKET/workers/$WORKER-bundle"
+
+rm -rf "$BUILD_DIR"
+
+echo "✓ Built $WORKER worker bundle $VERSION"
+echo "  SHA-256: $SHA256"
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""Unit tests for the backfill script.
+
+Tests validate that:
+1. Archives and unpacked prefixes are selected by creation time and ordered oldest first.
+2. A checkpoint lists the finished items of earlier runs, ignoring a line cut short by an interruption.
+3. The both stage transforms the message unpackArchive returns, and publishes only when asked to.
+4. An interrupted run checkpoints the items finished by then without waiting for the running ones.
+"""
+
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from unittest.mock import Mock, patch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "tasks", "bulk-processing"))
+
+import backfill
+
+
+def blob(name, size, day):
+    result = Mock(size=size, time_created=datetime(2026, 9, day, tzinfo=timezone.utc))
+    # name is a Mock constructor argument, it has to be set afterwards
+    result.name = name
+    return result
+
+
+class TestBackfill(unittest.TestCase):
+    """Test cases for listing, checkpoints and runItem."""
+
+    def test_list_archives_and_prefixes(self):
+        """Test that the time range applies to archives and to the oldest object of each prefix."""
+        storage_client = Mock()
+        storage_client.list_blobs.return_value = [
+            blob("b.zip", 20, 3), blob("a.zip", 10, 2), blob("c.zip", 30, 9), blob("notes.txt", 1, 3),
+        ]
+        start, end = backfill.parseTime("2026-09-02"), backfill.parseTime("2026-09-05T00:00:00+00:00")
+        self.assertEqual(backfill.listArchives(storage_client, "ingest", "", start, end), [("a.zip", 10), ("b.zip", 20)])
+
+        storage_client.list_blobs.return_value = [
+            blob("b/x.json", 5, 4), blob("a/x.json", 1, 3), blob("a/y.json", 2, 1), blob("b/y.json", 5, 4),
+            blob("b/.manifest.json", 9, 4), blob("b/nested/z.json", 9, 4),
+        ]
+        self.assertEqual(backfill.listPrefixes(storage_client, "unpack", "", None, None), [("a", 3), ("b", 10)])
+        self.assertEqual(backfill.listPrefixes(storage_client, "unpack", "", start, end), [("b", 10)])
+
+    def test_checkpoint(self):
+        """Test that finished items are read back per stage and a truncated last line is skipped."""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "checkpoint.jsonl")
+            self.assertEqual(backfill.loadCheckpoint(path), set())
+            with open(path, "w") as f:
+                f.write(json.dumps({"stage": "both", "name": "a.zip", "size": 10, "seconds": 1.5}) + "\n")
+                f.write(json.dumps({"stage": "unpack", "name": "b.zip", "size": 20, "seconds": 2}) + "\n")
+                f.write('{"stage": "both", "na')
+            self.assertEqual(backfill.loadCheckpoint(path), {("both", "a.zip"), ("unpack", "b.zip")})
+
+    def test_run_both_stages(self):
+        """Test that the unpack message is transformed under the archive's prefix, published only by transform."""
+        message = {"prefix": "1700000000.1", "objects": [{"name": "1700000000.1/a.json"}]}
+        unpack = Mock(destination_bucket="test-unpack")
+        unpack.unpackArchive.return_value.result.return_value = json.dumps(message).encode("utf-8")
+        transform = Mock(destination_bucket="test-transform")
+        backfill.workers.update(unpack=unpack, transform=transform)
+        try:
+            backfill.runItem("both", "test-ingest", "2026/1700000000.1.zip", publish=True)
+        finally:
+            backfill.workers.clear()
+        unpack.unpackArchive.assert_called_once_with(
+            "test-ingest", "2026/1700000000.1.zip", "test-unpack", "1700000000.1", publish=False
+        )
+        transform.transformPrefixes.assert_called_once_with([message], "test-transform", "1700000000.1", publish=True)
+        transform.transformPrefixes.return_value.result.assert_called_once()
+
+    def test_interrupt(self):
+        """Test that an interrupt checkpoints the finished items, and neither waits for nor checkpoints the rest."""
+        release = threading.Event()
+
+        def runItem(stage, source_bucket, name, publish):
+            if name == "slow.zip":
+                release.wait(10)
+            return 0.5
+
+        def interruptedWait(futures, timeout=None, return_when=None):
+            # Ctrl-C arrives while waiting, after every item but the slow one has finished
+            while sum(future.done() for future in futures) < len(futures) - 1:
+                time.sleep(0.01)
+            raise KeyboardInterrupt
+
+        items = [("a.zip", 10), ("slow.zip", 20), ("c.zip", 30)]
+        progress = backfill.Progress(len(items), 60, interval=60)
+        executor = ThreadPoolExecutor(max_workers=3)
+        with tempfile.TemporaryFile("w+") as checkpoint_file, \
+                patch.object(backfill, "runItem", runItem), patch.object(backfill, "wait", interruptedWait):
+            try:
+                with self.assertRaises(KeyboardInterrupt):
+                    backfill.processItems(executor, items, "unpack", "ingest", False, 2, 0, progress, checkpoint_file)
+                self.assertFalse(release.is_set())
+            finally:
+                release.set()
+                executor.shutdown()
+            checkpoint_file.seek(0)
+            self.assertEqual([json.loads(line)["name"] for line in checkpoint_file], ["a.zip", "c.zip"])
+        self.assertEqual((progress.done, progress.done_bytes), (2, 40))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""Unit tests for the backlog estimate the workers write for the autoscaler.
+
+Tests validate that:
+1. The work model is fitted to the fixed cost per message and the cost per archive byte.
+2. The backlog counts the remaining work of running messages and assumes the recent mean size for the others.
+3. The unpack message carries the archive size, which the transform worker reads as the size of its job.
+4. Every instance writes its share of the backlog, split between the instances that wrote it recently.
+"""
+
+import json
+import os
+import sys
+import unittest
+from unittest.mock import Mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "tasks", "bulk-processing"))
+os.environ.setdefault("PROJECT_ID", "test-project")
+
+try:
+    import unpack
+    import worker_common
+    from prometheus_client import REGISTRY
+except ImportError:
+    unpack = None
+
+
+@unittest.skipIf(unpack is None, "worker dependencies are not installed")
+class TestBacklogEstimate(unittest.TestCase):
+    """Test cases for fitWorkModel, backlogSeconds and writeBacklog."""
+
+    def test_fit_work_model(self):
+        """Test that seconds = 2 + size / 1000 is recovered, and that a negative fixed cost is dropped."""
+        a, b, mean_size = worker_common.fitWorkModel([(size, 2 + size / 1000) for size in (0, 1000, 5000)])
+        self.assertAlmostEqual(a, 2)
+        self.assertAlmostEqual(b, 0.001)
+        self.assertEqual(mean_size, 2000)
+        self.assertEqual(worker_common.fitWorkModel([(1000, 1), (3000, 5)]), (0.0, 0.0015, 2000))
+        self.assertEqual(worker_common.fitWorkModel([(1000, 4), (1000, 6)]), (5.0, 0.0, 1000))
+        self.assertIsNone(worker_common.fitWorkModel([]))
+
+    def test_backlog_seconds(self):
+        """Test that running messages count their remaining work and the others the recent mean."""
+        samples = [(size, 2 + size / 1000) for size in (0, 1000, 5000)]
+        # One running 10000 byte archive with 5 of its 12 seconds done, 3 more messages of 4 seconds each
+        self.assertAlmostEqual(worker_common.backlogSeconds(4, [(10000, 5)], samples, capacity=1), 7 + 3 * 4)
+        self.assertAlmostEqual(worker_common.backlogSeconds(4, [(10000, 5)], samples, capacity=2), (7 + 3 * 4) / 2)
+        # A message running longer than estimated has no work left, the undelivered count may lag behind
+        self.assertEqual(worker_common.backlogSeconds(0, [(0, 60)], samples, capacity=1), 0)
+        self.assertIsNone(worker_common.backlogSeconds(10, [], [], capacity=1))
+
+    def test_message_sizes(self):
+        """Test that a job's size is the archive size of an ingest notification or of the unpack message."""
+        data, manifest = unpack.unpackMessage("1700000000.1", [{"name": "1700000000.1/a.json"}], 1234)
+        self.assertIsNone(manifest)
+        self.assertEqual(json.loads(data)["size"], 1234)
+        self.assertEqual(worker_common.Job(Mock(data=data)).size, 1234)
+        group = worker_common.MessageGroup([Mock(data=data), Mock(data=data)])
+        self.assertEqual(worker_common.archiveSize(group), 2468)
+        self.assertEqual(worker_common.archiveSize(Mock(data=b"")), 0)
+        notification = Mock(data=json.dumps({"name": "1700000000.1.zip", "size": "99"}).encode("utf-8"))
+        self.assertEqual(worker_common.Job(notification).size, 99)
+
+    def test_write_backlog(self):
+        """Test that the backlog of both workers' jobs is written as this instance's share."""
+        session = Mock()
+        session.get.return_value.json.side_effect = [
+            {"timeSeries": [{"points": [{"value": {"int64Value": "3"}}]}]},
+            {"timeSeries": [{"resource": {"labels": {"instance_id": "other"}}}]},
+        ]
+        stage = worker_common.Stage("backlog_test", 1)
+        stage.recent_work.extend((size, 2 + size / 1000) for size in (0, 1000, 5000))
+        stage.writeBacklog(session, "test-subscription", "instance", "zone")
+        series = session.post.call_args.kwargs["json"]["timeSeries"][0]
+        self.assertEqual(series["metric"]["labels"], {"subscription_id": "test-subscription"})
+        capacity = worker_common.callback_workers * worker_common.instance_processes
+        # 3 messages of 4 seconds each, split between this instance and the other writer
+        self.assertAlmostEqual(series["points"][0]["value"]["doubleValue"], 3 * 4 / capacity / 2)
+        self.assertAlmostEqual(REGISTRY.get_sample_value("backlog_test_backlog_seconds"), 3 * 4 / capacity / 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
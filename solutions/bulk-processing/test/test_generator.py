@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""Unit tests for the bulk-processing data generator.
+
+Tests validate that:
+1. Generated documents have the same format as the original per-sensor JSON files.
+2. Runs with the same seed produce the same readings.
+3. Readings stay within the expected ranges.
+4. Zip output contains one member per sensor.
+"""
+
+import io
+import json
+import os
+import sys
+import unittest
+from zipfile import ZipFile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "tasks", "bulk-processing"))
+
+try:
+    import numpy as np
+    import generator
+except ImportError:
+    generator = None
+
+
+@unittest.skipIf(generator is None, "numpy is not installed")
+class TestGenerator(unittest.TestCase):
+    """Test cases for the generator's bulk mode."""
+
+    def documents(self, seed, sensors=100):
+        rng = np.random.default_rng(seed)
+        return [document for _, batch in generator.generateDocuments(rng, sensors, "1700000000") for document in batch]
+
+    def test_document_format(self):
+        """Test that documents match json.dumps of the per-sensor dict."""
+        for document in self.documents(seed=1, sensors=10):
+            data = json.loads(document)
+            self.assertEqual(list(data), ["id", "temperature", "humidity", "pressure", "timestamp"])
+            self.assertEqual(document, json.dumps(data))
+            self.assertEqual(data["timestamp"], "1700000000")
+
+    def test_seed_is_reproducible(self):
+        """Test that the same seed produces the same documents and another seed does not."""
+        self.assertEqual(self.documents(seed=42), self.documents(seed=42))
+        self.assertNotEqual(self.documents(seed=42), self.documents(seed=43))
+
+    def test_reading_ranges(self):
+        """Test that readings are whole numbers within the sensor ranges."""
+        readings = generator.generateReadings(np.random.default_rng(7), 10000)
+        for metric, low, high in (("temperature", 0, 40), ("humidity", 0, 100), ("pressure", 950, 1050)):
+            with self.subTest(metric=metric):
+                values = readings[metric]
+                self.assertGreaterEqual(values.min(), low)
+                self.assertLessEqual(values.max(), high)
+                self.assertTrue((values == np.round(values)).all())
+
+    def test_batches_cover_all_sensors(self):
+        """Test that sensor ids continue across batches."""
+        batch_size = generator.BATCH_SIZE
+        generator.BATCH_SIZE = 4
+        try:
+            batches = list(generator.generateDocuments(np.random.default_rng(1), 10, "1"))
+        finally:
+            generator.BATCH_SIZE = batch_size
+        self.assertEqual([start for start, _ in batches], [0, 4, 8])
+        ids = [json.loads(document)["id"] for _, batch in batches for document in batch]
+        self.assertEqual(ids, list(range(10)))
+
+    def test_zip_output(self):
+        """Test that zip output has one JSON member per sensor."""
+        buffer = io.BytesIO()
+        generator.writeZip(buffer, generator.generateDocuments(np.random.default_rng(1), 5, "1"))
+        with ZipFile(buffer) as archive:
+            self.assertEqual(archive.namelist(), [f"sensor{i}.json" for i in range(5)])
+            self.assertEqual(json.loads(archive.read("sensor3.json"))["id"], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
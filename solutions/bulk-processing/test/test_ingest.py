@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""Unit tests for the ingest script.
+
+Tests validate that:
+1. An archive streamed into a write-only, non-seekable upload is a complete zip with one member per sensor.
+"""
+
+import io
+import json
+import os
+import sys
+import unittest
+from unittest.mock import Mock
+from zipfile import ZipFile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "tasks", "bulk-processing"))
+
+try:
+    import numpy as np
+    import ingest
+except ImportError:
+    ingest = None
+
+
+class UnseekableWriter(io.RawIOBase):
+    """Write-only stream like the writer of Blob.open, it knows its position but cannot seek."""
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.data += b
+        return len(b)
+
+    def tell(self):
+        return len(self.data)
+
+
+@unittest.skipIf(ingest is None, "ingest dependencies are not installed")
+class TestIngest(unittest.TestCase):
+    """Test cases for ingestArchive."""
+
+    def test_streamed_archive_round_trips(self):
+        """Test that the archive written to the upload stream reads back with every generated document."""
+        writer = UnseekableWriter()
+        blob = Mock()
+        blob.open.return_value = writer
+        bucket = Mock()
+        bucket.blob.return_value = blob
+        ingest.ingestArchive(bucket, "1700000000.1.zip", np.random.default_rng(1), 25, "1700000000")
+
+        bucket.blob.assert_called_once_with("1700000000.1.zip")
+        blob.open.assert_called_once_with("wb", ignore_flush=True, content_type="application/zip")
+        self.assertTrue(writer.closed)
+        expected = [
+            document
+            for _, batch in ingest.generator.generateDocuments(np.random.default_rng(1), 25, "1700000000")
+            for document in batch
+        ]
+        with ZipFile(io.BytesIO(bytes(writer.data))) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual(archive.namelist(), [f"sensor{i}.json" for i in range(25)])
+            documents = [archive.read(f"sensor{i}.json").decode("utf-8") for i in range(25)]
+        self.assertEqual(documents, expected)
+        self.assertEqual([json.loads(document)["id"] for document in documents], list(range(25)))
+
+
+if __name__ == '__main__':
+    unittest.main()
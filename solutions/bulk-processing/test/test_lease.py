@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""Unit tests for the lease watchdog of the bulk-processing workers.
+
+Tests validate that:
+1. Leases of messages making progress are extended with the adaptive ack deadline.
+2. Stalled messages and messages over the hard cap are nacked and their work cancelled.
+3. The ack deadline follows the 99th percentile of recent processing times within Pub/Sub's limits.
+4. A draining worker nacks new messages and the messages still running after DRAIN_SECONDS, and waits for the
+   messages handed to the event loop.
+5. A job cancelled after its last member upload does not publish.
+6. On the Pub/Sub emulator, with a deliberately slow fake GCS, an archive that takes longer than the
+   subscription's ack deadline is delivered once, and a stuck archive is redelivered and unpacked once.
+   Needs PUBSUB_EMULATOR_HOST.
+"""
+
+import asyncio
+import io
+import json
+import os
+import sys
+import threading
+import time
+import unittest
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import Mock, patch
+from zipfile import ZipFile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "tasks", "bulk-processing"))
+os.environ.setdefault("PROJECT_ID", "test-project")
+
+try:
+    import unpack
+    import worker_common
+    from prometheus_client import REGISTRY
+except ImportError:
+    unpack = None
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+@unittest.skipIf(unpack is None, "worker dependencies are not installed")
+class TestLeaseWatchdog(unittest.TestCase):
+    """Test cases for checkLeases and ackDeadline."""
+
+    def setUp(self):
+        """Set up test fixtures."""
+        self.key = ("ingest", f"{self.id()}.zip", "1")
+        self.assertIsNone(unpack.stage.claim(self.key))
+        self.job = unpack.stage.startJob(Mock(), [self.key])
+
+    def tearDown(self):
+        """Tear down test fixtures."""
+        unpack.stage.finishJob(self.job, succeeded=False)
+        unpack.stage.release(self.key, done=False)
+
+    def test_progressing_job_is_extended(self):
+        """Test that a job with recent progress gets its ack deadline extended."""
+        unpack.stage.checkLeases(now=self.job.last_progress + 1)
+        self.job.message.modify_ack_deadline.assert_called_once_with(unpack.stage.ackDeadline())
+        self.job.message.nack.assert_not_called()
+        self.job.check()
+
+    def test_stalled_job_is_cancelled(self):
+        """Test that a job without progress is nacked, cancelled and released for the redelivery."""
+        stalled = sample("unpack_cancelled_total", reason="stalled")
+        unpack.stage.checkLeases(now=self.job.last_progress + worker_common.lease_stall_seconds + 1)
+        self.job.message.nack.assert_called_once()
+        self.job.message.modify_ack_deadline.assert_not_called()
+        self.assertRaises(worker_common.JobCancelled, self.job.progress)
+        self.assertNotIn(self.job, unpack.stage.jobs)
+        self.assertIsNone(unpack.stage.claim(self.key))
+        self.assertEqual(sample("unpack_cancelled_total", reason="stalled"), stalled + 1)
+
+    def test_hard_cap(self):
+        """Test that a job running longer than the hard cap is cancelled even while it makes progress."""
+        with patch.object(worker_common, "lease_max_seconds", 5):
+            self.job.started -= 10
+            unpack.stage.checkLeases(now=self.job.last_progress)
+        self.job.message.nack.assert_called_once()
+        self.assertRaises(worker_common.JobCancelled, self.job.check)
+
+    def test_drain(self):
+        """Test that draining nacks new messages, and running ones once DRAIN_SECONDS is over."""
+        shutdown = sample("unpack_cancelled_total", reason="shutdown")
+        new_message = Mock(attributes={"eventType": "OBJECT_FINALIZE", "bucketId": "ingest", "objectId": "new.zip"})
+        with patch.object(worker_common, "drain_seconds", 0):
+            worker_common.draining.set()
+            try:
+                self.assertIsNone(unpack.claimMessage(new_message))
+                unpack.stage.drain()
+            finally:
+                worker_common.draining.clear()
+        new_message.nack.assert_called_once()
+        self.job.message.nack.assert_called_once()
+        self.assertRaises(worker_common.JobCancelled, self.job.check)
+        self.assertIsNone(unpack.stage.claim(self.key))
+        self.assertEqual(sample("unpack_cancelled_total", reason="shutdown"), shutdown + 1)
+
+    def test_drain_waits_for_scheduled_messages(self):
+        """Test that draining waits for messages handed to the event loop before their coroutine has a job."""
+        unpack.stage.finishJob(self.job, succeeded=False)
+        loop = asyncio.new_event_loop()
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+        self.addCleanup(loop.call_soon_threadsafe, loop.stop)
+        handled = []
+
+        async def slowCallback(message):
+            await asyncio.sleep(0.2)
+            handled.append(message)
+
+        with patch.object(worker_common, "event_loop", loop), patch.object(worker_common, "drain_seconds", 5):
+            worker_common.scheduleOnEventLoop(slowCallback)("message")
+            unpack.stage.drain()
+        self.assertEqual(handled, ["message"])
+
+    def test_ack_deadline(self):
+        """Test that the ack deadline follows the 99th percentile of processing times, within 10-600s."""
+        with patch.object(unpack.stage, "processing_times", deque()):
+            self.assertEqual(unpack.stage.ackDeadline(), worker_common.MAX_ACK_DEADLINE)
+        with patch.object(unpack.stage, "processing_times", deque([1.0] * 100)):
+            self.assertEqual(unpack.stage.ackDeadline(), worker_common.MIN_ACK_DEADLINE)
+        with patch.object(unpack.stage, "processing_times", deque([30.0] * 99 + [1000.0, 45.2])):
+            self.assertEqual(unpack.stage.ackDeadline(), 46)
+        with patch.object(unpack.stage, "processing_times", deque([5000.0])):
+            self.assertEqual(unpack.stage.ackDeadline(), worker_common.MAX_ACK_DEADLINE)
+
+    def test_cancelled_job_is_not_published(self):
+        """Test that a job cancelled while its manifest is uploaded raises instead of publishing."""
+        archive_data = io.BytesIO()
+        with ZipFile(archive_data, "w") as archive:
+            archive.writestr("sensor0.json", json.dumps({"id": 0}))
+        archive_data = archive_data.getvalue()
+        archive_blob = Mock(size=len(archive_data), generation=1)
+        archive_blob.download_to_file.side_effect = lambda file: file.write(archive_data)
+
+        def memberBlob(name):
+            blob = Mock(size=1, generation=1)
+            blob.name = name
+            if name == f"1700000000.1/{worker_common.MANIFEST_NAME}":
+                # The watchdog nacks the message while the manifest, the last upload, is written
+                blob.upload_from_string.side_effect = lambda *args, **kwargs: unpack.stage.cancelJob(
+                    self.job, "stalled"
+                )
+            return blob
+
+        storage_client = Mock()
+        storage_client.bucket.side_effect = lambda name: (
+            Mock(blob=lambda object_name, generation=None: archive_blob) if name == "ingest" else Mock(blob=memberBlob)
+        )
+        publisher_client = Mock()
+        with patch.object(unpack.stage, "getStorageClient", return_value=storage_client), \
+                patch.object(unpack.stage, "getPublisherClient", return_value=publisher_client), \
+                patch.object(unpack, "manifest_inline_max_bytes", 0):
+            with self.assertRaises(worker_common.JobCancelled):
+                unpack.unpackArchive("ingest", self.key[1], "unpack", "1700000000.1", self.job)
+        publisher_client.publish.assert_not_called()
+        self.job.message.nack.assert_called_once()
+
+
+class SlowStorageClient:
+    """Fake storage client serving one archive, every member upload takes upload_seconds."""
+
+    def __init__(self, archive, upload_seconds, stuck_upload=None):
+        self.archive = archive
+        self.upload_seconds = upload_seconds
+        # The first upload blocks until the event is set
+        self.stuck_upload = stuck_upload
+        self.uploads = 0
+        self.lock = threading.Lock()
+
+    def bucket(self, name):
+        return Mock(blob=lambda object_name, generation=None: SlowBlob(self, object_name))
+
+
+class SlowBlob:
+    def __init__(self, storage_client, name):
+        self.storage_client = storage_client
+        self.name = name
+        self.bucket = Mock()
+
+    def reload(self):
+        self.size = len(self.storage_client.archive)
+        self.generation = 1
+
+    def download_to_file(self, file):
+        for start in range(0, self.size, 1024):
+            file.write(self.storage_client.archive[start:start + 1024])
+
+    def upload_from_file(self, file, size=None, content_type=None):
+        self.size = len(file.read())
+        self.generation = 1
+        with self.storage_client.lock:
+            self.storage_client.uploads += 1
+            first = self.storage_client.uploads == 1
+        if first and self.storage_client.stuck_upload is not None:
+            self.storage_client.stuck_upload.wait()
+        time.sleep(self.storage_client.upload_seconds)
+
+
+@unittest.skipIf(unpack is None, "worker dependencies are not installed")
+@unittest.skipUnless(os.environ.get("PUBSUB_EMULATOR_HOST"), "PUBSUB_EMULATOR_HOST is not set")
+class TestLeaseOnEmulator(unittest.TestCase):
+    """Test cases running unpack.callback behind a real streaming pull from the Pub/Sub emulator."""
+
+    ACK_DEADLINE = 10
+
+    def setUp(self):
+        """Create a topic pair and a subscription with a short ack deadline."""
+        from google.cloud.pubsub import PublisherClient, SubscriberClient
+        run_id = f"lease-{time.time_ns()}"
+        self.publisher = PublisherClient()
+        self.subscriber = SubscriberClient()
+        self.topic_path = self.publisher.topic_path(unpack.project_id, f"{run_id}-ingest")
+        self.publisher.create_topic(name=self.topic_path)
+        self.publisher.create_topic(name=self.publisher.topic_path(unpack.project_id, f"{run_id}-unpack"))
+        self.subscription_path = self.subscriber.subscription_path(unpack.project_id, f"{run_id}-ingest")
+        self.subscriber.create_subscription(
+            name=self.subscription_path, topic=self.topic_path, ack_deadline_seconds=self.ACK_DEADLINE
+        )
+        self.object_name = f"{run_id}.zip"
+
+        buffer = io.BytesIO()
+        with ZipFile(buffer, "w") as archive:
+            for i in range(6):
+                archive.writestr(f"sensor{i}.json", json.dumps({"id": i}))
+        self.archive = buffer.getvalue()
+
+        self.stop = threading.Event()
+        self.upload_executor = ThreadPoolExecutor(max_workers=1)
+        # Recent messages were fast, so the ack deadline is at its minimum
+        for target, name, value in (
+            (unpack, "topic_id", f"{run_id}-unpack"),
+            (unpack, "upload_executor", self.upload_executor),
+            (worker_common, "lease_stall_seconds", 4),
+            (worker_common, "MIN_ACK_DEADLINE", self.ACK_DEADLINE),
+            (unpack.stage, "processing_times", deque([1.0] * 10)),
+        ):
+            patcher = patch.object(target, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        """Stop the watchdog and the upload pool."""
+        self.stop.set()
+        self.upload_executor.shutdown(wait=False)
+
+    def watch(self):
+        while not self.stop.wait(1):
+            unpack.stage.checkLeases()
+
+    def run_pipeline(self, storage_client, on_delivery=None, wait_after_ack=15):
+        """Deliver one archive and return the number of deliveries and of published messages."""
+        deliveries = []
+        published = []
+        acked = threading.Event()
+        ack_on_publish = unpack.stage.ackOnPublish
+
+        def countingAckOnPublish(message, future):
+            ack_on_publish(message, future)
+            published.append(future.result())
+            acked.set()
+
+        def countingCallback(message):
+            deliveries.append(message.message_id)
+            if on_delivery:
+                on_delivery(len(deliveries))
+            unpack.callback(message)
+
+        threading.Thread(target=self.watch, daemon=True).start()
+        with patch.object(unpack.stage, "getStorageClient", return_value=storage_client), \
+                patch.object(unpack.stage, "ackOnPublish", countingAckOnPublish):
+            future = self.subscriber.subscribe(self.subscription_path, callback=countingCallback)
+            self.publisher.publish(
+                self.topic_path, b"", eventType="OBJECT_FINALIZE", bucketId="ingest",
+                objectId=self.object_name, objectGeneration=str(time.time_ns()),
+            ).result()
+            self.assertTrue(acked.wait(120), "archive was not unpacked")
+            # Any redelivery after the first deadline would show up now
+            time.sleep(wait_after_ack)
+            future.cancel()
+        return len(deliveries), len(published)
+
+    def test_slow_archive_is_delivered_once(self):
+        """Test that an archive taking longer than the ack deadline is not redelivered while it progresses."""
+        extensions = sample("unpack_lease_extensions_total")
+        storage_client = SlowStorageClient(self.archive, upload_seconds=3)
+        self.assertEqual(self.run_pipeline(storage_client), (1, 1))
+        self.assertGreater(sample("unpack_lease_extensions_total"), extensions)
+
+    def test_stuck_archive_is_redelivered(self):
+        """Test that a stuck archive is nacked, redelivered and unpacked once."""
+        stalled = sample("unpack_cancelled_total", reason="stalled")
+        stuck_upload = threading.Event()
+        storage_client = SlowStorageClient(self.archive, upload_seconds=0, stuck_upload=stuck_upload)
+
+        def onDelivery(count):
+            # The stuck upload returns once the redelivery arrives, its job then stops at the next check
+            if count == 2:
+                stuck_upload.set()
+
+        self.assertEqual(self.run_pipeline(storage_client, onDelivery), (2, 1))
+        self.assertEqual(sample("unpack_cancelled_total", reason="stalled"), stalled + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
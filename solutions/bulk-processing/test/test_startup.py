@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+"""Unit tests for the import time of the workers.
+
+Tests validate that:
+1. Importing a worker does not load the Pub/Sub and Cloud Storage client libraries, they are imported with the
+   clients, so the supervisor and restarted worker processes start quickly.
+"""
+
+import os
+import subprocess
+import sys
+import unittest
+
+WORKERS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "tasks", "bulk-processing")
+
+try:
+    import google.cloud.pubsub  # noqa: F401
+    import prometheus_client  # noqa: F401
+except ImportError:
+    prometheus_client = None
+
+
+@unittest.skipIf(prometheus_client is None, "worker dependencies are not installed")
+class TestWorkerImports(unittest.TestCase):
+    """Test cases for the modules loaded by importing the workers."""
+
+    def test_client_libraries_are_lazy(self):
+        """Test that the client libraries are not among the modules loaded by importing each worker."""
+        for worker in ("unpack", "transform"):
+            with self.subTest(worker=worker):
+                result = subprocess.run(
+                    [sys.executable, "-c", f"import sys, {worker}; print(' '.join(sys.modules))"],
+                    env=dict(os.environ, PROJECT_ID="test-project", PYTHONPATH=WORKERS_DIR),
+                    capture_output=True, text=True, check=True,
+                )
+                modules = set(result.stdout.split())
+                self.assertIn(worker, modules)
+                for name in ("google.cloud.pubsub", "google.cloud.storage", "grpc"):
+                    self.assertNotIn(name, modules)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+"""Unit tests for the transform worker output.
+
+Tests validate that:
+1. CSV output has one file per metric with quoted, well-formed rows.
+2. Parquet output has one typed file per metric.
+3. Wide Parquet output has a single file with all metrics.
+4. Phase timings, bytes and message results are recorded in the worker metrics.
+5. Redeliveries of a transformed prefix are acknowledged without transforming it again.
+6. In batching mode several prefixes are written as one output with a manifest and acked together.
+7. Objects listed in the unpack manifest are read at their generation without listing the prefix, and a listed
+   prefix skips a manifest object left in it.
+8. Archive input transforms the zip members of the notified generation in memory and writes audit copies only
+   when asked to.
+9. The asyncio runtime writes the same outputs as the threaded one and acks the message once it is published.
+"""
+
+import asyncio
+import io
+import json
+import os
+import sys
+import unittest
+from concurrent.futures import Future
+from unittest.mock import AsyncMock, Mock, patch
+from zipfile import ZipFile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "tasks", "bulk-processing"))
+os.environ.setdefault("PROJECT_ID", "test-project")
+
+try:
+    import transform
+    from prometheus_client import REGISTRY
+except ImportError:
+    transform = None
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+
+def listedBlob(name, data):
+    blob = Mock(download_as_bytes=Mock(return_value=data))
+    # name is a Mock constructor argument, it has to be set afterwards
+    blob.name = name
+    return blob
+
+
+def mockStorageClient(documents):
+    """Return a mock storage client listing the documents and the dict of mock blobs it creates, keyed by name.
+
+    The listing also has the manifest of an earlier run, which is not a document.
+    """
+    blobs = {}
+    bucket = Mock()
+    bucket.blob.side_effect = lambda name: blobs.setdefault(name, Mock())
+    storage_client = Mock()
+    storage_client.bucket.return_value = bucket
+    storage_client.list_blobs.return_value = [
+        listedBlob(f"1700000000.1/sensor{i}.json", json.dumps(document).encode("utf-8"))
+        for i, document in enumerate(documents)
+    ] + [listedBlob(f"1700000000.1/{transform.MANIFEST_NAME}", b'{"objects": []}')]
+    return storage_client, blobs
+
+
+class FakeAioStorage:
+    """Stands in for gcloud.aio.storage.Storage, serving objects of one generation keyed by (bucket, name)."""
+
+    def __init__(self, objects, page_size=2):
+        self.objects = objects
+        self.page_size = page_size
+        self.uploads = {}
+
+    async def list_objects(self, bucket, params=None):
+        prefix = params.get("prefix", "")
+        names = sorted(name for bucket_name, name in self.objects if bucket_name == bucket and name.startswith(prefix))
+        start = int(params.get("pageToken", 0))
+        page = {"items": [{"name": name, "generation": "3"} for name in names[start:start + self.page_size]]}
+        if start + self.page_size < len(names):
+            page["nextPageToken"] = str(start + self.page_size)
+        return page
+
+    async def _download(self, bucket, object_name, params=None):
+        assert params["generation"] == "3"
+        return self.objects[(bucket, object_name)]
+
+    async def upload(self, bucket, object_name, data, content_type=None):
+        self.uploads[(bucket, object_name)] = data
+        return {"name": object_name, "size": str(len(data)), "generation": "1"}
+
+
+@unittest.skipIf(transform is None, "worker dependencies are not installed")
+class TestTransformOutput(unittest.TestCase):
+    """Test cases for the files written by transformData."""
+
+    def transform(self, output_format="csv"):
+        """Run transformData on the documents and return the mock blobs it uploaded to."""
+        storage_client, blobs = mockStorageClient(self.documents)
+        with patch.object(transform.stage, "getStorageClient", return_value=storage_client), \
+                patch.object(transform.stage, "getPublisherClient", return_value=Mock()), \
+                patch.object(transform, "output_format", output_format):
+            transform.transformData("unpack", "1700000000.1", "transform", "1700000000.1")
+        return blobs
+
+    def setUp(self):
+        """Set up test fixtures."""
+        self.documents = [
+            {"id": i, "timestamp": "1700000000", "temperature": 20.0 + i, "humidity": 50.0, "pressure": 1000.0}
+            for i in range(3)
+        ]
+
+    def test_csv_output(self):
+        """Test that CSV output is written per metric with quoted rows."""
+        blobs = self.transform("csv")
+
+        self.assertEqual(sorted(blobs), [
+            "humidity/1700000000.1.csv",
+            "pressure/1700000000.1.csv",
+            "temperature/1700000000.1.csv",
+        ])
+        content = blobs["temperature/1700000000.1.csv"].upload_from_string.call_args[0][0]
+        self.assertEqual(content.splitlines(), [
+            '"Sensor ID","Timestamp","Temperature"',
+            '"0","1700000000","20.0"',
+            '"1","1700000000","21.0"',
+            '"2","1700000000","22.0"',
+        ])
+
+    @unittest.skipIf(pq is None, "pyarrow is not installed")
+    def test_parquet_output(self):
+        """Test that Parquet output is written per metric with typed columns."""
+        blobs = self.transform("parquet")
+
+        self.assertEqual(sorted(blobs), [
+            "humidity/1700000000.1.parquet",
+            "pressure/1700000000.1.parquet",
+            "temperature/1700000000.1.parquet",
+        ])
+        content = blobs["temperature/1700000000.1.parquet"].upload_from_string.call_args[0][0]
+        table = pq.read_table(io.BytesIO(content))
+        self.assertEqual(table.column_names, ["sensor_id", "timestamp", "temperature"])
+        self.assertEqual(table.column("sensor_id").to_pylist(), [0, 1, 2])
+        self.assertEqual(table.column("temperature").to_pylist(), [20.0, 21.0, 22.0])
+        self.assertEqual(table.column("timestamp")[0].as_py().timestamp(), 1700000000)
+
+    @unittest.skipIf(pq is None, "pyarrow is not installed")
+    def test_parquet_wide_output(self):
+        """Test that wide Parquet output is a single table with every metric."""
+        blobs = self.transform("parquet-wide")
+
+        self.assertEqual(list(blobs), ["readings/1700000000.1.parquet"])
+        content = blobs["readings/1700000000.1.parquet"].upload_from_string.call_args[0][0]
+        table = pq.read_table(io.BytesIO(content))
+        self.assertEqual(table.column_names, ["sensor_id", "timestamp", "temperature", "humidity", "pressure"])
+        self.assertEqual(table.num_rows, 3)
+
+    def test_metrics(self):
+        """Test that every phase is timed and bytes and acks are counted."""
+        def sample(name, **labels):
+            return REGISTRY.get_sample_value(name, labels) or 0
+
+        phases = ("list", "download", "build", "upload")
+        before = {phase: sample("transform_phase_seconds_count", phase=phase) for phase in phases}
+        bytes_in = sample("transform_bytes_in_total")
+        bytes_out = sample("transform_bytes_out_total")
+        blobs = self.transform("csv")
+        for phase in phases:
+            self.assertEqual(sample("transform_phase_seconds_count", phase=phase), before[phase] + 1)
+        downloaded = sum(len(json.dumps(document)) for document in self.documents)
+        self.assertEqual(sample("transform_bytes_in_total"), bytes_in + downloaded)
+        uploaded = sum(len(blob.upload_from_string.call_args[0][0]) for blob in blobs.values())
+        self.assertEqual(sample("transform_bytes_out_total"), bytes_out + uploaded)
+
+        acked = sample("transform_messages_total", result="acked")
+        nacked = sample("transform_messages_total", result="nacked")
+        transform.stage.ackOnPublish(Mock(), Mock(result=Mock(return_value="1")))
+        transform.stage.ackOnPublish(Mock(), Mock(result=Mock(side_effect=RuntimeError("publish failed"))))
+        self.assertEqual(sample("transform_messages_total", result="acked"), acked + 1)
+        self.assertEqual(sample("transform_messages_total", result="nacked"), nacked + 1)
+
+    def test_redelivery_is_skipped(self):
+        """Test that a redelivered message is acked once without a second transform, a new generation is not."""
+        storage_client, blobs = mockStorageClient(self.documents)
+        published = Future()
+        published.set_result("1")
+        publisher_client = Mock()
+        publisher_client.publish.return_value = published
+        duplicates = REGISTRY.get_sample_value("transform_duplicates_total", {"source": "cache"}) or 0
+
+        def message(generation):
+            data = json.dumps({"bucket": "unpack", "path": "1700000000.2"}).encode("utf-8")
+            return Mock(data=data, attributes={"generation": generation})
+
+        first, redelivered, reuploaded = message("5"), message("5"), message("6")
+        with patch.object(transform.stage, "getStorageClient", return_value=storage_client), \
+                patch.object(transform.stage, "getPublisherClient", return_value=publisher_client):
+            for delivery in (first, redelivered, reuploaded):
+                transform.callback(delivery)
+
+        self.assertEqual(publisher_client.publish.call_count, 2)
+        for delivery in (first, redelivered, reuploaded):
+            delivery.ack.assert_called_once()
+        self.assertEqual(REGISTRY.get_sample_value("transform_duplicates_total", {"source": "cache"}), duplicates + 1)
+
+    def test_manifest_source(self):
+        """Test that the objects from the message manifest are read at their generation instead of listed."""
+        storage_client, blobs = mockStorageClient([])
+        sources = {}
+        for i, document in enumerate(self.documents):
+            sources[f"1700000000.1/sensor{i}.json"] = json.dumps(document).encode("utf-8")
+        src_bucket = Mock()
+        src_bucket.blob.side_effect = lambda name, generation: Mock(
+            download_as_bytes=Mock(return_value=sources[name] if generation == 7 else b"{}")
+        )
+        storage_client.bucket.side_effect = lambda name: src_bucket if name == "unpack" else Mock(
+            blob=lambda object_name: blobs.setdefault(object_name, Mock())
+        )
+        source = {
+            "bucket": "unpack",
+            "path": "1700000000.1",
+            "objects": [{"name": name, "size": len(data), "generation": 7} for name, data in sources.items()],
+        }
+        with patch.object(transform.stage, "getStorageClient", return_value=storage_client), \
+                patch.object(transform.stage, "getPublisherClient", return_value=Mock()):
+            transform.transformPrefixes([source], "transform", "1700000000.1")
+
+        storage_client.list_blobs.assert_not_called()
+        content = blobs["temperature/1700000000.1.csv"].upload_from_string.call_args[0][0]
+        self.assertEqual(len(content.splitlines()), 1 + len(self.documents))
+
+    def test_archive_input(self):
+        """Test that an archive is transformed without the unpack bucket, with optional audit copies."""
+        buffer = io.BytesIO()
+        with ZipFile(buffer, "w") as archive:
+            for i, document in enumerate(self.documents):
+                archive.writestr(f"sensor{i}.json", json.dumps(document))
+            archive.writestr("nested/sensor9.json", json.dumps(self.documents[0]))
+        archive_data = buffer.getvalue()
+
+        def archiveBlob(name, generation=None):
+            # Only the generation of the notification is served
+            self.assertEqual(generation, "5")
+            blob = Mock()
+            blob.reload.side_effect = lambda: setattr(blob, "size", len(archive_data))
+            blob.download_to_file.side_effect = lambda file: file.write(archive_data)
+            return blob
+
+        for audit_bucket in (None, "audit"):
+            with self.subTest(audit_bucket=audit_bucket):
+                storage_client, blobs = mockStorageClient([])
+                buckets = {"ingest": Mock(blob=archiveBlob)}
+                storage_client.bucket.side_effect = lambda name: buckets.get(name) or Mock(
+                    blob=lambda object_name: blobs.setdefault(f"{name}:{object_name}", Mock())
+                )
+                with patch.object(transform.stage, "getStorageClient", return_value=storage_client), \
+                        patch.object(transform.stage, "getPublisherClient", return_value=Mock()), \
+                        patch.object(transform, "audit_bucket", audit_bucket):
+                    transform.transformArchive(
+                        "ingest", "1700000000.5.zip", "transform", "1700000000.5", generation="5"
+                    )
+
+                content = blobs["transform:temperature/1700000000.5.csv"].upload_from_string.call_args[0][0]
+                self.assertEqual(len(content.splitlines()), 1 + len(self.documents))
+                audited = sorted(name for name in blobs if name.startswith("audit:"))
+                expected = [f"audit:1700000000.5/sensor{i}.json" for i in range(len(self.documents))]
+                self.assertEqual(audited, expected if audit_bucket else [])
+                storage_client.list_blobs.assert_not_called()
+
+    def test_asyncio_runtime(self):
+        """Test that the asyncio runtime lists every page, writes the threaded outputs and acks once published."""
+        objects = {
+            ("unpack", f"1700000000.6/sensor{i}.json"): json.dumps(document).encode("utf-8")
+            for i, document in enumerate(self.documents)
+        }
+        objects[("unpack", f"1700000000.6/{transform.MANIFEST_NAME}")] = b'{"objects": []}'
+        storage = FakeAioStorage(objects)
+        published = Future()
+        published.set_result("1")
+        publisher_client = Mock()
+        publisher_client.publish.return_value = published
+        message = Mock(data=json.dumps({"bucket": "unpack", "path": "1700000000.6"}).encode("utf-8"),
+                       attributes={"generation": "6"})
+        with patch.object(transform.stage, "getAioStorageClient", AsyncMock(return_value=storage)), \
+                patch.object(transform.stage, "getPublisherClient", return_value=publisher_client):
+            asyncio.run(transform.callbackAsync(message))
+
+        message.ack.assert_called_once()
+        data = json.loads(publisher_client.publish.call_args[0][1])
+        self.assertEqual(data, {"bucket": transform.destination_bucket, "path": "1700000000.6"})
+        blobs = self.transform("csv")
+        for metric in transform.measurements:
+            threaded = blobs[f"{metric}/1700000000.1.csv"].upload_from_string.call_args[0][0]
+            self.assertEqual(storage.uploads[(transform.destination_bucket, f"{metric}/1700000000.6.csv")], threaded)
+
+    def test_batch(self):
+        """Test that a full batch is written once per metric, with a manifest, and all its messages are acked."""
+        storage_client, blobs = mockStorageClient(self.documents)
+        published = Future()
+        published.set_result("1")
+        publisher_client = Mock()
+        publisher_client.publish.return_value = published
+        deliveries = [
+            Mock(data=json.dumps({"bucket": "unpack", "path": f"1700000000.{i}"}).encode("utf-8"),
+                 attributes={"generation": str(i)})
+            for i in range(3, 5)
+        ]
+        with patch.object(transform.stage, "getStorageClient", return_value=storage_client), \
+                patch.object(transform.stage, "getPublisherClient", return_value=publisher_client), \
+                patch.object(transform, "batch_max_prefixes", 2):
+            transform.callback(deliveries[0])
+            deliveries[0].ack.assert_not_called()
+            transform.callback(deliveries[1])
+
+        for delivery in deliveries:
+            delivery.ack.assert_called_once()
+        publisher_client.publish.assert_called_once()
+        data = json.loads(publisher_client.publish.call_args[0][1])
+        self.assertEqual(data["manifest"], f"manifests/{data['path']}.json")
+        manifest = json.loads(blobs[data["manifest"]].upload_from_string.call_args[0][0])
+        self.assertEqual(manifest["prefixes"], [
+            {"bucket": "unpack", "path": "1700000000.3", "generation": "3"},
+            {"bucket": "unpack", "path": "1700000000.4", "generation": "4"},
+        ])
+        content = blobs[f"temperature/{data['path']}.csv"].upload_from_string.call_args[0][0]
+        self.assertEqual(len(content.splitlines()), 1 + 2 * len(self.documents))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+"""Unit tests for the unpack worker's asyncio runtime and notifications.
+
+Tests validate that:
+1. unpackArchiveAsync uploads the same members and publishes the same message as unpackArchive.
+2. A failed member upload fails the archive and cancels the uploads still running.
+3. With UNCHANGED_MEMBERS=skip a replayed archive only uploads the members whose objects differ, and objects
+   without the zip CRC-32 are compared by their CRC32C.
+4. Notifications of objects that are not .zip archives are acknowledged without unpacking them.
+5. The asyncio runtime reads the notified archive generation, and a generation that no longer exists acknowledges
+   the message instead of failing it forever.
+6. unpackArchive retries a failed member upload but not a cancelled job, and its first failed member cancels the
+   uploads still queued.
+7. A manifest too big for the message is written into the prefix, under a name no unpacked member takes.
+"""
+
+import asyncio
+import base64
+import io
+import json
+import os
+import sys
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import AsyncMock, Mock, patch
+from zipfile import ZipFile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "tasks", "bulk-processing"))
+os.environ.setdefault("PROJECT_ID", "test-project")
+
+try:
+    import unpack
+    import worker_common
+except ImportError:
+    unpack = None
+
+
+class FakeStream:
+    def __init__(self, data):
+        self.file = io.BytesIO(data)
+
+    async def read(self, size=-1):
+        return self.file.read(size)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+
+class NotFound(Exception):
+    status = 404
+
+
+class FakeAioStorage:
+    """Stands in for gcloud.aio.storage.Storage, fail_upload names a member that fails.
+
+    The archive is generation 12, it was overwritten by generation 13 since.
+    """
+
+    def __init__(self, archive, fail_upload=None):
+        self.generations = {"12": archive, "13": b"overwritten"}
+        self.fail_upload = fail_upload
+        self.uploads = {}
+        self.objects = {}
+        self.cancelled = 0
+        self.list_requests = 0
+
+    async def _download(self, bucket, object_name, params=None):
+        assert params["alt"] == "json"
+        generation = params.get("generation", "13")
+        if generation not in self.generations:
+            raise NotFound(f"{object_name}#{generation}")
+        data = self.generations[generation]
+        return json.dumps({"name": object_name, "size": str(len(data)), "generation": generation}).encode()
+
+    async def _download_stream(self, bucket, object_name, params=None):
+        return FakeStream(self.generations[params["generation"]])
+
+    async def list_objects(self, bucket, params=None):
+        """Serves two objects per page, so paging is exercised."""
+        self.list_requests += 1
+        names = sorted(name for name in self.objects if name.startswith(params.get("prefix", "")))
+        start = int(params.get("pageToken", 0))
+        page = {"items": [self.objects[name] for name in names[start:start + 2]]}
+        if start + 2 < len(names):
+            page["nextPageToken"] = str(start + 2)
+        return page
+
+    async def upload(self, bucket, object_name, data, content_type=None, metadata=None):
+        if object_name == self.fail_upload:
+            raise RuntimeError("upload failed")
+        try:
+            # Every upload waits a little, so the failing one happens while others are in flight
+            await asyncio.sleep(0.01)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        self.uploads[object_name] = data
+        # Overwriting an object creates its next generation
+        generation = int(self.objects.get(object_name, {}).get("generation", 0)) + 1
+        self.objects[object_name] = {
+            "name": object_name, "size": str(len(data)), "generation": str(generation),
+            "metadata": (metadata or {}).get("metadata", {}),
+        }
+        return self.objects[object_name]
+
+
+@unittest.skipIf(unpack is None, "worker dependencies are not installed")
+class TestAsyncioRuntime(unittest.TestCase):
+    """Test cases for unpackArchiveAsync."""
+
+    def setUp(self):
+        """Build an archive with three top level members and a nested one."""
+        buffer = io.BytesIO()
+        with ZipFile(buffer, "w") as archive:
+            for i in range(3):
+                archive.writestr(f"sensor{i}.json", json.dumps({"id": i}))
+            archive.writestr("nested/sensor9.json", json.dumps({"id": 9}))
+        self.archive = buffer.getvalue()
+
+    def threadedUnpack(self, upload, job=None):
+        """Run unpackArchive on mock clients, upload(name, file) makes each member upload, return the publisher.
+
+        The destination blobs are kept in self.blobs by name.
+        """
+        self.blobs = {}
+
+        def memberBlob(name):
+            blob = self.blobs[name] = Mock()
+            blob.name = name
+
+            def uploadFromFile(file, size=None, content_type=None):
+                self.assertIn("zip-crc32", blob.metadata)
+                upload(name, file)
+                blob.size, blob.generation = size, 1
+            blob.upload_from_file.side_effect = uploadFromFile
+            return blob
+
+        archive_blob = Mock(size=len(self.archive), generation=12)
+        archive_blob.download_to_file.side_effect = lambda file: file.write(self.archive)
+        storage_client = Mock()
+        buckets = {"ingest": Mock(blob=Mock(return_value=archive_blob))}
+        storage_client.bucket.side_effect = lambda name: buckets.get(name) or Mock(blob=memberBlob)
+        publisher_client = Mock()
+        with patch.object(unpack.stage, "getStorageClient", return_value=storage_client), \
+                patch.object(unpack.stage, "getPublisherClient", return_value=publisher_client):
+            unpack.unpackArchive("ingest", "1700000000.1.zip", "unpack", "1700000000.1", job=job, generation="12")
+        # The notification's generation is read, not the archive's current one
+        buckets["ingest"].blob.assert_called_once_with("1700000000.1.zip", generation="12")
+        return publisher_client
+
+    def threadedMessage(self):
+        """Run unpackArchive on mock clients and return the published data and the uploaded members."""
+        uploads = {}
+        publisher_client = self.threadedUnpack(lambda name, file: uploads.update({name: file.read()}))
+        return publisher_client.publish.call_args, uploads
+
+    def test_same_message_as_threads(self):
+        """Test that the asyncio runtime uploads the same members and publishes the same message."""
+        storage = FakeAioStorage(self.archive)
+        publisher_client = Mock()
+        with patch.object(unpack.stage, "getAioStorageClient", AsyncMock(return_value=storage)), \
+                patch.object(unpack.stage, "getPublisherClient", return_value=publisher_client):
+            job = unpack.Job(None)
+            asyncio.run(unpack.unpackArchiveAsync(
+                "ingest", "1700000000.1.zip", "unpack", "1700000000.1", job=job, generation="12"
+            ))
+
+        self.assertEqual(job.size, len(self.archive))
+        threaded_call, threaded_uploads = self.threadedMessage()
+        self.assertEqual(storage.uploads, threaded_uploads)
+        self.assertEqual(sorted(storage.uploads), [f"1700000000.1/sensor{i}.json" for i in range(3)])
+        self.assertEqual(json.loads(publisher_client.publish.call_args[0][1]), json.loads(threaded_call[0][1]))
+        self.assertEqual(publisher_client.publish.call_args[1], {"generation": "12"})
+
+    def test_failed_upload_cancels_the_others(self):
+        """Test that the first failed member fails the archive and the running uploads are cancelled."""
+        storage = FakeAioStorage(self.archive, fail_upload="1700000000.2/sensor1.json")
+        publisher_client = Mock()
+        with patch.object(unpack.stage, "getAioStorageClient", AsyncMock(return_value=storage)), \
+                patch.object(unpack.stage, "getPublisherClient", return_value=publisher_client), \
+                patch.object(unpack, "upload_retries", 0):
+            with self.assertRaises(RuntimeError):
+                asyncio.run(unpack.unpackArchiveAsync("ingest", "1700000000.2.zip", "unpack", "1700000000.2", generation="12"))
+
+        publisher_client.publish.assert_not_called()
+        self.assertEqual(storage.cancelled, 2)
+
+    def test_replay_skips_unchanged_members(self):
+        """Test that a replay uploads only the changed member, and that CRC32C matches objects without a CRC-32."""
+        storage = FakeAioStorage(self.archive)
+        with patch.object(unpack.stage, "getAioStorageClient", AsyncMock(return_value=storage)), \
+                patch.object(unpack.stage, "getPublisherClient", return_value=Mock()), \
+                patch.object(unpack, "unchanged_members", "skip"):
+            asyncio.run(unpack.unpackArchiveAsync("ingest", "1700000000.3.zip", "unpack", "1700000000.3", generation="12"))
+            self.assertEqual(len(storage.uploads), 3)
+            # sensor0 was written by someone else and only has its CRC32C, sensor1 has changed
+            sensor0 = storage.objects["1700000000.3/sensor0.json"]
+            sensor0["metadata"] = {}
+            with ZipFile(io.BytesIO(self.archive)) as archive:
+                data = archive.read("sensor0.json")
+            import google_crc32c
+            sensor0["crc32c"] = base64.b64encode(google_crc32c.Checksum(data).digest()).decode("ascii")
+            storage.objects["1700000000.3/sensor1.json"]["metadata"]["zip-crc32"] = "00000000"
+            storage.uploads.clear()
+            storage.list_requests = 0
+
+            publisher_client = Mock()
+            with patch.object(unpack.stage, "getPublisherClient", return_value=publisher_client):
+                asyncio.run(unpack.unpackArchiveAsync("ingest", "1700000000.3.zip", "unpack", "1700000000.3", generation="12"))
+
+        self.assertEqual(list(storage.uploads), ["1700000000.3/sensor1.json"])
+        self.assertEqual(storage.list_requests, 2)
+        objects = json.loads(publisher_client.publish.call_args[0][1])["objects"]
+        self.assertEqual({item["name"]: item["generation"] for item in objects}, {
+            name: int(storage.objects[name]["generation"]) for name in storage.objects
+        })
+
+    def test_threaded_retry(self):
+        """Test that a failed member upload is retried after a backoff and the archive still succeeds."""
+        attempts = {}
+
+        def upload(name, file):
+            attempts[name] = attempts.get(name, 0) + 1
+            if name.endswith("sensor1.json") and attempts[name] == 1:
+                raise ConnectionError("connection reset")
+            file.read()
+
+        with patch.object(unpack.time, "sleep") as sleep:
+            publisher_client = self.threadedUnpack(upload)
+        sleep.assert_called_once_with(0.5)
+        self.assertEqual(attempts, {"1700000000.1/sensor0.json": 1, "1700000000.1/sensor1.json": 2,
+                                    "1700000000.1/sensor2.json": 1})
+        objects = json.loads(publisher_client.publish.call_args[0][1])["objects"]
+        self.assertEqual(sorted(item["name"] for item in objects), sorted(attempts))
+
+    def test_threaded_cancelled_job_is_not_retried(self):
+        """Test that a job cancelled during an upload stops instead of retrying the upload."""
+        job = worker_common.Job(None)
+
+        def upload(name, file):
+            # The lease watchdog cancels the job while the member is uploaded
+            job.cancel_reason = "no progress for 600s"
+
+        with patch.object(unpack.time, "sleep") as sleep:
+            with self.assertRaises(worker_common.JobCancelled):
+                self.threadedUnpack(upload, job=job)
+        sleep.assert_not_called()
+
+    def test_threaded_failure_cancels_queued_uploads(self):
+        """Test that the first failed member fails the archive, queued uploads never start and running ones finish."""
+        buffer = io.BytesIO()
+        with ZipFile(buffer, "w") as archive:
+            for i in range(10):
+                archive.writestr(f"sensor{i}.json", json.dumps({"id": i}))
+        self.archive = buffer.getvalue()
+        started, finished = [], []
+
+        def upload(name, file):
+            started.append(name)
+            if name.endswith("sensor0.json"):
+                raise RuntimeError("upload failed")
+            time.sleep(0.05)
+            finished.append(name)
+
+        with patch.object(unpack, "upload_executor", ThreadPoolExecutor(max_workers=2)) as executor, \
+                patch.object(unpack, "upload_retries", 0):
+            with self.assertRaises(RuntimeError):
+                self.threadedUnpack(upload)
+            # The uploads running at the failure were waited for, the archive buffer is not closed under them
+            self.assertEqual(sorted(finished), sorted(name for name in started if not name.endswith("sensor0.json")))
+            executor.shutdown()
+        self.assertLessEqual(len(started), 4)
+
+    def test_manifest_name_is_reserved(self):
+        """Test that a big manifest is written into the prefix and a member with its name is not unpacked."""
+        buffer = io.BytesIO()
+        with ZipFile(buffer, "w") as archive:
+            archive.writestr("sensor0.json", json.dumps({"id": 0}))
+            archive.writestr(worker_common.MANIFEST_NAME, json.dumps({"objects": []}))
+        self.archive = buffer.getvalue()
+        uploads = {}
+        with patch.object(unpack, "manifest_inline_max_bytes", 0):
+            publisher_client = self.threadedUnpack(lambda name, file: uploads.update({name: file.read()}))
+
+        manifest_name = f"1700000000.1/{worker_common.MANIFEST_NAME}"
+        self.assertEqual(list(uploads), ["1700000000.1/sensor0.json"])
+        self.assertEqual(json.loads(publisher_client.publish.call_args[0][1])["manifest"], manifest_name)
+        manifest = json.loads(self.blobs[manifest_name].upload_from_string.call_args[0][0])
+        self.assertEqual([item["name"] for item in manifest["objects"]], ["1700000000.1/sensor0.json"])
+
+    def test_gone_generation_is_acked(self):
+        """Test that a notified generation that no longer exists acks the message instead of nacking it."""
+        storage = FakeAioStorage(self.archive)
+        message = Mock(data=b"{}")
+        job = unpack.stage.startJob(message, ())
+        with patch.object(unpack.stage, "getAioStorageClient", AsyncMock(return_value=storage)), \
+                patch.object(unpack.stage, "getPublisherClient", return_value=Mock()):
+            with self.assertRaises(unpack.ArchiveGone) as raised:
+                asyncio.run(unpack.unpackArchiveAsync(
+                    "ingest", "1700000000.4.zip", "unpack", "1700000000.4", job=job, generation="11"
+                ))
+        unpack.stage.failJob(job, raised.exception)
+
+        message.ack.assert_called_once()
+        message.nack.assert_not_called()
+        self.assertEqual(storage.uploads, {})
+
+
+@unittest.skipIf(unpack is None, "worker dependencies are not installed")
+class TestNotifications(unittest.TestCase):
+    """Test cases for claimMessage."""
+
+    def test_non_archive_is_acked(self):
+        """Test that other objects in the ingest bucket are acknowledged instead of redelivered forever."""
+        for object_name in ("bundles/unpack-1.tar.gz", "unpack-bundle"):
+            with self.subTest(object_name=object_name):
+                message = Mock(attributes={
+                    "eventType": "OBJECT_FINALIZE", "bucketId": "ingest", "objectId": object_name,
+                    "objectGeneration": "1",
+                })
+                self.assertIsNone(unpack.claimMessage(message))
+                message.ack.assert_called_once()
+                message.nack.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -19,6 +19,10 @@ export DB_PASSWORD="$(base64 /dev/urandom | head -c 32)"  # Change to secure pas
 # Cloud Function Configuration
 export FUNCTION_NAME="api-handler"
 export FUNCTION_ENTRY_POINT="handler"
+# Requests one instance serves at once, every instance keeps one database connection per request
+export FUNCTION_CONCURRENCY="8"
+# Instances x concurrency stays below the max_connections of the db-f1-micro tier (250)
+export FUNCTION_MAX_INSTANCES="20"
 
 # Cloud Storage Configuration
 export BUCKET_NAME="${PROJECT_ID}-static-content"
@@ -119,6 +123,8 @@ echo ''
 echo 'Cloud Function Configuration'
 echo "FUNCTION_NAME: ${FUNCTION_NAME}"
 echo "FUNCTION_ENTRY_POINT: ${FUNCTION_ENTRY_POINT}"
+echo "FUNCTION_CONCURRENCY: ${FUNCTION_CONCURRENCY}"
+echo "FUNCTION_MAX_INSTANCES: ${FUNCTION_MAX_INSTANCES}"
 echo ''
 echo 'Cloud Storage Configuration'
 echo "BUCKET_NAME: ${BUCKET_NAME}"
@@ -174,6 +180,8 @@ DB_PASSWORD="${DB_PASSWORD}"
 # Cloud Function Configuration
 FUNCTION_NAME="${FUNCTION_NAME}"
 FUNCTION_ENTRY_POINT="${FUNCTION_ENTRY_POINT}"
+FUNCTION_CONCURRENCY="${FUNCTION_CONCURRENCY}"
+FUNCTION_MAX_INSTANCES="${FUNCTION_MAX_INSTANCES}"
 
 # Cloud Storage Configuration
 BUCKET_NAME="${BUCKET_NAME}"
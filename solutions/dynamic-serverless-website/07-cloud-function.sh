@@ -4,6 +4,7 @@
 SECRET_VALUE=$(gcloud secrets versions access latest --secret=$SECRET_NAME)
 
 # Deploy Cloud Function (Gen 2)
+# Concurrency above 1 needs a whole CPU, the connection pool gets one connection per concurrent request
 gcloud functions deploy $FUNCTION_NAME \
     --gen2 \
     --runtime=python311 \
@@ -14,6 +15,11 @@ gcloud functions deploy $FUNCTION_NAME \
     --allow-unauthenticated \
     --vpc-connector=$CONNECTOR_NAME \
     --egress-settings=private-ranges-only \
+    --memory=512Mi \
+    --cpu=1 \
+    --concurrency=$FUNCTION_CONCURRENCY \
+    --max-instances=$FUNCTION_MAX_INSTANCES \
+    --set-env-vars=DB_POOL_SIZE=$FUNCTION_CONCURRENCY \
     --set-secrets=DB_CREDS=$SECRET_NAME:latest
 
 # Get the function URL
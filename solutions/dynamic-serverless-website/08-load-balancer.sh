@@ -16,9 +16,12 @@ gcloud compute network-endpoint-groups create $NEG_NAME \
     --cloud-function-name=$FUNCTION_NAME
 
 # Create backend service for Cloud Function
+# Cloud CDN caches /api/ responses for as long as the function's Cache-Control header allows
 gcloud compute backend-services create $BACKEND_SERVICE_FUNCTION \
     --global \
-    --load-balancing-scheme=EXTERNAL_MANAGED
+    --load-balancing-scheme=EXTERNAL_MANAGED \
+    --enable-cdn \
+    --cache-mode=USE_ORIGIN_HEADERS
 
 # Add the NEG to the backend service
 gcloud compute backend-services add-backend $BACKEND_SERVICE_FUNCTION \
@@ -23,6 +23,25 @@ gcloud compute backend-services update $BACKEND_SERVICE_FUNCTION \
     --security-policy=$SECURITY_POLICY \
     --global
 
+# Cache hits are served before the backend policy is evaluated, an edge policy also filters them
+gcloud compute security-policies create $SECURITY_POLICY-edge \
+    --type=CLOUD_ARMOR_EDGE \
+    --description="IP whitelist policy for cached API responses"
+
+gcloud compute security-policies rules create 1000 \
+    --security-policy=$SECURITY_POLICY-edge \
+    --src-ip-ranges=$EXTERNAL_IP \
+    --action=allow \
+    --description="Allow traffic from known IP"
+
+gcloud compute security-policies rules update 2147483647 \
+    --security-policy=$SECURITY_POLICY-edge \
+    --action=deny-403
+
+gcloud compute backend-services update $BACKEND_SERVICE_FUNCTION \
+    --edge-security-policy=$SECURITY_POLICY-edge \
+    --global
+
 # Note: Backend buckets don't support Cloud Armor directly
 # You would need to put the bucket behind a backend service with a NEG if needed
 
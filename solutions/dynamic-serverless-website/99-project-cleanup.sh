@@ -10,6 +10,8 @@ gcloud compute forwarding-rules delete $FORWARDING_RULE_NAME --global
 gcloud compute target-http-proxies delete $TARGET_HTTP_PROXY_NAME
 gcloud compute url-maps delete $URL_MAP_NAME
 gcloud compute backend-services delete $BACKEND_SERVICE_FUNCTION --global
+# The edge policy can only be deleted once no backend service uses it
+gcloud compute security-policies delete $SECURITY_POLICY-edge
 gcloud compute backend-buckets delete $BACKEND_BUCKET_NAME
 gcloud compute network-endpoint-groups delete $NEG_NAME --region=$REGION
 gcloud compute addresses delete $IP_NAME --global
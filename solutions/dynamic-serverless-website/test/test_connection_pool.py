@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""Unit tests for the database connection pool of the website function.
+
+Tests validate that:
+1. A pooled connection whose ping fails is closed and its slot is freed for the next request.
+"""
+
+import json
+import os
+import sys
+import unittest
+from unittest.mock import Mock, patch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "tasks", "dynamic-serverless-website"))
+os.environ.setdefault("DB_CREDS", json.dumps({"host": "127.0.0.1", "username": "test", "password": "test"}))
+
+try:
+    import main
+    import mysql.connector
+except ImportError:
+    main = None
+
+
+@unittest.skipIf(main is None, "function dependencies are not installed")
+class TestConnectionPool(unittest.TestCase):
+    """Test cases for ConnectionPool.acquire."""
+
+    def test_failed_ping_closes_connection(self):
+        """Test that a connection that cannot be reconnected is closed and does not keep its slot."""
+        pool = main.ConnectionPool(1, 0.1)
+        stale = Mock()
+        stale.ping.side_effect = mysql.connector.InterfaceError("Lost connection to MySQL server")
+        stale.close.side_effect = mysql.connector.OperationalError("already closed")
+        pool.idle.put(stale)
+        self.assertRaises(mysql.connector.InterfaceError, pool.acquire)
+        stale.close.assert_called_once()
+
+        fresh = Mock()
+        with patch.object(main.mysql.connector, "connect", return_value=fresh):
+            self.assertIs(pool.acquire(), fresh)
+
+
+if __name__ == '__main__':
+    unittest.main()
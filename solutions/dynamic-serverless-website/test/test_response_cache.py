@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""Unit tests for the response cache of the website function.
+
+Tests validate that:
+1. Responses are cached by the CDN only for the time the instance still keeps the database time, rounded up.
+2. Concurrent misses wait for a single database query.
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+import unittest
+from unittest.mock import Mock, patch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "tasks", "dynamic-serverless-website"))
+os.environ.setdefault("DB_CREDS", json.dumps({"host": "127.0.0.1", "username": "test", "password": "test"}))
+
+try:
+    import main
+except ImportError:
+    main = None
+
+
+@unittest.skipIf(main is None, "function dependencies are not installed")
+class TestResponseCache(unittest.TestCase):
+    """Test cases for the Cache-Control header of handler."""
+
+    def test_max_age_is_remaining_lifetime(self):
+        """Test that a fresh result is sent with the full max-age and a cached one with the seconds it has left."""
+        cache = main.ResponseCache(60)
+        query = Mock(return_value=("2026-10-18 12:00:00", '"etag"'))
+        with patch.object(main, "response_cache", cache), patch.object(main, "queryDbTime", query):
+            _, _, headers = main.handler(None)
+            self.assertEqual(headers["Cache-Control"], "public, max-age=60")
+            # The result was loaded 45.5 seconds ago
+            cache.entries["db_time"] = (query.return_value, time.monotonic() + 14.5)
+            body, status, headers = main.handler(None)
+        self.assertEqual((body, status), ("2026-10-18 12:00:00", 200))
+        self.assertEqual(headers["Cache-Control"], "public, max-age=15")
+        query.assert_called_once()
+
+    def test_max_age_with_default_ttl(self):
+        """Test that a hit in the middle of the default one second lifetime is still cacheable downstream."""
+        cache = main.ResponseCache(1)
+        query = Mock(return_value=("2026-10-18 12:00:00", '"etag"'))
+        with patch.object(main, "response_cache", cache), patch.object(main, "queryDbTime", query):
+            _, _, headers = main.handler(None)
+            self.assertEqual(headers["Cache-Control"], "public, max-age=1")
+            cache.entries["db_time"] = (query.return_value, time.monotonic() + 0.4)
+            _, _, headers = main.handler(None)
+        self.assertEqual(headers["Cache-Control"], "public, max-age=1")
+        query.assert_called_once()
+
+    def test_concurrent_misses_query_once(self):
+        """Test that concurrent requests on an empty cache make exactly one database query."""
+        requests = 8
+        cache = main.ResponseCache(60)
+
+        def queryDbTime():
+            # The query is slow enough for every other request to miss and wait for it
+            deadline = time.monotonic() + 5
+            while cache.coalesced < requests - 1 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            return "2026-10-18 12:00:00", '"etag"'
+
+        query = Mock(side_effect=queryDbTime)
+        responses = []
+        with patch.object(main, "response_cache", cache), patch.object(main, "queryDbTime", query):
+            threads = [threading.Thread(target=lambda: responses.append(main.handler(None))) for _ in range(requests)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        query.assert_called_once()
+        self.assertEqual([(body, status) for body, status, _ in responses], [("2026-10-18 12:00:00", 200)] * requests)
+        self.assertEqual(cache.stats(), {"hits": 0, "misses": requests, "coalesced": requests - 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
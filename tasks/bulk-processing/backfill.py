@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+"""Reprocess archives or unpacked prefixes of a bucket with the workers' own functions, without Pub/Sub.
+
+unpack: the archives of the source (ingest) bucket are unpacked to the unpack bucket with unpackArchive.
+transform: the unpacked prefixes of the source (unpack) bucket are transformed with transformData.
+both: every archive is unpacked and its prefix transformed right away, from the objects unpackArchive wrote.
+
+Archives and prefixes are processed by a pool of --processes processes, started at most --rate per second.
+Nothing is published unless --publish is given, so the worker subscriptions see none of the backfill. With
+--checkpoint every finished archive or prefix is appended to that file, and a run with the same file skips
+them. Progress, throughput and the estimated time to finish are printed every --progress-seconds.
+"""
+import argparse
+import importlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import nullcontext
+from datetime import datetime, timezone
+from pathlib import Path
+
+STAGES = ("unpack", "transform", "both")
+# worker_common.MANIFEST_NAME, the main process imports no worker module
+MANIFEST_NAME = ".manifest.json"
+LIST_FIELDS = "items(name,size,timeCreated),nextPageToken"
+
+# The worker modules of a backfill process, imported by initProcess
+workers = {}
+
+
+def parseTime(value):
+    """ISO 8601 date or time, in UTC unless it has an offset."""
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment
+
+
+def inRange(created, start, end):
+    return (start is None or created >= start) and (end is None or created < end)
+
+
+def listArchives(storage_client, bucket_name, prefix, start, end):
+    """Return (name, size) of the archives under prefix created in [start, end), oldest first."""
+    archives = [
+        (blob.time_created, blob.name, blob.size)
+        for blob in storage_client.list_blobs(bucket_name, prefix=prefix or None, fields=LIST_FIELDS)
+        if blob.name.endswith(".zip") and inRange(blob.time_created, start, end)
+    ]
+    return [(name, size) for _, name, size in sorted(archives)]
+
+
+def listPrefixes(storage_client, bucket_name, prefix, start, end):
+    """Return (path, bytes) of the unpacked prefixes whose oldest object was created in [start, end), oldest first.
+
+    Prefixes have no size or creation time of their own, so every unpacked object is listed (1000 per request).
+    """
+    prefixes = {}
+    for blob in storage_client.list_blobs(bucket_name, prefix=prefix or None, fields=LIST_FIELDS):
+        path, _, member = blob.name.partition("/")
+        # Only the top level members unpack.py writes, not the manifest it writes next to them
+        if not member or "/" in member or member == MANIFEST_NAME:
+            continue
+        created, size = prefixes.get(path, (blob.time_created, 0))
+        prefixes[path] = (min(created, blob.time_created), size + blob.size)
+    ordered = sorted(prefixes.items(), key=lambda item: item[1][0])
+    return [(path, size) for path, (created, size) in ordered if inRange(created, start, end)]
+
+
+def loadCheckpoint(path):
+    """Return the (stage, name) of the archives and prefixes finished by earlier runs with this checkpoint."""
+    done = set()
+    if path and os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The last line of an interrupted run may be cut short, its item is processed again
+                    continue
+                done.add((record["stage"], record["name"]))
+    return done
+
+
+def initProcess(stage, unpack_env, transform_env):
+    """Import the workers a backfill process needs, each with the settings of its stage."""
+    if stage in ("unpack", "both"):
+        os.environ.update(unpack_env)
+        workers["unpack"] = importlib.import_module("unpack")
+    if stage in ("transform", "both"):
+        os.environ.update(transform_env)
+        workers["transform"] = importlib.import_module("transform")
+
+
+def runItem(stage, source_bucket, name, publish):
+    """Process one archive (unpack, both) or unpacked prefix (transform), return the seconds it took."""
+    start = time.perf_counter()
+    if stage == "transform":
+        transform = workers["transform"]
+        transform.transformData(source_bucket, name, transform.destination_bucket, name, publish=publish).result()
+        return time.perf_counter() - start
+    unpack = workers["unpack"]
+    # The same prefix the unpack worker uses for a notification of this archive
+    prefix = Path(name).stem
+    future = unpack.unpackArchive(
+        source_bucket, name, unpack.destination_bucket, prefix, publish=publish and stage == "unpack"
+    )
+    data = future.result()
+    if stage == "both":
+        # The unpack message, with the objects or the manifest, is transformed as the transform worker would
+        transform = workers["transform"]
+        transform.transformPrefixes([json.loads(data)], transform.destination_bucket, prefix, publish=publish).result()
+    return time.perf_counter() - start
+
+
+class Progress:
+    """Archives or prefixes and bytes done, reported with the rate so far and the time left at that rate."""
+
+    def __init__(self, items, total_bytes, interval):
+        self.items = items
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.done = 0
+        self.failed = 0
+        self.done_bytes = 0
+        self.start = self.reported = time.monotonic()
+
+    def add(self, size, failed=False):
+        if failed:
+            self.failed += 1
+        else:
+            self.done += 1
+            self.done_bytes += size
+
+    def report(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.reported < self.interval:
+            return
+        self.reported = now
+        elapsed = max(now - self.start, 1e-9)
+        left = self.items - self.done - self.failed
+        if self.done_bytes:
+            eta = (self.total_bytes - self.done_bytes) / (self.done_bytes / elapsed)
+        elif self.done:
+            eta = left / (self.done / elapsed)
+        else:
+            eta = None
+        print(f"PROGRESS: {self.done}/{self.items} done, {self.failed} failed, "
+              f"{self.done_bytes / 1e9:.2f}/{self.total_bytes / 1e9:.2f} GB, "
+              f"{self.done / elapsed:.2f}/s, {self.done_bytes / 1e6 / elapsed:.1f} MB/s, "
+              f"ETA {'unknown' if eta is None else f'{eta / 60:.1f} min'}", flush=True)
+
+
+def processItems(executor, items, stage, bucket_name, publish, processes, rate, progress, checkpoint_file):
+    """Run the items on the executor, append the finished ones to checkpoint_file and return the failed ones.
+
+    On KeyboardInterrupt the queued items are cancelled and the running ones are not waited for, the items
+    finished by then are checkpointed before the interrupt propagates.
+    """
+    failed = []
+    pending = {}
+
+    def collect(futures):
+        for future in futures:
+            name, size = pending.pop(future)
+            try:
+                seconds = future.result()
+            except Exception as e:
+                print(f"FAILED: {name}: {e}")
+                failed.append(name)
+                progress.add(size, failed=True)
+                continue
+            if checkpoint_file is not None:
+                record = {"stage": stage, "name": name, "size": size, "seconds": round(seconds, 3)}
+                checkpoint_file.write(json.dumps(record) + "\n")
+                checkpoint_file.flush()
+            progress.add(size)
+
+    next_start = time.monotonic()
+    try:
+        for name, size in items:
+            # A bounded number of items is queued, so the rate limit applies to the starts
+            while len(pending) >= 2 * processes:
+                collect(wait(pending, timeout=progress.interval, return_when=FIRST_COMPLETED).done)
+                progress.report()
+            if rate:
+                time.sleep(max(0.0, next_start - time.monotonic()))
+                next_start = max(next_start, time.monotonic() - 1) + 1 / rate
+            pending[executor.submit(runItem, stage, bucket_name, name, publish)] = (name, size)
+            progress.report()
+        while pending:
+            collect(wait(pending, timeout=progress.interval, return_when=FIRST_COMPLETED).done)
+            progress.report()
+    except KeyboardInterrupt:
+        executor.shutdown(wait=False, cancel_futures=True)
+        # Interrupted processes fail their items with the KeyboardInterrupt, only the finished ones are collected
+        collect([
+            future for future in list(pending)
+            if future.done() and not future.cancelled() and future.exception() is None
+        ])
+        raise
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("source", help="gs://bucket[/prefix], the ingest bucket for unpack and both, "
+                                       "the unpack bucket for transform")
+    parser.add_argument("--stage", choices=STAGES, default="both", help="stages to run (default: both)")
+    parser.add_argument("--start", type=parseTime, help="only objects created at or after this ISO 8601 time (UTC)")
+    parser.add_argument("--end", type=parseTime, help="only objects created before this ISO 8601 time (UTC)")
+    parser.add_argument("--unpack-bucket", help="destination of unpack (default: UNPACK_BUCKET or <project>-unpack)")
+    parser.add_argument("--transform-bucket",
+                        help="destination of transform (default: TRANSFORM_BUCKET or <project>-transform)")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="backfill processes (default: CPUs)")
+    parser.add_argument("--rate", type=float, default=0, help="archives or prefixes started per second (0: no limit)")
+    parser.add_argument("--checkpoint", help="file of finished archives or prefixes, skipped when the run is resumed")
+    parser.add_argument("--progress-seconds", type=float, default=10, help="time between progress reports")
+    parser.add_argument("--publish", action="store_true",
+                        help="publish the messages of the last stage run, like the workers (default: no messages)")
+    parser.add_argument("--dry-run", action="store_true", help="only list what would be processed")
+    args = parser.parse_args()
+
+    project_id = os.environ.get("PROJECT_ID")
+    if not project_id:
+        print("PROJECT_ID environment variable is not set")
+        sys.exit(1)
+    location = args.source[len("gs://"):] if args.source.startswith("gs://") else args.source
+    bucket_name, _, prefix = location.partition("/")
+    if not bucket_name:
+        print("Bucket name is empty")
+        sys.exit(1)
+    unpack_bucket = args.unpack_bucket or os.environ.get("UNPACK_BUCKET") or f"{project_id}-unpack"
+    transform_bucket = args.transform_bucket or os.environ.get("TRANSFORM_BUCKET") or f"{project_id}-transform"
+
+    from google.cloud import storage
+
+    storage_client = storage.Client()
+    if args.stage == "transform":
+        found = listPrefixes(storage_client, bucket_name, prefix, args.start, args.end)
+        kind = "prefixes"
+    else:
+        found = listArchives(storage_client, bucket_name, prefix, args.start, args.end)
+        kind = "archives"
+    done = loadCheckpoint(args.checkpoint)
+    items = [(name, size) for name, size in found if (args.stage, name) not in done]
+    total_bytes = sum(size for _, size in items)
+    print(f"{len(items)} {kind} in gs://{bucket_name}/{prefix} to {args.stage}, {total_bytes / 1e9:.2f} GB"
+          f" ({len(found) - len(items)} done by an earlier run)")
+    if args.dry_run or not items:
+        return
+
+    # The workers read their settings at import, each gets its own destination bucket and topic. Dedup
+    # markers and metrics belong to the subscriber loop, which the backfill does not run
+    common_env = {"PROJECT_ID": project_id, "RUNTIME": "threads"}
+    unpack_env = dict(common_env, BUCKET=unpack_bucket, TOPIC=os.environ.get("UNPACK_TOPIC", "data-unpack"))
+    transform_env = dict(
+        common_env, BUCKET=transform_bucket, TOPIC=os.environ.get("TRANSFORM_TOPIC", "data-transform"), INPUT="unpacked"
+    )
+    progress = Progress(len(items), total_bytes, args.progress_seconds)
+    # Processes are spawned rather than forked, the client libraries' threads do not survive a fork
+    executor = ProcessPoolExecutor(
+        max_workers=args.processes, mp_context=multiprocessing.get_context("spawn"),
+        initializer=initProcess, initargs=(args.stage, unpack_env, transform_env),
+    )
+    try:
+        with open(args.checkpoint, "a") if args.checkpoint else nullcontext() as checkpoint_file:
+            failed = processItems(
+                executor, items, args.stage, bucket_name, args.publish, args.processes, args.rate, progress,
+                checkpoint_file,
+            )
+    except KeyboardInterrupt:
+        progress.report(force=True)
+        print("Interrupted" + (f", run again with --checkpoint {args.checkpoint} to resume" if args.checkpoint else ""))
+        sys.exit(130)
+    executor.shutdown()
+    progress.report(force=True)
+    if failed:
+        print(f"{len(failed)} {kind} failed" + (", run again with the same --checkpoint to retry them"
+                                                if args.checkpoint else ""))
+        sys.exit(1)
+    elapsed = time.monotonic() - progress.start
+    print(f"DONE: {len(items)} {kind} in {elapsed:.1f}s ({len(items) / elapsed:.1f} {kind}/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""Messages/sec of both workers with shared clients vs a new client per message.
+
+The "per-message" mode recreates storage.Client and PublisherClient for every
+call, the way the workers used to; "shared" uses the process-wide clients.
+Calls are made from a pool of threads, like the subscriber's callback executor.
+"""
+import argparse
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import emulators
+
+
+def throughput(calls, concurrency):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(call) for call in calls]:
+            future.result()
+    return len(calls) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=50, help="messages per worker and mode")
+    parser.add_argument("--sensors", type=int, default=20, help="members per archive")
+    parser.add_argument("--concurrency", type=int, default=10, help="concurrent callbacks")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    from google.cloud import storage
+    from google.cloud.pubsub import PublisherClient
+
+    emulators.checkEmulators()
+    unpack = emulators.importWorker("unpack", TOPIC="bench-unpack")
+    transform = emulators.importWorker("transform", TOPIC="bench-transform")
+    emulators.createTopic("bench-unpack")
+    emulators.createTopic("bench-transform")
+    src_bucket = emulators.createBucket("bench-ingest")
+    unpack_bucket = emulators.createBucket("bench-unpack")
+    transform_bucket = emulators.createBucket("bench-transform")
+    src_bucket.blob("bench.zip").upload_from_string(emulators.makeArchive(args.sensors), content_type="application/zip")
+
+    shared = {}
+    for worker in (unpack, transform):
+        shared[worker] = (worker.stage.getStorageClient, worker.stage.getPublisherClient)
+
+    results = []
+    for mode in ("per-message", "shared"):
+        for worker in (unpack, transform):
+            if mode == "per-message":
+                worker.stage.getStorageClient = storage.Client
+                worker.stage.getPublisherClient = PublisherClient
+            else:
+                worker.stage.getStorageClient, worker.stage.getPublisherClient = shared[worker]
+        unpack_calls = [
+            lambda i=i: unpack.unpackArchive(src_bucket.name, "bench.zip", unpack_bucket.name, f"{mode}/{i}").result()
+            for i in range(args.messages)
+        ]
+        transform_calls = [
+            lambda i=i: transform.transformData(unpack_bucket.name, f"{mode}/{i}", transform_bucket.name, f"{mode}/{i}").result()
+            for i in range(args.messages)
+        ]
+        results.append({
+            "mode": mode,
+            "unpack_msgs_per_sec": round(throughput(unpack_calls, args.concurrency), 2),
+            "transform_msgs_per_sec": round(throughput(transform_calls, args.concurrency), 2),
+        })
+
+    print(f"{'mode':<14}{'unpack msg/s':>14}{'transform msg/s':>18}")
+    for result in results:
+        print(f"{result['mode']:<14}{result['unpack_msgs_per_sec']:>14}{result['transform_msgs_per_sec']:>18}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"concurrency": args.concurrency, "sensors": args.sensors, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""Unpack worker throughput and memory for different flow control settings.
+
+Every setting runs in its own process: a real streaming pull subscriber with
+the given CALLBACK_WORKERS and FLOW_MAX_MESSAGES drains a backlog of
+OBJECT_FINALIZE messages from the Pub/Sub emulator. The backlog is published
+before the subscriber starts, so all archives "arrive together".
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import emulators
+
+
+def runSetting(args):
+    unpack = emulators.importWorker(
+        "unpack",
+        TOPIC="bench-unpack",
+        SUBSCRIPTION="bench-ingest",
+        CALLBACK_WORKERS=args.callback_workers,
+        FLOW_MAX_MESSAGES=args.max_messages,
+    )
+    import worker_common
+    from google.cloud.pubsub import PublisherClient, SubscriberClient
+    from google.cloud.pubsub_v1.subscriber.scheduler import ThreadScheduler
+
+    topic_path = emulators.createTopic("bench-ingest-notifications", "bench-ingest")
+    emulators.createTopic("bench-unpack")
+    src_bucket = emulators.createBucket("bench-ingest")
+    emulators.createBucket("bench-unpack")
+    src_bucket.blob("bench.zip").upload_from_string(emulators.makeArchive(args.sensors), content_type="application/zip")
+
+    publisher_client = PublisherClient()
+    attributes = {"eventType": "OBJECT_FINALIZE", "bucketId": src_bucket.name, "objectId": "bench.zip"}
+    # Every notification has its own generation, so none of them is skipped as a redelivery
+    futures = [publisher_client.publish(topic_path, b"", objectGeneration=str(i), **attributes) for i in range(args.archives)]
+    for future in futures:
+        future.result()
+
+    acked = []
+    done = threading.Event()
+    ack_on_publish = unpack.stage.ackOnPublish
+
+    def countingAckOnPublish(message, future):
+        ack_on_publish(message, future)
+        acked.append(time.perf_counter())
+        if len(acked) >= args.archives:
+            done.set()
+
+    unpack.stage.ackOnPublish = countingAckOnPublish
+    subscriber = SubscriberClient()
+    subscription_path = subscriber.subscription_path(emulators.PROJECT_ID, "bench-ingest")
+    scheduler = ThreadScheduler(ThreadPoolExecutor(max_workers=worker_common.callback_workers))
+    start = time.perf_counter()
+    streaming_pull_future = subscriber.subscribe(
+        subscription_path, callback=unpack.callback, flow_control=worker_common.flowControl(), scheduler=scheduler
+    )
+    done.wait(args.timeout)
+    elapsed = time.perf_counter() - start
+    streaming_pull_future.cancel()
+    subscriber.close()
+    return {
+        "callback_workers": worker_common.callback_workers,
+        "flow_max_messages": worker_common.flow_max_messages,
+        "archives": len(acked),
+        "archives_per_sec": round(len(acked) / elapsed, 2),
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--archives", type=int, default=200, help="backlog size per setting")
+    parser.add_argument("--sensors", type=int, default=100, help="members per archive")
+    parser.add_argument("--settings", default="2:4,4:8,10:20,20:40",
+                        help="comma separated CALLBACK_WORKERS:FLOW_MAX_MESSAGES pairs")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds to wait for one setting")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--callback-workers", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--max-messages", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    emulators.checkEmulators()
+    if args.callback_workers:
+        print(json.dumps(runSetting(args)))
+        return
+
+    results = []
+    for setting in args.settings.split(","):
+        callback_workers, max_messages = setting.split(":")
+        command = [
+            sys.executable, os.path.abspath(__file__),
+            "--archives", str(args.archives), "--sensors", str(args.sensors), "--timeout", str(args.timeout),
+            "--callback-workers", callback_workers, "--max-messages", max_messages,
+        ]
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    print(f"{'callbacks':>10}{'max msgs':>10}{'archives/s':>12}{'max RSS MB':>12}")
+    for result in results:
+        print(f"{result['callback_workers']:>10}{result['flow_max_messages']:>10}"
+              f"{result['archives_per_sec']:>12}{result['max_rss_mb']:>12}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"archives": args.archives, "sensors": args.sensors, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
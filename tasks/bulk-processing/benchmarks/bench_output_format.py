@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""Bytes written and downstream read time for each transform OUTPUT_FORMAT.
+
+Runs the transform output builders on generated sensor documents, the output
+stays in memory, so no emulator is needed. Read time is what a downstream loader
+pays to get typed columns back: csv.reader plus type conversion or
+pyarrow.csv for CSV, pyarrow.parquet for Parquet.
+"""
+import argparse
+import csv
+import io
+import json
+import time
+
+import emulators
+
+
+def build(builder, *args, **kwargs):
+    """Run an output builder and return its objects as bytes, keyed by name."""
+    outputs = {}
+
+    def call():
+        for name, data, _ in builder(*args, **kwargs):
+            outputs[name] = data.encode("utf-8") if isinstance(data, str) else data
+
+    return outputs, call
+
+
+def readCsvPython(data):
+    rows = list(csv.reader(io.StringIO(data.decode("utf-8"))))[1:]
+    return [(int(row[0]), int(row[1]), float(row[2])) for row in rows]
+
+
+def timed(call, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        call()
+    return round((time.perf_counter() - start) / repeat * 1000, 2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sensors", default="100,10000,100000", help="comma separated sensor counts")
+    parser.add_argument("--repeat", type=int, default=5, help="reads per measurement")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    transform = emulators.importWorker("transform")
+    generator = emulators.importWorker("generator")
+    import pyarrow.csv as pacsv
+    import pyarrow.parquet as pq
+
+    results = []
+    for sensors in [int(n) for n in args.sensors.split(",")]:
+        documents = []
+        for i in range(sensors):
+            data = generator.generateSensorData(i)
+            data["timestamp"] = "1700000000"
+            documents.append(data)
+
+        csv_objects, call = build(transform.buildCsv, "bench", iter(documents))
+        write_csv_ms = timed(call, 1)
+        parquet_objects, call = build(transform.buildParquet, "bench", iter(documents))
+        write_parquet_ms = timed(call, 1)
+        wide_objects, call = build(transform.buildParquet, "bench", iter(documents), wide=True)
+        write_wide_ms = timed(call, 1)
+
+        csv_data = csv_objects["temperature/bench.csv"]
+        parquet_data = parquet_objects["temperature/bench.parquet"]
+        results.append({
+            "sensors": sensors,
+            "csv_bytes": sum(len(data) for data in csv_objects.values()),
+            "parquet_bytes": sum(len(data) for data in parquet_objects.values()),
+            "parquet_wide_bytes": sum(len(data) for data in wide_objects.values()),
+            "csv_write_ms": write_csv_ms,
+            "parquet_write_ms": write_parquet_ms,
+            "parquet_wide_write_ms": write_wide_ms,
+            "csv_read_python_ms": timed(lambda: readCsvPython(csv_data), args.repeat),
+            "csv_read_arrow_ms": timed(lambda: pacsv.read_csv(io.BytesIO(csv_data)), args.repeat),
+            "parquet_read_ms": timed(lambda: pq.read_table(io.BytesIO(parquet_data)), args.repeat),
+        })
+
+    for result in results:
+        print(f"{result['sensors']} sensors")
+        print(f"  bytes written:  csv {result['csv_bytes']}, parquet {result['parquet_bytes']}, "
+              f"parquet-wide {result['parquet_wide_bytes']}")
+        print(f"  write ms:       csv {result['csv_write_ms']}, parquet {result['parquet_write_ms']}, "
+              f"parquet-wide {result['parquet_wide_write_ms']}")
+        print(f"  read ms/metric: csv.reader {result['csv_read_python_ms']}, pyarrow.csv {result['csv_read_arrow_ms']}, "
+              f"parquet {result['parquet_read_ms']}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""End-to-end throughput and latency of the bulk-processing pipeline on local emulators.
+
+Starts the Pub/Sub emulator and a fake GCS server (unless the emulator
+variables are already set), runs real unpack.py and transform.py worker
+processes, ingests archives with ingest.py and follows every archive through
+both stages. The fake GCS server has no bucket notifications, so the
+OBJECT_FINALIZE message is published by the harness after each upload.
+
+Stage completion is observed on extra subscriptions to the unpack and
+transform topics:
+- unpack latency: notification published -> unpack message received;
+- transform latency: unpack message received -> transform message received;
+- end-to-end latency: notification published -> transform message received.
+
+With --fused, transform.py runs with INPUT=archive on the ingest subscription
+and no unpack workers are started, so only end-to-end latency is measured.
+
+The JSON result file holds the configuration, the git revision and all
+numbers, so runs of different releases can be diffed.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import emulators
+
+STAGES = ("unpack", "transform", "end_to_end")
+
+
+class PipelineObserver:
+    """Records when each archive enters the pipeline and leaves each stage."""
+
+    def __init__(self, archives):
+        self.archives = archives
+        self.ingested = {}
+        self.unpacked = {}
+        self.transformed = {}
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    def onUnpacked(self, message):
+        path = json.loads(message.data)["path"]
+        with self.lock:
+            self.unpacked.setdefault(path, time.time())
+        message.ack()
+
+    def onTransformed(self, message):
+        path = json.loads(message.data)["path"]
+        with self.lock:
+            self.transformed.setdefault(path, time.time())
+            if len(self.transformed) >= self.archives:
+                self.done.set()
+        message.ack()
+
+    def latencies(self):
+        result = {stage: [] for stage in STAGES}
+        for path, ingested in self.ingested.items():
+            if path in self.unpacked:
+                result["unpack"].append(self.unpacked[path] - ingested)
+            if path in self.unpacked and path in self.transformed:
+                result["transform"].append(self.transformed[path] - self.unpacked[path])
+            if path in self.transformed:
+                result["end_to_end"].append(self.transformed[path] - ingested)
+        return result
+
+
+def gitRevision():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], cwd=emulators.WORKERS_DIR,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def startWorkers(script, count, env):
+    workers = []
+    for _ in range(count):
+        workers.append(subprocess.Popen(
+            [sys.executable, os.path.join(emulators.WORKERS_DIR, script)],
+            env={**os.environ, **env}, stdout=subprocess.DEVNULL,
+        ))
+    return workers
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--archives", type=int, default=100, help="archives to ingest")
+    parser.add_argument("--sensors", type=int, default=100, help="sensors per archive")
+    parser.add_argument("--unpack-workers", type=int, default=1, help="unpack.py processes")
+    parser.add_argument("--transform-workers", type=int, default=1, help="transform.py processes")
+    parser.add_argument("--fused", action="store_true",
+                        help="run transform.py on the archives (INPUT=archive) without unpack workers")
+    parser.add_argument("--ingest-concurrency", type=int, default=10, help="archives uploaded at once")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--timeout", type=float, default=900, help="seconds to wait for the pipeline to drain")
+    parser.add_argument("--worker-env", action="append", default=[], metavar="NAME=VALUE",
+                        help="extra environment for both workers, e.g. CALLBACK_WORKERS=4 (repeatable)")
+    parser.add_argument("--output", default="pipeline-results.json", help="JSON result file")
+    args = parser.parse_args()
+
+    stop_emulators = emulators.startEmulators()
+    os.environ["PROJECT_ID"] = emulators.PROJECT_ID
+    run_id = str(int(time.time()))
+    names = {stage: f"bench-{run_id}-{stage}" for stage in ("ingest", "unpack", "transform")}
+    workers = {}
+    try:
+        from google.cloud import storage
+        from google.cloud.pubsub import PublisherClient, SubscriberClient
+        import numpy as np
+        ingest = emulators.importWorker("ingest")
+
+        for name in names.values():
+            emulators.createBucket(name)
+        ingest_topic = emulators.createTopic(names["ingest"], names["ingest"])
+        emulators.createTopic(names["unpack"], names["unpack"])
+        emulators.createTopic(names["transform"])
+        # Observer subscriptions see the same messages as the next stage's workers
+        subscriber = SubscriberClient()
+        observer = PipelineObserver(args.archives)
+        for stage, handler in (("unpack", observer.onUnpacked), ("transform", observer.onTransformed)):
+            subscription_path = subscriber.subscription_path(emulators.PROJECT_ID, f"{names[stage]}-observer")
+            topic_path = subscriber.topic_path(emulators.PROJECT_ID, names[stage])
+            subscriber.create_subscription(name=subscription_path, topic=topic_path)
+            subscriber.subscribe(subscription_path, callback=handler)
+
+        # Several workers share the host, so their metrics endpoints are off unless a port is given
+        extra_env = {"METRICS_PORT": "0", **dict(item.split("=", 1) for item in args.worker_env)}
+        if args.fused:
+            workers["transform"] = startWorkers("transform.py", args.transform_workers, {
+                **extra_env, "INPUT": "archive", "SUBSCRIPTION": names["ingest"],
+                "TOPIC": names["transform"], "BUCKET": names["transform"],
+            })
+        else:
+            workers["unpack"] = startWorkers("unpack.py", args.unpack_workers, {
+                **extra_env, "SUBSCRIPTION": names["ingest"], "TOPIC": names["unpack"], "BUCKET": names["unpack"],
+            })
+            workers["transform"] = startWorkers("transform.py", args.transform_workers, {
+                **extra_env, "SUBSCRIPTION": names["unpack"], "TOPIC": names["transform"], "BUCKET": names["transform"],
+            })
+
+        storage_client = storage.Client(project=emulators.PROJECT_ID)
+        ingest_bucket = storage_client.bucket(names["ingest"])
+        publisher_client = PublisherClient()
+        seeds = np.random.SeedSequence(args.seed).spawn(args.archives)
+
+        def ingestOne(i):
+            object_name = f"{run_id}.{i}.zip"
+            ingest.ingestArchive(ingest_bucket, object_name, np.random.default_rng(seeds[i]), args.sensors, run_id)
+            observer.ingested[f"{run_id}.{i}"] = time.time()
+            publisher_client.publish(
+                ingest_topic, b"", eventType="OBJECT_FINALIZE", bucketId=ingest_bucket.name, objectId=object_name,
+            ).result()
+
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=args.ingest_concurrency) as executor:
+            list(executor.map(ingestOne, range(args.archives)))
+        drained = observer.done.wait(args.timeout)
+        elapsed = time.time() - start
+
+        worker_stats = {}
+        for stage, processes in workers.items():
+            worker_stats[stage] = []
+            for process in processes:
+                cpu_seconds, peak_rss_mb = emulators.processStats(process.pid)
+                worker_stats[stage].append({"cpu_seconds": cpu_seconds, "peak_rss_mb": peak_rss_mb})
+
+        latencies = observer.latencies()
+        result = {
+            "revision": gitRevision(),
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "config": {
+                "archives": args.archives,
+                "sensors": args.sensors,
+                "fused": args.fused,
+                "unpack_workers": 0 if args.fused else args.unpack_workers,
+                "transform_workers": args.transform_workers,
+                "ingest_concurrency": args.ingest_concurrency,
+                "worker_env": extra_env,
+            },
+            "completed": len(observer.transformed),
+            "drained": drained,
+            "elapsed_sec": round(elapsed, 2),
+            "archives_per_sec": round(len(observer.transformed) / elapsed, 2),
+            "latency_ms": {
+                stage: {f"p{pct}": round(emulators.percentile(latencies[stage], pct) * 1000, 1) for pct in (50, 95, 99)}
+                for stage in STAGES
+            },
+            "workers": worker_stats,
+        }
+    finally:
+        for processes in workers.values():
+            for process in processes:
+                process.terminate()
+                process.wait()
+        stop_emulators()
+
+    print(f"{result['completed']}/{args.archives} archives in {result['elapsed_sec']}s "
+          f"({result['archives_per_sec']} archives/s)")
+    for stage in STAGES:
+        pcts = result["latency_ms"][stage]
+        print(f"  {stage:<11} p50 {pcts['p50']:>8} ms  p95 {pcts['p95']:>8} ms  p99 {pcts['p99']:>8} ms")
+    for stage, stats in result["workers"].items():
+        for i, worker in enumerate(stats):
+            print(f"  {stage} worker {i}: {worker['cpu_seconds']} CPU s, {worker['peak_rss_mb']} MiB peak RSS")
+    with open(args.output, "w") as f:
+        json.dump(result, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""Callback throughput of the transform worker with blocking vs non-blocking publish.
+
+Feeds transform.callback with messages from a pool of threads, like the
+subscriber does. In "blocking" mode every callback waits until its message
+is acknowledged, which is what the worker used to do; in "async" mode the
+callback returns as soon as the publish is queued and the ack happens from
+the publish future's done-callback.
+"""
+import argparse
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import emulators
+
+
+def run(transform, messages, concurrency, blocking):
+    def handle(message):
+        transform.callback(message)
+        if blocking:
+            message.settled.wait()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(handle, messages))
+    callbacks_done = time.perf_counter() - start
+    for message in messages:
+        message.settled.wait()
+    all_acked = time.perf_counter() - start
+    return {
+        "mode": "blocking" if blocking else "async",
+        "callbacks_per_sec": round(len(messages) / callbacks_done, 2),
+        "acks_per_sec": round(len(messages) / all_acked, 2),
+        "nacked": sum(1 for message in messages if not message.acked),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=100)
+    parser.add_argument("--sensors", type=int, default=10, help="members per archive")
+    parser.add_argument("--concurrency", type=int, default=10, help="concurrent callbacks")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    emulators.checkEmulators()
+    unpack = emulators.importWorker("unpack", TOPIC="bench-unpack")
+    transform = emulators.importWorker("transform", TOPIC="bench-transform", BUCKET="bench-transform")
+    emulators.createTopic("bench-unpack")
+    emulators.createTopic("bench-transform")
+    src_bucket = emulators.createBucket("bench-ingest")
+    unpack_bucket = emulators.createBucket("bench-unpack")
+    emulators.createBucket("bench-transform")
+    src_bucket.blob("bench.zip").upload_from_string(emulators.makeArchive(args.sensors), content_type="application/zip")
+    unpack.unpackArchive(src_bucket.name, "bench.zip", unpack_bucket.name, "bench").result()
+
+    results = []
+    for blocking in (True, False):
+        data = json.dumps({"bucket": unpack_bucket.name, "path": "bench"}).encode("utf-8")
+        # Every message has its own generation, so none of them is skipped as a redelivery
+        messages = [emulators.FakeMessage(data, {"generation": f"{blocking}-{i}"}) for i in range(args.messages)]
+        results.append(run(transform, messages, args.concurrency, blocking))
+
+    print(f"{'mode':<10}{'callbacks/s':>14}{'acks/s':>10}{'nacked':>8}")
+    for result in results:
+        print(f"{result['mode']:<10}{result['callbacks_per_sec']:>14}{result['acks_per_sec']:>10}{result['nacked']:>8}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"concurrency": args.concurrency, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""Unpack worker throughput on one vCPU with the threaded and the asyncio runtime.
+
+Every setting runs in its own process pinned to a single CPU: a real streaming
+pull subscriber drains a backlog of OBJECT_FINALIZE messages from the Pub/Sub
+emulator. Storage requests go through latency_proxy (started by this script,
+outside the pinned CPU), so every request pays a simulated round-trip and the
+number of requests in flight decides the throughput.
+
+threads settings run FLOW_MAX_MESSAGES callback threads, asyncio settings
+lease FLOW_MAX_MESSAGES messages and run them as tasks on the event loop. The
+asyncio runtime needs gcloud-aio-storage, pinned in requirements.txt.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import emulators
+import latency_proxy
+
+
+def runSetting(args):
+    os.sched_setaffinity(0, {args.cpu})
+    unpack = emulators.importWorker(
+        "unpack",
+        TOPIC="bench-unpack",
+        BUCKET="bench-unpack",
+        RUNTIME=args.runtime,
+        CALLBACK_WORKERS=args.max_messages,
+        FLOW_MAX_MESSAGES=args.max_messages,
+        UPLOAD_WORKERS=args.upload_workers,
+        ASYNC_MAX_REQUESTS=args.async_max_requests,
+    )
+    import worker_common
+    from google.cloud.pubsub import PublisherClient, SubscriberClient
+    from google.cloud.pubsub_v1.subscriber.scheduler import ThreadScheduler
+
+    subscription_id = f"bench-runtime-{args.runtime}-{args.max_messages}-{time.time_ns()}"
+    topic_path = emulators.createTopic(subscription_id, subscription_id)
+    publisher_client = PublisherClient()
+    # Every notification has its own generation, so none of them is skipped as a redelivery
+    futures = [
+        publisher_client.publish(
+            topic_path, b"", eventType="OBJECT_FINALIZE", bucketId="bench-ingest", objectId="bench.zip",
+            objectGeneration=str(i),
+        )
+        for i in range(args.archives)
+    ]
+    for future in futures:
+        future.result()
+
+    acked = []
+    done = threading.Event()
+    ack_on_publish = unpack.stage.ackOnPublish
+
+    def countingAckOnPublish(message, future):
+        ack_on_publish(message, future)
+        acked.append(time.perf_counter())
+        if len(acked) >= args.archives:
+            done.set()
+
+    unpack.stage.ackOnPublish = countingAckOnPublish
+    if args.runtime == "asyncio":
+        worker_common.startEventLoop()
+        scheduler = ThreadScheduler(ThreadPoolExecutor(max_workers=1))
+        callback = worker_common.scheduleOnEventLoop(unpack.callbackAsync)
+    else:
+        scheduler = ThreadScheduler(ThreadPoolExecutor(max_workers=worker_common.callback_workers))
+        callback = unpack.callback
+    subscriber = SubscriberClient()
+    subscription_path = subscriber.subscription_path(emulators.PROJECT_ID, subscription_id)
+    start = time.perf_counter()
+    streaming_pull_future = subscriber.subscribe(
+        subscription_path, callback=callback, flow_control=worker_common.flowControl(), scheduler=scheduler
+    )
+    done.wait(args.timeout)
+    elapsed = time.perf_counter() - start
+    streaming_pull_future.cancel()
+    subscriber.close()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return {
+        "runtime": args.runtime,
+        "flow_max_messages": args.max_messages,
+        "archives": len(acked),
+        "archives_per_sec": round(len(acked) / elapsed, 2),
+        "cpu_ms_per_archive": round((usage.ru_utime + usage.ru_stime) * 1000 / max(1, len(acked)), 1),
+        "threads": threading.active_count(),
+        "max_rss_mb": round(usage.ru_maxrss / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--archives", type=int, default=200, help="backlog size per setting")
+    parser.add_argument("--sensors", type=int, default=100, help="members per archive")
+    parser.add_argument("--latency-ms", type=float, default=30, help="latency added to every storage request")
+    parser.add_argument("--settings", default="threads:10,threads:50,asyncio:50,asyncio:200",
+                        help="comma separated RUNTIME:FLOW_MAX_MESSAGES pairs")
+    parser.add_argument("--upload-workers", type=int, default=8, help="UPLOAD_WORKERS of the threaded runtime")
+    parser.add_argument("--async-max-requests", type=int, default=100, help="ASYNC_MAX_REQUESTS of the asyncio runtime")
+    parser.add_argument("--cpu", type=int, default=0, help="CPU the worker processes are pinned to")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds to wait for one setting")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--runtime", help=argparse.SUPPRESS)
+    parser.add_argument("--max-messages", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    emulators.checkEmulators()
+    if args.runtime:
+        print(json.dumps(runSetting(args)))
+        return
+
+    emulators.createTopic("bench-unpack")
+    src_bucket = emulators.createBucket("bench-ingest")
+    emulators.createBucket("bench-unpack")
+    src_bucket.blob("bench.zip").upload_from_string(emulators.makeArchive(args.sensors), content_type="application/zip")
+    # The proxy runs in this process, so its threads do not compete with the pinned worker
+    proxy_host = latency_proxy.startProxy(os.environ["STORAGE_EMULATOR_HOST"], args.latency_ms)
+
+    results = []
+    for setting in args.settings.split(","):
+        runtime, max_messages = setting.split(":")
+        command = [
+            sys.executable, os.path.abspath(__file__),
+            "--archives", str(args.archives), "--timeout", str(args.timeout), "--cpu", str(args.cpu),
+            "--upload-workers", str(args.upload_workers), "--async-max-requests", str(args.async_max_requests),
+            "--runtime", runtime, "--max-messages", max_messages,
+        ]
+        output = subprocess.run(
+            command, check=True, capture_output=True, text=True, env={**os.environ, "STORAGE_EMULATOR_HOST": proxy_host},
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    print(f"{'runtime':<10}{'max msgs':>10}{'archives/s':>12}{'CPU ms/archive':>16}{'threads':>9}{'max RSS MB':>12}")
+    for result in results:
+        print(f"{result['runtime']:<10}{result['flow_max_messages']:>10}{result['archives_per_sec']:>12}"
+              f"{result['cpu_ms_per_archive']:>16}{result['threads']:>9}{result['max_rss_mb']:>12}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "archives": args.archives, "sensors": args.sensors, "latency_ms": args.latency_ms, "results": results,
+            }, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
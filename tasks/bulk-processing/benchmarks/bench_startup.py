@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""Import time of the workers, from `python3 -X importtime`.
+
+Every run imports a worker module in a fresh interpreter, the way a worker process started by the supervisor
+or the startup script's restart loop does, and records the cumulative import time of the module and the self
+time of every module it pulled in. It reports the median over --runs, the heaviest packages and the
+--forbid modules that were imported at module load. The script exits with 1 when a forbidden module is
+imported or the median is above --max-import-ms, so it can guard against regressions in CI.
+
+No emulators are needed, the workers only read their settings at import.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+
+import emulators
+
+WORKERS = ("unpack", "transform")
+# Loaded by the workers when they create their clients, not when they are imported
+FORBIDDEN = ("google.cloud.pubsub", "google.cloud.pubsub_v1", "google.pubsub_v1", "google.cloud.storage", "grpc")
+
+
+def package(module_name):
+    # google.* is a namespace package, group its modules by the client library
+    parts = module_name.split(".")
+    depth = 3 if parts[:2] == ["google", "cloud"] else 2 if parts[0] == "google" else 1
+    return ".".join(parts[:depth])
+
+
+def importOnce(module_name):
+    """Import module_name in a new interpreter, return {module: (self_us, cumulative_us)}."""
+    env = dict(os.environ, PROJECT_ID=emulators.PROJECT_ID, PYTHONPATH=emulators.WORKERS_DIR)
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module_name}"],
+        env=env, capture_output=True, text=True, check=True,
+    )
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        if self_us.strip().isdigit():
+            modules[name.strip()] = (int(self_us), int(cumulative_us))
+    return modules
+
+
+def measure(module_name, runs, top):
+    totals = []
+    packages = defaultdict(list)
+    for _ in range(runs):
+        modules = importOnce(module_name)
+        totals.append(modules[module_name][1] / 1000)
+        per_package = defaultdict(int)
+        for name, (self_us, _) in modules.items():
+            per_package[package(name)] += self_us
+        for name, self_us in per_package.items():
+            packages[name].append(self_us / 1000)
+    heaviest = sorted(((statistics.median(ms), name) for name, ms in packages.items()), reverse=True)[:top]
+    return {
+        "module": module_name,
+        "import_ms": round(statistics.median(totals), 1),
+        "import_ms_min": round(min(totals), 1),
+        "modules": len(modules),
+        "heaviest_ms": {name: round(ms, 1) for ms, name in heaviest},
+        "forbidden": sorted(name for name in modules if name in FORBIDDEN),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", default=",".join(WORKERS), help="comma separated worker modules")
+    parser.add_argument("--runs", type=int, default=5, help="imports per worker, the median is reported")
+    parser.add_argument("--top", type=int, default=8, help="heaviest packages to report")
+    parser.add_argument("--max-import-ms", type=float, help="fail when a median import takes longer")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    results = [measure(worker, args.runs, args.top) for worker in args.workers.split(",")]
+    failed = False
+    for result in results:
+        print(f"{result['module']}: {result['import_ms']} ms median, {result['import_ms_min']} ms min, "
+              f"{result['modules']} modules")
+        for name, ms in result["heaviest_ms"].items():
+            print(f"  {name:<32}{ms:>8.1f} ms")
+        if result["forbidden"]:
+            print(f"  imported at module load: {', '.join(result['forbidden'])}")
+            failed = True
+        if args.max_import_ms is not None and result["import_ms"] > args.max_import_ms:
+            print(f"  slower than --max-import-ms {args.max_import_ms}")
+            failed = True
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"python": sys.version.split()[0], "results": results}, f, indent=2)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""Latency and memory of transformData for growing numbers of sensors.
+
+Compares the original implementation (serial downloads, CSV built by string
+concatenation) with concurrent downloads and csv.writer output, reading the
+prefix by listing it and from an unpack manifest. The legacy mode is
+quadratic, so it only runs up to --legacy-max sensors.
+"""
+import argparse
+import json
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import emulators
+
+
+def legacyTransformData(transform, src_bucket_name, src_path, dst_bucket_name, dst_path):
+    # The implementation transform.py used before: serial downloads and string concatenation
+    storage_client = transform.stage.getStorageClient()
+    src_bucket = storage_client.bucket(src_bucket_name)
+    dst_bucket = storage_client.bucket(dst_bucket_name)
+    temperature = "\"Sensor ID\",\"Timestamp\",\"Temperature\"\n"
+    humidity = "\"Sensor ID\",\"Timestamp\",\"Humidity\"\n"
+    pressure = "\"Sensor ID\",\"Timestamp\",\"Pressure\"\n"
+    for blob in storage_client.list_blobs(src_bucket, prefix=src_path):
+        data = json.loads(blob.download_as_bytes())
+        temperature += f"\"{data['id']}\",{data['timestamp']}\",\"{data['temperature']}\"\n"
+        humidity += f"\"{data['id']}\",\"{data['timestamp']}\",\"{data['humidity']}\"\n"
+        pressure += f"\"{data['id']}\",\"{data['timestamp']}\",\"{data['pressure']}\"\n"
+    dst_bucket.blob(f"temperature/{dst_path}.csv").upload_from_string(temperature)
+    dst_bucket.blob(f"humidity/{dst_path}.csv").upload_from_string(humidity)
+    dst_bucket.blob(f"pressure/{dst_path}.csv").upload_from_string(pressure)
+
+
+def prepare(generator, bucket, prefix, sensors):
+    def upload(i):
+        data = generator.generateSensorData(i)
+        data["timestamp"] = "1700000000"
+        bucket.blob(f"{prefix}/sensor{i}.json").upload_from_string(json.dumps(data))
+
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        list(executor.map(upload, range(sensors)))
+
+
+def measure(call):
+    tracemalloc.start()
+    start = time.perf_counter()
+    call()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return round(elapsed, 2), round(peak / 1024 / 1024, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sensors", default="100,1000,10000,100000", help="comma separated sensor counts")
+    parser.add_argument("--legacy-max", type=int, default=10000, help="largest sensor count for the legacy mode")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    emulators.checkEmulators()
+    transform = emulators.importWorker("transform", TOPIC="bench-transform")
+    generator = emulators.importWorker("generator")
+    emulators.createTopic("bench-transform")
+    src_bucket = emulators.createBucket("bench-unpack")
+    dst_bucket = emulators.createBucket("bench-transform")
+
+    results = []
+    for sensors in [int(n) for n in args.sensors.split(",")]:
+        prefix = f"sensors-{sensors}"
+        prepare(generator, src_bucket, prefix, sensors)
+        result = {"sensors": sensors}
+        if sensors <= args.legacy_max:
+            result["legacy_sec"], result["legacy_peak_mb"] = measure(
+                lambda: legacyTransformData(transform, src_bucket.name, prefix, dst_bucket.name, f"legacy/{prefix}")
+            )
+        result["streaming_sec"], result["streaming_peak_mb"] = measure(
+            lambda: transform.transformData(src_bucket.name, prefix, dst_bucket.name, prefix).result()
+        )
+        # The manifest unpack.py would have sent, built outside the measurement
+        objects = [
+            {"name": blob.name, "size": blob.size, "generation": blob.generation}
+            for blob in src_bucket.client.list_blobs(src_bucket, prefix=f"{prefix}/")
+        ]
+        source = {"bucket": src_bucket.name, "path": prefix, "objects": objects}
+        result["manifest_sec"], result["manifest_peak_mb"] = measure(
+            lambda: transform.transformPrefixes([source], dst_bucket.name, f"manifest/{prefix}").result()
+        )
+        results.append(result)
+
+    print(f"{'sensors':>8}{'legacy s':>10}{'legacy MB':>11}{'streaming s':>13}{'streaming MB':>14}"
+          f"{'manifest s':>12}{'manifest MB':>13}")
+    for result in results:
+        print(f"{result['sensors']:>8}{result.get('legacy_sec', '-'):>10}{result.get('legacy_peak_mb', '-'):>11}"
+              f"{result['streaming_sec']:>13}{result['streaming_peak_mb']:>14}"
+              f"{result['manifest_sec']:>12}{result['manifest_peak_mb']:>13}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
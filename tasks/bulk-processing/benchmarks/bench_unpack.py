@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""Per-archive latency and local disk writes of unpackArchive.
+
+Compares the original extract-to-disk implementation with the streaming
+implementation, once forced to spill to disk and once unpacked from memory.
+Then replays the archives of the memory run to the same prefixes, uploading
+every member again and with UNCHANGED_MEMBERS=skip.
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+from zipfile import ZipFile
+
+import emulators
+
+
+def legacyUnpackArchive(unpack, src_bucket_name, src_object_name, dst_bucket_name, dst_object_prefix):
+    # The implementation unpack.py used before streaming: download, extractall, upload from disk
+    from google.cloud import storage
+    from google.cloud.pubsub import PublisherClient
+
+    storage_client = storage.Client()
+    blob = storage_client.bucket(src_bucket_name).blob(src_object_name)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        local_file = os.path.join(tmpdir, "data.zip")
+        blob.download_to_filename(local_file)
+        with ZipFile(local_file) as archive:
+            archive.extractall(path=tmpdir)
+        os.remove(local_file)
+        dst_bucket = storage_client.bucket(dst_bucket_name)
+        for datafile in os.listdir(tmpdir):
+            if os.path.isfile(os.path.join(tmpdir, datafile)):
+                blob = dst_bucket.blob(f"{dst_object_prefix}/{datafile}")
+                blob.upload_from_filename(os.path.join(tmpdir, datafile))
+    publisher_client = PublisherClient()
+    topic_path = publisher_client.topic_path(unpack.project_id, unpack.topic_id)
+    data = json.dumps({"bucket": dst_bucket_name, "path": dst_object_prefix}).encode("utf-8")
+    publisher_client.publish(topic_path, data).result()
+
+
+def run(unpack, mode, archives, src_bucket, dst_bucket, prefix_mode=None):
+    latencies = []
+    disk_before = emulators.diskBytesWritten()
+    for i, object_name in enumerate(archives):
+        prefix = f"{prefix_mode or mode}/{i}"
+        start = time.perf_counter()
+        if mode == "legacy":
+            legacyUnpackArchive(unpack, src_bucket, object_name, dst_bucket, prefix)
+        else:
+            unpack.unpackArchive(src_bucket, object_name, dst_bucket, prefix).result()
+        latencies.append(time.perf_counter() - start)
+    disk_bytes = emulators.diskBytesWritten() - disk_before
+    return {
+        "mode": mode,
+        "archives": len(archives),
+        "p50_ms": round(emulators.percentile(latencies, 50) * 1000, 1),
+        "p95_ms": round(emulators.percentile(latencies, 95) * 1000, 1),
+        "disk_bytes_per_archive": disk_bytes // max(1, len(archives)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--archives", type=int, default=20, help="archives per mode")
+    parser.add_argument("--sensors", type=int, default=100, help="members per archive")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    emulators.checkEmulators()
+    unpack = emulators.importWorker("unpack", TOPIC="bench-unpack")
+    emulators.createTopic("bench-unpack")
+    src_bucket = emulators.createBucket("bench-ingest")
+    dst_bucket = emulators.createBucket("bench-unpack")
+
+    archive = emulators.makeArchive(args.sensors)
+    archives = []
+    for i in range(args.archives):
+        object_name = f"bench-{i}.zip"
+        src_bucket.blob(object_name).upload_from_string(archive, content_type="application/zip")
+        archives.append(object_name)
+
+    results = [run(unpack, "legacy", archives, src_bucket.name, dst_bucket.name)]
+    threshold = unpack.spool_threshold
+    unpack.spool_threshold = 0
+    results.append(run(unpack, "spool-disk", archives, src_bucket.name, dst_bucket.name))
+    unpack.spool_threshold = threshold
+    results.append(run(unpack, "memory", archives, src_bucket.name, dst_bucket.name))
+    results.append(run(unpack, "replay-upload", archives, src_bucket.name, dst_bucket.name, prefix_mode="memory"))
+    unpack.unchanged_members = "skip"
+    results.append(run(unpack, "replay-skip", archives, src_bucket.name, dst_bucket.name, prefix_mode="memory"))
+    unpack.unchanged_members = "upload"
+
+    print(f"{'mode':<15}{'p50 ms':>10}{'p95 ms':>10}{'disk bytes/archive':>22}")
+    for result in results:
+        print(f"{result['mode']:<15}{result['p50_ms']:>10}{result['p95_ms']:>10}{result['disk_bytes_per_archive']:>22}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"archive_bytes": len(archive), "sensors": args.sensors, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
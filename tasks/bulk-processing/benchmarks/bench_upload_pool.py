@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""Per-archive latency of unpackArchive for different UPLOAD_WORKERS settings.
+
+Storage requests go through latency_proxy, so every member upload pays a
+simulated round-trip and the effect of concurrent uploads becomes visible.
+"""
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import emulators
+import latency_proxy
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--archives", type=int, default=5, help="archives per setting")
+    parser.add_argument("--sensors", type=int, default=100, help="members per archive")
+    parser.add_argument("--latency-ms", type=float, default=30, help="latency added to every storage request")
+    parser.add_argument("--workers", default="1,4,8,16", help="comma separated UPLOAD_WORKERS values")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    emulators.checkEmulators()
+    os.environ["STORAGE_EMULATOR_HOST"] = latency_proxy.startProxy(os.environ["STORAGE_EMULATOR_HOST"], args.latency_ms)
+    unpack = emulators.importWorker("unpack", TOPIC="bench-unpack")
+    emulators.createTopic("bench-unpack")
+    src_bucket = emulators.createBucket("bench-ingest")
+    dst_bucket = emulators.createBucket("bench-unpack")
+    src_bucket.blob("bench.zip").upload_from_string(emulators.makeArchive(args.sensors), content_type="application/zip")
+
+    results = []
+    for workers in [int(w) for w in args.workers.split(",")]:
+        unpack.upload_executor.shutdown()
+        unpack.upload_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="upload")
+        latencies = []
+        for i in range(args.archives):
+            start = time.perf_counter()
+            unpack.unpackArchive(src_bucket.name, "bench.zip", dst_bucket.name, f"workers-{workers}/{i}").result()
+            latencies.append(time.perf_counter() - start)
+        results.append({
+            "upload_workers": workers,
+            "p50_ms": round(emulators.percentile(latencies, 50) * 1000, 1),
+            "p95_ms": round(emulators.percentile(latencies, 95) * 1000, 1),
+            "members_per_sec": round(args.sensors / emulators.percentile(latencies, 50), 1),
+        })
+
+    print(f"{'workers':<10}{'p50 ms':>10}{'p95 ms':>10}{'members/s':>12}")
+    for result in results:
+        print(f"{result['upload_workers']:<10}{result['p50_ms']:>10}{result['p95_ms']:>10}{result['members_per_sec']:>12}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"latency_ms": args.latency_ms, "sensors": args.sensors, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
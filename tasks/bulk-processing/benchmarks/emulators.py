@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""Helpers for running the bulk-processing workers against local emulators.
+
+Benchmarks expect a fake GCS server and the Pub/Sub emulator to be running
+(bench_pipeline.py can start them itself, see startEmulators) and the usual
+emulator variables to point at them:
+
+    docker run -d --name fake-gcs -p 4443:4443 fsouza/fake-gcs-server -scheme http
+    gcloud beta emulators pubsub start --host-port=localhost:8085
+
+    export STORAGE_EMULATOR_HOST=http://localhost:4443
+    export PUBSUB_EMULATOR_HOST=localhost:8085
+"""
+import importlib
+import io
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from zipfile import ZipFile, ZIP_DEFLATED
+
+WORKERS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROJECT_ID = "bench-project"
+
+
+def checkEmulators():
+    missing = [name for name in ("STORAGE_EMULATOR_HOST", "PUBSUB_EMULATOR_HOST") if not os.environ.get(name)]
+    if missing:
+        print(f"Emulator variables are not set: {', '.join(missing)}")
+        sys.exit(1)
+
+
+def waitForPort(host, port, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.5)
+    print(f"Timed out waiting for {host}:{port}")
+    sys.exit(1)
+
+
+def startEmulators(pubsub_port=8085, gcs_port=4443):
+    """Start the emulators that are not configured yet, return a callable that stops them."""
+    processes = []
+    if not os.environ.get("PUBSUB_EMULATOR_HOST"):
+        processes.append(subprocess.Popen(
+            ["gcloud", "beta", "emulators", "pubsub", "start", f"--host-port=localhost:{pubsub_port}"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True,
+        ))
+        os.environ["PUBSUB_EMULATOR_HOST"] = f"localhost:{pubsub_port}"
+        waitForPort("localhost", pubsub_port)
+    if not os.environ.get("STORAGE_EMULATOR_HOST"):
+        processes.append(subprocess.Popen(
+            ["docker", "run", "--rm", "-p", f"{gcs_port}:4443", "fsouza/fake-gcs-server",
+             "-scheme", "http", "-public-host", f"localhost:{gcs_port}"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True,
+        ))
+        os.environ["STORAGE_EMULATOR_HOST"] = f"http://localhost:{gcs_port}"
+        waitForPort("localhost", gcs_port)
+
+    def stop():
+        for process in processes:
+            # The emulators run child processes (java, the docker container), stop the whole group
+            os.killpg(process.pid, signal.SIGTERM)
+            process.wait()
+    return stop
+
+
+def processStats(pid):
+    """CPU seconds and peak RSS in MiB of a running process (Linux only)."""
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    cpu_seconds = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    peak_rss_kb = 0
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                peak_rss_kb = int(line.split()[1])
+    return round(cpu_seconds, 2), round(peak_rss_kb / 1024, 1)
+
+
+def importWorker(module_name, **env):
+    """Import a worker module from tasks/bulk-processing with the given environment."""
+    os.environ.setdefault("PROJECT_ID", PROJECT_ID)
+    for name, value in env.items():
+        os.environ[name] = str(value)
+    if WORKERS_DIR not in sys.path:
+        sys.path.insert(0, WORKERS_DIR)
+    return importlib.import_module(module_name)
+
+
+def createBucket(bucket_name):
+    from google.cloud import storage
+    storage_client = storage.Client(project=PROJECT_ID)
+    bucket = storage_client.bucket(bucket_name)
+    if not bucket.exists():
+        storage_client.create_bucket(bucket)
+    return bucket
+
+
+def createTopic(topic_id, subscription_id=None):
+    from google.api_core.exceptions import AlreadyExists
+    from google.cloud.pubsub import PublisherClient, SubscriberClient
+    publisher_client = PublisherClient()
+    topic_path = publisher_client.topic_path(PROJECT_ID, topic_id)
+    try:
+        publisher_client.create_topic(name=topic_path)
+    except AlreadyExists:
+        pass
+    if subscription_id:
+        subscriber = SubscriberClient()
+        subscription_path = subscriber.subscription_path(PROJECT_ID, subscription_id)
+        with subscriber:
+            try:
+                subscriber.create_subscription(name=subscription_path, topic=topic_path, ack_deadline_seconds=600)
+            except AlreadyExists:
+                pass
+    return topic_path
+
+
+class FakeMessage:
+    """Stands in for a received Pub/Sub message when a worker callback is called directly."""
+
+    def __init__(self, data=b"", attributes=None):
+        self.data = data
+        self.attributes = attributes or {}
+        self.size = len(data)
+        self.acked = None
+        self.settled = threading.Event()
+
+    def ack(self):
+        self.acked = True
+        self.settled.set()
+
+    def nack(self):
+        self.acked = False
+        self.settled.set()
+
+
+def makeArchive(sensors, timestamp="1700000000"):
+    """Build an ingest archive with one JSON member per sensor, like ingest.sh does."""
+    generator = importWorker("generator")
+    buffer = io.BytesIO()
+    with ZipFile(buffer, "w", ZIP_DEFLATED) as archive:
+        for i in range(sensors):
+            data = generator.generateSensorData(i)
+            data["timestamp"] = timestamp
+            archive.writestr(f"sensor{i}.json", json.dumps(data))
+    return buffer.getvalue()
+
+
+def diskBytesWritten():
+    """Bytes this process has caused to be written to block devices (Linux only)."""
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                name, value = line.split(":")
+                if name == "write_bytes":
+                    return int(value)
+    except OSError:
+        pass
+    return 0
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
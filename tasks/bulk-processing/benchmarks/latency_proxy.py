@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""HTTP proxy that adds a fixed delay to every request sent to the fake GCS server.
+
+The fake GCS server answers in well under a millisecond, which hides the cost of
+every round-trip the workers make. Putting this proxy in front of it makes the
+local numbers look more like a real bucket:
+
+    python3 latency_proxy.py --latency-ms 30 --port 4444 &
+    export STORAGE_EMULATOR_HOST=http://localhost:4444
+"""
+import argparse
+import http.client
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+# Hop-by-hop headers are not forwarded, the proxy always sends a plain Content-Length body
+HOP_HEADERS = {"connection", "keep-alive", "transfer-encoding", "proxy-connection", "upgrade"}
+
+
+class LatencyProxyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def forward(self):
+        body = None
+        if "Content-Length" in self.headers:
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+        time.sleep(self.server.latency)
+        connection = http.client.HTTPConnection(self.server.upstream_host, self.server.upstream_port)
+        headers = {k: v for k, v in self.headers.items() if k.lower() not in HOP_HEADERS}
+        connection.request(self.command, self.path, body=body, headers=headers)
+        response = connection.getresponse()
+        data = response.read()
+        self.send_response(response.status, response.reason)
+        for name, value in response.getheaders():
+            if name.lower() not in HOP_HEADERS and name.lower() != "content-length":
+                self.send_header(name, value)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        connection.close()
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = do_HEAD = forward
+
+    def log_message(self, format, *args):
+        pass
+
+
+def startProxy(upstream, latency_ms, port=0):
+    """Start the proxy in a background thread and return its base URL."""
+    upstream = urlsplit(upstream)
+    server = ThreadingHTTPServer(("127.0.0.1", port), LatencyProxyHandler)
+    server.daemon_threads = True
+    server.upstream_host = upstream.hostname
+    server.upstream_port = upstream.port or 80
+    server.latency = latency_ms / 1000
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--upstream", default=os.environ.get("STORAGE_EMULATOR_HOST", "http://localhost:4443"))
+    parser.add_argument("--latency-ms", type=float, default=30)
+    parser.add_argument("--port", type=int, default=4444)
+    args = parser.parse_args()
+    url = startProxy(args.upstream, args.latency_ms, args.port)
+    print(f"Proxying {url} -> {args.upstream} with {args.latency_ms}ms latency")
+    threading.Event().wait()
+
+
+if __name__ == "__main__":
+    main()
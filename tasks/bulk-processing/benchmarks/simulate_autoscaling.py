@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""Replay an archive arrival trace through a simulated instance group to compare autoscaling signals.
+
+Every archive of the trace is a message with a size. Instances take messages from one queue, each works on
+--concurrency messages at once, and a message of `size` bytes takes --overhead-seconds plus
+size / --mb-per-sec. New instances serve messages after --startup-seconds.
+
+Every --decision-seconds the autoscaler picks a group size from the subscription's undelivered messages as
+Cloud Monitoring reports them, --metric-delay seconds late:
+- queue-depth: undelivered messages / --target-queue-depth, what the MIG scripts configure by default;
+- backlog-seconds: the estimate the workers write with BACKLOG_METRIC_INTERVAL (backlogSeconds of worker_common.py,
+  fitted to the messages finished so far) / --target-backlog-seconds.
+Like the MIG autoscaler it scales out at once and scales in to the largest recommendation of the last
+--stabilization-seconds. Messages of removed instances go back to the queue.
+
+A trace is a JSON lines file of {"time": seconds, "size": bytes}. --record writes one from the creation times
+and sizes of the archives in an ingest bucket; without --trace a synthetic trace with bursts of small archives
+and a few large ones is used.
+"""
+import argparse
+import json
+import math
+import random
+
+import emulators
+
+POLICIES = ("queue-depth", "backlog-seconds")
+
+
+def recordTrace(bucket_uri, path):
+    from google.cloud import storage
+
+    location = bucket_uri[len("gs://"):] if bucket_uri.startswith("gs://") else bucket_uri
+    bucket_name, _, prefix = location.partition("/")
+    blobs = [blob for blob in storage.Client().list_blobs(bucket_name, prefix=prefix or None)
+             if blob.name.endswith(".zip")]
+    blobs.sort(key=lambda blob: blob.time_created)
+    with open(path, "w") as f:
+        for blob in blobs:
+            f.write(json.dumps({"time": blob.time_created.timestamp(), "size": blob.size}) + "\n")
+    print(f"Recorded {len(blobs)} archives to {path}")
+
+
+def loadTrace(path):
+    with open(path) as f:
+        arrivals = sorted((record["time"], record["size"]) for record in map(json.loads, f) if record)
+    start = arrivals[0][0] if arrivals else 0
+    return [(arrival - start, size) for arrival, size in arrivals]
+
+
+def syntheticTrace(seed, minutes):
+    """Bursts of 2000 archives of ~20 KB every 15 minutes, and 20 archives of ~2 GB twice an hour."""
+    rng = random.Random(seed)
+    arrivals = []
+    for minute in range(0, minutes, 15):
+        arrivals += [(minute * 60 + rng.uniform(0, 60), int(rng.uniform(10, 30) * 1000)) for _ in range(2000)]
+    for minute in range(20, minutes, 30):
+        arrivals += [(minute * 60 + rng.uniform(0, 60), int(rng.uniform(1, 3) * 1e9)) for _ in range(20)]
+    return sorted(arrivals)
+
+
+class Instance:
+    def __init__(self, ready_at):
+        self.ready_at = ready_at
+        # [arrival, size, started, remaining seconds]
+        self.running = []
+
+
+def simulate(trace, policy, args, worker_common):
+    def workSeconds(size):
+        return args.overhead_seconds + size / (args.mb_per_sec * 1e6)
+
+    queue = []
+    instances = [Instance(0) for _ in range(args.min_instances)]
+    samples = []
+    latencies = []
+    undelivered_history = []
+    recommendations = []
+    timeline = []
+    next_arrival = 0
+    instance_seconds = 0
+    redelivered = 0
+    t = 0
+    while next_arrival < len(trace) or queue or any(instance.running for instance in instances):
+        while next_arrival < len(trace) and trace[next_arrival][0] <= t:
+            queue.append(trace[next_arrival])
+            next_arrival += 1
+
+        for instance in instances:
+            if instance.ready_at > t:
+                continue
+            while queue and len(instance.running) < args.concurrency:
+                arrival, size = queue.pop(0)
+                instance.running.append([arrival, size, t, workSeconds(size)])
+            for work in list(instance.running):
+                work[3] -= 1
+                if work[3] <= 0:
+                    instance.running.remove(work)
+                    latencies.append(t + 1 - work[0])
+                    samples.append((work[1], t + 1 - work[2]))
+        instance_seconds += len(instances)
+        undelivered_history.append(len(queue) + sum(len(instance.running) for instance in instances))
+
+        if t % args.decision_seconds == 0:
+            # Cloud Monitoring reports the undelivered messages metric_delay seconds late
+            observed = undelivered_history[max(0, t - args.metric_delay)]
+            size = len(instances)
+            if policy == "queue-depth":
+                size = math.ceil(observed / args.target_queue_depth)
+            else:
+                running = [(work[1], t - work[2]) for instance in instances for work in instance.running]
+                seconds = worker_common.backlogSeconds(observed, running, samples[-1000:], args.concurrency)
+                if seconds is not None:
+                    size = math.ceil(seconds / args.target_backlog_seconds)
+            recommendations.append((t, max(args.min_instances, min(args.max_instances, size))))
+            recommendations = [(at, value) for at, value in recommendations if at > t - args.stabilization_seconds]
+            target = recommendations[-1][1]
+            if target < len(instances):
+                target = max(value for _, value in recommendations)
+            while len(instances) < target:
+                instances.append(Instance(t + args.startup_seconds))
+            if len(instances) > target:
+                # The least busy instances go first, the messages they held are redelivered
+                instances.sort(key=lambda instance: len(instance.running))
+                for instance in instances[:len(instances) - target]:
+                    redelivered += len(instance.running)
+                    queue[:0] = [(work[0], work[1]) for work in instance.running]
+                del instances[:len(instances) - target]
+            timeline.append({"time": t, "undelivered": undelivered_history[-1], "instances": len(instances)})
+        t += 1
+
+    return {
+        "policy": policy,
+        "archives": len(latencies),
+        "max_instances": max(point["instances"] for point in timeline),
+        "instance_hours": round(instance_seconds / 3600, 2),
+        "latency_sec": {f"p{pct}": round(emulators.percentile(latencies, pct), 1) for pct in (50, 95, 99)},
+        "max_latency_sec": round(max(latencies), 1) if latencies else 0,
+        "drained_at_sec": t,
+        "redelivered": redelivered,
+        "timeline": timeline,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--trace", help="JSON lines trace of {time, size} records")
+    parser.add_argument("--record", metavar="GS_URI", help="write the archives of this bucket/prefix to --trace")
+    parser.add_argument("--seed", type=int, default=42, help="seed of the synthetic trace")
+    parser.add_argument("--minutes", type=int, default=60, help="length of the synthetic trace")
+    parser.add_argument("--policies", default=",".join(POLICIES), help="comma separated autoscaling signals")
+    parser.add_argument("--concurrency", type=int, default=10, help="messages per instance, CALLBACK_WORKERS")
+    parser.add_argument("--overhead-seconds", type=float, default=1, help="fixed work per archive")
+    parser.add_argument("--mb-per-sec", type=float, default=2, help="archive MB processed per second per message")
+    parser.add_argument("--startup-seconds", type=int, default=90, help="time until a new instance serves messages")
+    parser.add_argument("--decision-seconds", type=int, default=60, help="time between autoscaling decisions")
+    parser.add_argument("--metric-delay", type=int, default=120, help="age of the undelivered count when it is read")
+    parser.add_argument("--stabilization-seconds", type=int, default=600, help="scale-in stabilization window")
+    parser.add_argument("--min-instances", type=int, default=1)
+    parser.add_argument("--max-instances", type=int, default=10)
+    parser.add_argument("--target-queue-depth", type=float, default=5, help="TARGET_QUEUE_DEPTH")
+    parser.add_argument("--target-backlog-seconds", type=float, default=300, help="TARGET_BACKLOG_SECONDS")
+    parser.add_argument("--output", help="write results with the per-decision timeline as JSON to this file")
+    args = parser.parse_args()
+
+    if args.record:
+        if not args.trace:
+            parser.error("--record needs --trace")
+        recordTrace(args.record, args.trace)
+    trace = loadTrace(args.trace) if args.trace else syntheticTrace(args.seed, args.minutes)
+    worker_common = emulators.importWorker("worker_common")
+
+    results = [simulate(trace, policy, args, worker_common) for policy in args.policies.split(",")]
+    print(f"{len(trace)} archives, {sum(size for _, size in trace) / 1e9:.1f} GB")
+    print(f"{'policy':<17}{'max inst':>9}{'inst hours':>12}{'p50 s':>8}{'p95 s':>8}{'p99 s':>8}{'max s':>8}"
+          f"{'drained s':>11}{'redelivered':>13}")
+    for result in results:
+        pcts = result["latency_sec"]
+        print(f"{result['policy']:<17}{result['max_instances']:>9}{result['instance_hours']:>12}{pcts['p50']:>8}"
+              f"{pcts['p95']:>8}{pcts['p99']:>8}{result['max_latency_sec']:>8}{result['drained_at_sec']:>11}"
+              f"{result['redelivered']:>13}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"settings": vars(args), "archives": len(trace), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,17 @@
 #!/usr/bin/env python3
-import sys
+import argparse
 import json
 import os
-from datetime import datetime, timedelta, timezone
+import sys
+import time
 from random import random
+from zipfile import ZipFile, ZIP_DEFLATED
+
+import numpy as np
+
+# Readings are generated in batches of at most this many values per metric
+BATCH_SIZE = 1000000
+
 
 def generateSensorData(sensor_id):
     data = {}
@@ -13,22 +21,83 @@ def generateSensorData(sensor_id):
     data["pressure"] = round(random() * 100 + 950, 0)
     return data
 
+
+def generateReadings(rng, count):
+    """Generate count readings at once, one NumPy array per metric."""
+    return {
+        "temperature": np.round(rng.random(count) * 40, 0),
+        "humidity": np.round(rng.random(count) * 100, 0),
+        "pressure": np.round(rng.random(count) * 100 + 950, 0),
+    }
+
+
+def generateDocuments(rng, sensors, timestamp):
+    """Yield batches of JSON documents, one per sensor, formatted like json.dumps(generateSensorData())."""
+    # Readings are whole numbers, formatting them as integers is much faster than as floats
+    template = '{"id": %d, "temperature": %d.0, "humidity": %d.0, "pressure": %d.0, "timestamp": ' + json.dumps(timestamp) + '}'
+    for start in range(0, sensors, BATCH_SIZE):
+        count = min(BATCH_SIZE, sensors - start)
+        readings = generateReadings(rng, count)
+        rows = zip(
+            range(start, start + count),
+            readings["temperature"].astype(np.int64).tolist(),
+            readings["humidity"].astype(np.int64).tolist(),
+            readings["pressure"].astype(np.int64).tolist(),
+        )
+        yield start, [template % row for row in rows]
+
+
+def writeFiles(directory, batches):
+    os.makedirs(directory, exist_ok=True)
+    for start, documents in batches:
+        for sensor_id, document in enumerate(documents, start):
+            with open(os.path.join(directory, f"sensor{sensor_id}.json"), "w") as f:
+                f.write(document)
+
+
+def writeJsonLines(path, batches):
+    with open(path, "w") as f:
+        for _, documents in batches:
+            f.write("\n".join(documents))
+            f.write("\n")
+
+
+def writeZip(target, batches):
+    """Write one member per sensor into a zip archive, target is a path or a writable file object."""
+    with ZipFile(target, "w", ZIP_DEFLATED) as archive:
+        for start, documents in batches:
+            for sensor_id, document in enumerate(documents, start):
+                archive.writestr(f"sensor{sensor_id}.json", document)
+
+
 def main():
-    if len(sys.argv) > 1:
-        destination = sys.argv[1]
-    else:
-        destination = "."
-    if not os.path.exists(destination) and os.path.isdir(destination):
+    parser = argparse.ArgumentParser(description="Generate sensor readings for the bulk-processing pipeline.")
+    parser.add_argument("destination", nargs="?", default=".", help="output directory (default: current directory)")
+    parser.add_argument("--sensors", type=int, default=100, help="readings per output file set (default: 100)")
+    parser.add_argument("--files", type=int, default=1, help="number of outputs to generate (default: 1)")
+    parser.add_argument("--seed", type=int, help="random seed, runs with the same seed produce the same values")
+    parser.add_argument("--mode", choices=("files", "jsonl", "zip"), default="files",
+                        help="one JSON file per sensor, one JSON Lines file or one zip archive per output")
+    parser.add_argument("--timestamp", help="timestamp written to every reading (default: now)")
+    args = parser.parse_args()
+
+    destination = args.destination
+    if not os.path.isdir(destination):
         print("Destination directory not exist or not a directory: {}".format(destination))
         sys.exit(1)
-    
-    timestamp = datetime.utcnow().strftime("%s")
-    for i in range(100):
-        data = generateSensorData(i)
-        data["timestamp"] = timestamp
-        f = open(os.path.join(destination, "sensor{}.json".format(i)), "w")
-        f.write(json.dumps(data))
-        f.close()
+
+    rng = np.random.default_rng(args.seed)
+    timestamp = args.timestamp or str(int(time.time()))
+    for i in range(args.files):
+        batches = generateDocuments(rng, args.sensors, timestamp)
+        if args.mode == "files":
+            # A single output keeps the original layout, sensor files directly in the destination
+            writeFiles(destination if args.files == 1 else os.path.join(destination, f"{timestamp}.{i}"), batches)
+        elif args.mode == "jsonl":
+            writeJsonLines(os.path.join(destination, f"{timestamp}.{i}.jsonl"), batches)
+        else:
+            writeZip(os.path.join(destination, f"{timestamp}.{i}.zip"), batches)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from google.cloud import storage
+from requests.adapters import HTTPAdapter
+
+import generator
+
+
+def ingestArchive(bucket, object_name, rng, sensors, timestamp):
+    """Generate one archive and stream it straight into the bucket with a resumable upload."""
+    blob = bucket.blob(object_name)
+    # ZipFile flushes the stream when it is closed, the upload is finalized when the writer is closed
+    with blob.open("wb", ignore_flush=True, content_type="application/zip") as writer:
+        generator.writeZip(writer, generator.generateDocuments(rng, sensors, timestamp))
+    return blob
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate sensor archives and upload them to the ingest bucket.")
+    parser.add_argument("bucket", help="ingest bucket, gs://bucket-name or bucket-name")
+    parser.add_argument("--archives", type=int, default=1, help="number of archives to upload (default: 1)")
+    parser.add_argument("--concurrency", type=int, default=1, help="archives uploaded at once (default: 1)")
+    parser.add_argument("--sensors", type=int, default=100, help="sensors per archive (default: 100)")
+    parser.add_argument("--seed", type=int, help="random seed, runs with the same seed produce the same values")
+    args = parser.parse_args()
+
+    bucket_name = args.bucket[len("gs://"):] if args.bucket.startswith("gs://") else args.bucket
+    bucket_name = bucket_name.rstrip("/")
+    if not bucket_name:
+        print("Bucket name is empty")
+        sys.exit(1)
+
+    storage_client = storage.Client()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=args.concurrency)
+    storage_client._http.mount("https://", adapter)
+    storage_client._http.mount("http://", adapter)
+    bucket = storage_client.bucket(bucket_name)
+
+    # Every archive gets its own generator, seeded from the run seed, so uploads can run in any order
+    seeds = np.random.SeedSequence(args.seed).spawn(args.archives)
+    timestamp = str(int(time.time()))
+    prefix = f"{timestamp}.{os.getpid()}"
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = []
+        for i, seed in enumerate(seeds):
+            object_name = f"{prefix}.zip" if args.archives == 1 else f"{prefix}.{i}.zip"
+            futures.append(executor.submit(
+                ingestArchive, bucket, object_name, np.random.default_rng(seed), args.sensors, timestamp
+            ))
+        for future in futures:
+            blob = future.result()
+            print(f"Uploaded gs://{bucket_name}/{blob.name}")
+    elapsed = time.perf_counter() - start
+    print(f"DONE: {args.archives} archives in {elapsed:.1f}s ({args.archives / elapsed:.1f} archives/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,74 +1,546 @@
 #!/usr/bin/env python3
+import asyncio
+import csv
+import io
+import itertools
 import json
+import mimetypes
 import os
 import sys
-from google.cloud.pubsub import SubscriberClient, PublisherClient
-from google.pubsub_v1.types import Encoding
-from google.cloud import storage
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from prometheus_client import Counter
+from zipfile import ZipFile
+from pathlib import Path
 
+import worker_common
+from worker_common import (
+    MANIFEST_NAME, ArchiveGone, Job, MessageGroup, ProgressWriter, Stage, callback_workers, draining,
+    flow_max_messages, gatherAll, getEnvVar, isNotFound, project_id, runtime, worker_processes,
+)
 
-def getEnvVar(var_name, def_value):
-    result = def_value
-    if var_name in os.environ and os.environ[var_name]:
-        result = os.environ[var_name]
-    return result
-
-project_id = getEnvVar("PROJECT_ID", None)
-if not project_id:
-    print("PROJECT_ID environment variable is not set")
+# unpacked: messages from unpack.py name prefixes of unpacked objects; archive: notifications of the ingest
+# bucket, archives are read and transformed in memory without the unpack stage (fused unpack and transform)
+input_mode = getEnvVar("INPUT", "unpacked")
+if input_mode not in ("unpacked", "archive"):
+    print(f"Unsupported INPUT: {input_mode}")
     sys.exit(1)
-
-subscription_id = getEnvVar("SUBSCRIPTION", "data-unpack")
+subscription_id = getEnvVar("SUBSCRIPTION", "data-ingest" if input_mode == "archive" else "data-unpack")
 topic_id = getEnvVar("TOPIC", "data-transform")
 destination_bucket = getEnvVar("BUCKET", f"{project_id}-transform")
+# csv: one CSV per metric, parquet: one Parquet file per metric, parquet-wide: one Parquet file with all metrics
+output_format = getEnvVar("OUTPUT_FORMAT", "csv")
+if output_format not in ("csv", "parquet", "parquet-wide"):
+    print(f"Unsupported OUTPUT_FORMAT: {output_format}")
+    sys.exit(1)
+download_workers = int(getEnvVar("DOWNLOAD_WORKERS", "8"))
+# In archive mode, archives up to this size are read from memory, larger ones spill to a temporary file
+spool_threshold = int(getEnvVar("SPOOL_THRESHOLD_MB", "64")) * 1024 * 1024
+# In archive mode the unpacked files are only written when AUDIT_BUCKET is set, under <prefix>/ like unpack.py does
+audit_bucket = getEnvVar("AUDIT_BUCKET", None)
+# Storage calls come from the subscriber callback threads and the download pool
+http_pool_size = int(getEnvVar("HTTP_POOL_SIZE", str(callback_workers + download_workers)))
+# With BATCH_MAX_PREFIXES above 1, messages are collected until the batch holds that many prefixes or its first
+# message waited BATCH_MAX_SECONDS, and the whole batch is written as one output per metric
+batch_max_prefixes = int(getEnvVar("BATCH_MAX_PREFIXES", "1"))
+batch_max_seconds = float(getEnvVar("BATCH_MAX_SECONDS", "30"))
+if batch_max_prefixes > 1 and input_mode == "archive":
+    print("BATCH_MAX_PREFIXES is not supported with INPUT=archive")
+    sys.exit(1)
+if runtime == "asyncio" and (batch_max_prefixes > 1 or input_mode == "archive"):
+    print("RUNTIME=asyncio only supports INPUT=unpacked without batching")
+    sys.exit(1)
+if batch_max_prefixes > flow_max_messages:
+    print("BATCH_MAX_PREFIXES is above FLOW_MAX_MESSAGES, batches will only be flushed after BATCH_MAX_SECONDS")
 
+# Shared by all messages, so at most download_workers blob downloads are in flight per process
+download_executor = ThreadPoolExecutor(max_workers=download_workers, thread_name_prefix="download")
+measurements = ("temperature", "humidity", "pressure")
 
-def transformData(src_bucket_name, src_path, dst_bucket_name, dst_path):
-    storage_client = storage.Client()
-    src_bucket = storage_client.bucket(src_bucket_name)
-    dst_bucket = storage_client.bucket(dst_bucket_name)
-    temperature = "\"Sensor ID\",\"Timestamp\",\"Temperature\"\n"
-    humidity = "\"Sensor ID\",\"Timestamp\",\"Humidity\"\n"
-    pressure = "\"Sensor ID\",\"Timestamp\",\"Pressure\"\n"
-
-    for blob in storage_client.list_blobs(src_bucket, prefix=src_path):
-        data = json.loads(blob.download_as_string())
-        temperature += f"\"{data['id']}\",{data['timestamp']}\",\"{data['temperature']}\"\n"
-        humidity += f"\"{data['id']}\",\"{data['timestamp']}\",\"{data['humidity']}\"\n"
-        pressure += f"\"{data['id']}\",\"{data['timestamp']}\",\"{data['pressure']}\"\n"
-    blob = dst_bucket.blob(f"temperature/{dst_path}.csv")
-    blob.upload_from_string(temperature)
-    blob = dst_bucket.blob(f"humidity/{dst_path}.csv")
-    blob.upload_from_string(humidity)
-    blob = dst_bucket.blob(f"pressure/{dst_path}.csv")
-    blob.upload_from_string(pressure)
-
-    publisher_client = PublisherClient()
-    topic_path = publisher_client.topic_path(project_id, topic_id)
+
+# Phases of a message: list, download, build, upload, publish and total (everything but waiting for the publish)
+stage = Stage("transform", http_pool_size)
+bytes_in = Counter("transform_bytes_in", "Sensor data bytes downloaded")
+bytes_out = Counter("transform_bytes_out", "Output bytes uploaded")
+sources_read = Counter("transform_sources", "Prefixes read, by where their object list came from", ["source"])
+
+
+def sourceBlobs(storage_client, source):
+    """Yield the blobs of an unpacked prefix, from the manifest sent by unpack.py or else by listing the prefix."""
+    bucket = storage_client.bucket(source["bucket"])
+    objects = source.get("objects")
+    if objects is not None:
+        sources_read.labels("message").inc()
+    elif "manifest" in source:
+        sources_read.labels("manifest").inc()
+        objects = json.loads(bucket.blob(source["manifest"]).download_as_bytes())["objects"]
+    else:
+        # Messages from unpack workers without manifests, and backfills. A manifest left by an earlier run is no member
+        sources_read.labels("listing").inc()
+        for blob in storage_client.list_blobs(bucket, prefix=f"{source['path']}/" if source["path"] else None):
+            if blob.name.rpartition("/")[2] != MANIFEST_NAME:
+                yield blob
+        return
+    for entry in objects:
+        # The exact generation unpack.py wrote is read, even if the object was overwritten since
+        yield bucket.blob(entry["name"], generation=entry["generation"])
+
+
+def nextDocument(pending, waits, job):
+    start = time.perf_counter()
+    data = pending.popleft().result()
+    waits["download"] += time.perf_counter() - start
+    bytes_in.inc(len(data))
+    job.progress()
+    return json.loads(data)
+
+
+def downloadData(blobs, waits, job):
+    """Download and parse blobs concurrently, yielding them in listing order.
+
+    Seconds spent waiting for the listing and for downloads are added to waits["list"] and waits["download"].
+    """
+    pending = deque()
+    blobs = iter(blobs)
+    while True:
+        start = time.perf_counter()
+        blob = next(blobs, None)
+        waits["list"] += time.perf_counter() - start
+        if blob is None:
+            break
+        pending.append(download_executor.submit(blob.download_as_bytes))
+        # Only a bounded window of downloads is kept, so memory does not grow with the number of blobs
+        if len(pending) >= 2 * download_workers:
+            yield nextDocument(pending, waits, job)
+    while pending:
+        yield nextDocument(pending, waits, job)
+
+
+def buildCsv(dst_path, documents):
+    """Return (object name, data, content type) of the CSV files, one per metric."""
+    outputs = {}
+    writers = {}
+    for metric in measurements:
+        outputs[metric] = io.StringIO()
+        writers[metric] = csv.writer(outputs[metric], quoting=csv.QUOTE_ALL, lineterminator="\n")
+        writers[metric].writerow(["Sensor ID", "Timestamp", metric.capitalize()])
+
+    for data in documents:
+        for metric in measurements:
+            writers[metric].writerow([data["id"], data["timestamp"], data[metric]])
+    return [(f"{metric}/{dst_path}.csv", outputs[metric].getvalue(), None) for metric in measurements]
+
+
+def buildParquet(dst_path, documents, wide=False):
+    """Return (object name, data, content type) of the Parquet files, one per metric or a single wide one."""
+    # pyarrow is only needed (and only imported) when Parquet output is enabled
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    columns = {"id": [], "timestamp": []}
+    for metric in measurements:
+        columns[metric] = []
+    for data in documents:
+        for name, column in columns.items():
+            column.append(data[name])
+
+    # Columns are converted in one pass each instead of row by row
+    sensor_ids = pa.array(columns["id"], type=pa.int64())
+    timestamps = pa.array(columns["timestamp"]).cast(pa.int64()).cast(pa.timestamp("s"))
+    values = {metric: pa.array(columns[metric], type=pa.float64()) for metric in measurements}
+    if wide:
+        tables = {"readings": pa.table({"sensor_id": sensor_ids, "timestamp": timestamps, **values})}
+    else:
+        tables = {}
+        for metric in measurements:
+            tables[metric] = pa.table({"sensor_id": sensor_ids, "timestamp": timestamps, metric: values[metric]})
+    outputs = []
+    for name, table in tables.items():
+        buffer = pa.BufferOutputStream()
+        pq.write_table(table, buffer)
+        outputs.append((f"{name}/{dst_path}.parquet", buffer.getvalue().to_pybytes(), "application/vnd.apache.parquet"))
+    return outputs
+
+
+def transformData(src_bucket_name, src_path, dst_bucket_name, dst_path, job=None, publish=True):
+    """Transform the unpacked data and return the future of the message published to the transform topic."""
+    sources = [{"bucket": src_bucket_name, "path": src_path}]
+    return transformPrefixes(sources, dst_bucket_name, dst_path, job, publish=publish)
+
+
+def transformPrefixes(sources, dst_bucket_name, dst_path, job=None, manifest=None, publish=True):
+    """Transform the sources into one output per metric and return the publish future.
+
+    Sources are unpack messages: bucket, path and optionally the objects or the manifest object unpack.py wrote.
+    A batch manifest, if given, is written as manifests/<dst_path>.json and referenced by the published message.
+    With publish=False (backfills) nothing is published, the returned future is done and holds the message data.
+    """
+    # Without a job from the subscriber callback nobody watches the progress
+    job = job or Job(None)
+    storage_client = stage.getStorageClient()
+    waits = {"list": 0.0, "download": 0.0}
+    documents = itertools.chain.from_iterable(
+        downloadData(sourceBlobs(storage_client, source), waits, job) for source in sources
+    )
+    return transformDocuments(documents, waits, dst_bucket_name, dst_path, job, manifest, publish)
+
+
+def archiveDocuments(archive, prefix, job):
+    """Yield the parsed sensor files of an archive, copying them to the audit bucket when it is set."""
+    bucket = stage.getStorageClient().bucket(audit_bucket) if audit_bucket else None
+    pending = deque()
+    for member in archive.infolist():
+        # Only top level files are read, like unpack.py unpacks them
+        if member.is_dir() or "/" in member.filename:
+            continue
+        data = archive.read(member)
+        if bucket is not None:
+            content_type, _ = mimetypes.guess_type(member.filename)
+            blob = bucket.blob(f"{prefix}/{member.filename}")
+            pending.append(download_executor.submit(blob.upload_from_string, data, content_type=content_type))
+            # Only a bounded window of audit copies is kept in memory
+            if len(pending) >= 2 * download_workers:
+                pending.popleft().result()
+        job.progress()
+        yield json.loads(data)
+    # Audit copies are part of the message's work, the outputs are only published once they all exist
+    while pending:
+        pending.popleft().result()
+
+
+def transformArchive(src_bucket_name, src_object_name, dst_bucket_name, dst_path, job=None, generation=None):
+    """Transform the sensor files of an archive without the unpack stage and return the publish future.
+
+    generation, if given, is the archive generation to read, otherwise the current one is.
+    """
+    job = job or Job(None)
+    # The generation the notification is about is read, not an archive uploaded to the same name since
+    blob = stage.getStorageClient().bucket(src_bucket_name).blob(src_object_name, generation=generation)
+    download_start = time.perf_counter()
+    try:
+        blob.reload()
+    except Exception as e:
+        if generation and isNotFound(e):
+            raise ArchiveGone(f"generation {generation} no longer exists") from e
+        raise
+    if blob.size <= spool_threshold:
+        buffer = io.BytesIO()
+    else:
+        buffer = tempfile.TemporaryFile()
+    with buffer:
+        blob.download_to_file(ProgressWriter(buffer, job))
+        waits = {"download": time.perf_counter() - download_start}
+        bytes_in.inc(blob.size)
+        buffer.seek(0)
+        with ZipFile(buffer) as archive:
+            return transformDocuments(archiveDocuments(archive, dst_path, job), waits, dst_bucket_name, dst_path, job)
+
+
+def transformDocuments(documents, waits, dst_bucket_name, dst_path, job, manifest=None, publish=True):
+    """Build and upload the outputs of the documents and return the publish future."""
+    outputs, data = buildOutputs(documents, waits, dst_bucket_name, dst_path, manifest)
+    dst_bucket = stage.getStorageClient().bucket(dst_bucket_name)
+    with stage.timedPhase("upload"):
+        for object_name, content, content_type in outputs:
+            job.check()
+            dst_bucket.blob(object_name).upload_from_string(content, content_type=content_type)
+            bytes_out.inc(len(content))
+            job.progress()
+    if not publish:
+        future = Future()
+        future.set_result(json.dumps(data).encode("utf-8"))
+        return future
+    # A job cancelled after its last upload must not publish, its message was already nacked
+    job.check()
+    return publishTransformed(data)
+
+
+def buildOutputs(documents, waits, dst_bucket_name, dst_path, manifest=None):
+    """Return the outputs of the documents as (object name, data, content type) and the message to publish.
+
+    waits holds the seconds spent waiting for input per phase. Waiting that overlaps with building the
+    outputs is subtracted from the build phase.
+    """
+    build_start = time.perf_counter()
+    waited = sum(waits.values())
+    if output_format == "csv":
+        outputs = buildCsv(dst_path, documents)
+    else:
+        outputs = buildParquet(dst_path, documents, wide=output_format == "parquet-wide")
+    build_seconds = time.perf_counter() - build_start - (sum(waits.values()) - waited)
+    for phase, seconds in waits.items():
+        stage.recordPhase(phase, seconds)
+    stage.recordPhase("build", build_seconds)
     data = {"bucket": dst_bucket_name, "path": dst_path}
+    if manifest is not None:
+        data["manifest"] = f"manifests/{dst_path}.json"
+        # The manifest is uploaded last, so it only exists when the outputs it describes do
+        outputs.append((data["manifest"], json.dumps(manifest), "application/json"))
+    return outputs, data
+
+
+def publishTransformed(data):
+    publisher_client = stage.getPublisherClient()
+    topic_path = publisher_client.topic_path(project_id, topic_id)
     data_str = json.dumps(data)
     data = data_str.encode("utf-8")
+    publish_start = time.perf_counter()
     future = publisher_client.publish(topic_path, data)
-    print(f"Published message ID: {future.result()}")
+    # Publishing completes on the publisher's thread, so it is only recorded in the histogram
+    future.add_done_callback(lambda f: stage.phase_seconds.labels("publish").observe(time.perf_counter() - publish_start))
+    return future
+
+
+async def sourceObjectsAsync(storage_client, source):
+    """Return the name and generation of the objects of an unpacked prefix, like sourceBlobs."""
+    objects = source.get("objects")
+    if objects is not None:
+        sources_read.labels("message").inc()
+        return objects
+    if "manifest" in source:
+        sources_read.labels("manifest").inc()
+        async with worker_common.request_slots:
+            return json.loads(await storage_client.download(source["bucket"], source["manifest"]))["objects"]
+    sources_read.labels("listing").inc()
+    params = {"prefix": f"{source['path']}/"} if source["path"] else {}
+    objects = []
+    while True:
+        async with worker_common.request_slots:
+            page = await storage_client.list_objects(source["bucket"], params=params)
+        objects.extend(
+            {"name": item["name"], "generation": item["generation"]} for item in page.get("items", [])
+            if item["name"].rpartition("/")[2] != MANIFEST_NAME
+        )
+        if not page.get("nextPageToken"):
+            return objects
+        params = {**params, "pageToken": page["nextPageToken"]}
+
+
+async def downloadDocumentAsync(storage_client, bucket_name, entry, job):
+    async with worker_common.request_slots:
+        # The public download methods take no generation, the listed or unpacked one is read like sourceBlobs does
+        data = await storage_client._download(
+            bucket_name, entry["name"], params={"alt": "media", "generation": str(entry["generation"])}
+        )
+    bytes_in.inc(len(data))
+    job.progress()
+    return json.loads(data)
+
+
+async def transformPrefixesAsync(sources, dst_bucket_name, dst_path, job=None, manifest=None):
+    """transformPrefixes for the asyncio runtime, the same outputs and message with Cloud Storage calls on the event loop."""
+    job = job or Job(None)
+    storage_client = await stage.getAioStorageClient()
+    waits = {"list": 0.0, "download": 0.0}
+    documents = []
+    for source in sources:
+        start = time.perf_counter()
+        objects = await sourceObjectsAsync(storage_client, source)
+        waits["list"] += time.perf_counter() - start
+        start = time.perf_counter()
+        documents.extend(await gatherAll(
+            downloadDocumentAsync(storage_client, source["bucket"], entry, job) for entry in objects
+        ))
+        waits["download"] += time.perf_counter() - start
+    # Building the outputs is CPU bound, it runs on a thread so the event loop keeps serving the other messages
+    outputs, data = await asyncio.to_thread(buildOutputs, documents, waits, dst_bucket_name, dst_path, manifest)
+    with stage.timedPhase("upload"):
+        for object_name, content, content_type in outputs:
+            job.check()
+            async with worker_common.request_slots:
+                # upload_from_string's default for text outputs
+                await storage_client.upload(dst_bucket_name, object_name, content, content_type=content_type or "text/plain")
+            bytes_out.inc(len(content))
+            job.progress()
+    # A job cancelled after its last upload must not publish, its message was already nacked
+    job.check()
+    return publishTransformed(data)
+
+
+async def transformDataAsync(src_bucket_name, src_path, dst_bucket_name, dst_path, job=None):
+    """transformData for the asyncio runtime."""
+    return await transformPrefixesAsync([{"bucket": src_bucket_name, "path": src_path}], dst_bucket_name, dst_path, job)
+
+
+# Messages waiting for the current batch to be flushed, as (message, key) pairs
+batch = []
+batch_lock = threading.Lock()
+batch_timer = None
+batch_ids = itertools.count()
+
+
+def addToBatch(message, key):
+    global batch, batch_timer
+    with batch_lock:
+        batch.append((message, key))
+        if len(batch) < batch_max_prefixes:
+            if batch_timer is None:
+                batch_timer = threading.Timer(batch_max_seconds, flushTimedOut)
+                batch_timer.daemon = True
+                batch_timer.start()
+            return
+        entries, batch = batch, []
+        batch_timer.cancel()
+        batch_timer = None
+    # A full batch is written on the callback thread that completed it
+    flushBatch(entries)
+
+
+def flushTimedOut():
+    global batch, batch_timer
+    with batch_lock:
+        entries, batch = batch, []
+        batch_timer = None
+    if entries:
+        flushBatch(entries)
 
 
+def flushBatch(entries):
+    """Write the batch as one output per metric, its messages are acked together once it is published."""
+    group = MessageGroup([message for message, _ in entries])
+    keys = [key for _, key in entries]
+    dst_path = f"batch-{int(time.time())}-{os.getpid()}-{next(batch_ids)}"
+    manifest = {
+        "path": dst_path,
+        "prefixes": [{"bucket": bucket, "path": path, "generation": generation} for bucket, path, generation in keys],
+    }
+    print(f"Transforming {len(keys)} prefixes to gs://{destination_bucket}/{dst_path}")
+    job = stage.startJob(group, keys)
+    with stage.span("transform-batch"):
+        try:
+            with stage.timedPhase("total"):
+                sources = [json.loads(message.data) for message, _ in entries]
+                future = transformPrefixes(sources, destination_bucket, dst_path, job, manifest)
+        except Exception as e:
+            transformFailed(job, f"batch {dst_path}", e)
+            return
+    future.add_done_callback(lambda f: stage.onPublished(job, f))
+
+
+def transformFailed(job, source, e):
+    print(f"Transforming {source} failed: {e}")
+    stage.failJob(job, e)
+
+
+def skipDuplicate(message, key, source):
+    """Settle the message and return True if its work is already done or running, else claim the key."""
+    if draining.is_set():
+        # The worker is shutting down, the message is redelivered to another one
+        message.nack()
+        stage.messages.labels("nacked").inc()
+        return True
+    skipped = stage.claim(key)
+    if not skipped:
+        return False
+    stage.duplicates.labels(skipped).inc()
+    if skipped == "in-progress":
+        # Acking would lose the message if the running attempt fails, so it is redelivered later instead
+        print(f"{source} is being transformed, message will be redelivered")
+        message.nack()
+        stage.messages.labels("nacked").inc()
+    else:
+        print(f"{source} was already transformed ({skipped}), skipping")
+        message.ack()
+        stage.messages.labels("acked").inc()
+    return True
+
+
+def processMessage(message, key, source, dst_path, work):
+    """Run work(job) for a claimed message, it is acked once the future work returns is published."""
+    print(f"Transforming {source} to gs://{destination_bucket}/{dst_path}")
+    job = stage.startJob(message, [key])
+    with stage.span("transform"):
+        try:
+            with stage.timedPhase("total"):
+                future = work(job)
+        except Exception as e:
+            transformFailed(job, source, e)
+            return
+    future.add_done_callback(lambda f: stage.onPublished(job, f))
+
+
+async def processMessageAsync(message, key, source, dst_path, work):
+    """processMessage for the asyncio runtime, work(job) is a coroutine returning the publish future."""
+    print(f"Transforming {source} to gs://{destination_bucket}/{dst_path}")
+    job = stage.startJob(message, [key])
+    with stage.span("transform"):
+        try:
+            with stage.timedPhase("total"):
+                future = await work(job)
+        except Exception as e:
+            transformFailed(job, source, e)
+            return
+    future.add_done_callback(lambda f: stage.onPublished(job, f))
+
 
 def callback(message):
     data = json.loads(message.data)
     bucket = data["bucket"]
     path = data["path"]
-    print(f"Transforming gs://{bucket}/{path} to gs://{destination_bucket}/{path}")
-    transformData(bucket, path, destination_bucket, path)
-    message.ack()
+    # The archive generation is only known for messages published by unpack.py
+    key = (bucket, path, message.attributes.get("generation", ""))
+    if skipDuplicate(message, key, f"gs://{bucket}/{path}"):
+        return
+    if batch_max_prefixes > 1:
+        addToBatch(message, key)
+        return
+    processMessage(
+        message, key, f"gs://{bucket}/{path}", path,
+        lambda job: transformPrefixes([data], destination_bucket, path, job),
+    )
+
+
+async def callbackAsync(message):
+    data = json.loads(message.data)
+    bucket = data["bucket"]
+    path = data["path"]
+    key = (bucket, path, message.attributes.get("generation", ""))
+    # Checking the dedup marker is a blocking Cloud Storage call
+    if await asyncio.to_thread(skipDuplicate, message, key, f"gs://{bucket}/{path}"):
+        return
+    await processMessageAsync(
+        message, key, f"gs://{bucket}/{path}", path,
+        lambda job: transformPrefixesAsync([data], destination_bucket, path, job),
+    )
+
+
+def archiveCallback(message):
+    if message.attributes.get("eventType") != "OBJECT_FINALIZE":
+        message.ack()
+        stage.messages.labels("acked").inc()
+        return
+    bucket = message.attributes.get("bucketId")
+    object_name = message.attributes.get("objectId")
+    if not object_name.endswith(".zip"):
+        # Anything else in the bucket never opens as an archive, nacking it would only redeliver it forever
+        print(f"gs://{bucket}/{object_name} is not a .zip archive, skipping")
+        message.ack()
+        stage.messages.labels("acked").inc()
+        return
+    prefix = Path(object_name).stem
+    generation = message.attributes.get("objectGeneration", "")
+    key = (bucket, object_name, generation)
+    if skipDuplicate(message, key, f"gs://{bucket}/{object_name}"):
+        return
+    processMessage(
+        message, key, f"gs://{bucket}/{object_name}", prefix,
+        lambda job: transformArchive(bucket, object_name, destination_bucket, prefix, job, generation or None),
+    )
 
 
 def main():
-    subscriber = SubscriberClient()
-    subscription_path = subscriber.subscription_path(project_id, subscription_id)
-    streaming_pull_future = subscriber.subscribe(subscription_path, callback=callback)
-    print(f"Listening for messages on {subscription_path}..\n")
-    with subscriber:
-        streaming_pull_future.result()
+    if worker_processes > 1:
+        stage.supervise(os.path.abspath(__file__))
+        return
+    stage.run(
+        subscription_id, archiveCallback if input_mode == "archive" else callback, callbackAsync,
+        # A pending batch is written now instead of waiting for BATCH_MAX_SECONDS
+        before_drain=flushTimedOut,
+    )
+
 
 if __name__ == "__main__":
     main()
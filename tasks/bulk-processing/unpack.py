@@ -1,76 +1,441 @@
 #!/usr/bin/env python3
+import asyncio
+import base64
+import io
 import json
+import mimetypes
 import os
 import sys
 import tempfile
-from google.cloud.pubsub import SubscriberClient, PublisherClient
-from google.pubsub_v1.types import Encoding
-from google.cloud import storage
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_EXCEPTION
+from prometheus_client import Counter
 from zipfile import ZipFile
 from pathlib import Path
 
-def getEnvVar(var_name, def_value):
-    result = def_value
-    if var_name in os.environ and os.environ[var_name]:
-        result = os.environ[var_name]
-    return result
-
-project_id = getEnvVar("PROJECT_ID", None)
-if not project_id:
-    print("PROJECT_ID environment variable is not set")
-    sys.exit(1)
+import worker_common
+from worker_common import (
+    MANIFEST_NAME, ArchiveGone, Job, ProgressWriter, Stage, archiveSize, callback_workers, draining, gatherAll,
+    getEnvVar, isNotFound, project_id, worker_processes,
+)
 
 subscription_id = getEnvVar("SUBSCRIPTION", "data-ingest")
 topic_id = getEnvVar("TOPIC", "data-unpack")
 destination_bucket = getEnvVar("BUCKET", f"{project_id}-unpack")
+# Archives up to this size are unpacked from memory, larger ones spill to a temporary file
+spool_threshold = int(getEnvVar("SPOOL_THRESHOLD_MB", "64")) * 1024 * 1024
+upload_workers = int(getEnvVar("UPLOAD_WORKERS", "8"))
+upload_retries = int(getEnvVar("UPLOAD_RETRIES", "3"))
+# upload: every member is uploaded. skip: members whose destination object already has the same size and content
+# are not uploaded again, so replaying archives costs a list request per 1000 members instead of the uploads
+unchanged_members = getEnvVar("UNCHANGED_MEMBERS", "upload")
+if unchanged_members not in ("upload", "skip"):
+    print(f"Unsupported UNCHANGED_MEMBERS: {unchanged_members}")
+    sys.exit(1)
+# Custom metadata key of the CRC-32 the zip central directory records for a member, set on every uploaded member
+CRC32_METADATA = "zip-crc32"
+# The manifest of the uploaded members is sent in the message up to this size, bigger ones are written to
+# <prefix>/.manifest.json in the destination bucket and the message only references it
+manifest_inline_max_bytes = int(getEnvVar("MANIFEST_INLINE_MAX_BYTES", str(256 * 1024)))
+# Storage calls come from the subscriber callback threads and the upload pool
+http_pool_size = int(getEnvVar("HTTP_POOL_SIZE", str(callback_workers + upload_workers)))
+
+# Shared by all messages, so at most upload_workers member uploads are in flight per process
+upload_executor = ThreadPoolExecutor(max_workers=upload_workers, thread_name_prefix="upload")
+
+
+# Phases of a message: download, list (with UNCHANGED_MEMBERS=skip), upload, publish and total (everything but
+# waiting for the publish)
+stage = Stage("unpack", http_pool_size)
+bytes_in = Counter("unpack_bytes_in", "Archive bytes downloaded")
+bytes_out = Counter("unpack_bytes_out", "Member bytes uploaded")
+duplicate_bytes = Counter("unpack_duplicate_bytes", "Archive bytes that were not downloaded again")
+unchanged = Counter(
+    "unpack_unchanged_members", "Members not uploaded because their object has the same content", ["check"]
+)
+unchanged_bytes = Counter("unpack_unchanged_bytes", "Member bytes not uploaded because their object has the same content")
+
+
+def existingObjects(dst_bucket, dst_object_prefix):
+    """Size, CRC32C, custom metadata and generation of the objects directly under the prefix, by name.
+
+    One list request returns up to 1000 objects, instead of a metadata request per member.
+    """
+    blobs = dst_bucket.client.list_blobs(
+        dst_bucket,
+        prefix=f"{dst_object_prefix}/" if dst_object_prefix else None,
+        delimiter="/",
+        fields="items(name,size,crc32c,metadata,generation),nextPageToken",
+    )
+    return {
+        blob.name: {
+            "size": blob.size, "crc32c": blob.crc32c, "metadata": blob.metadata or {}, "generation": blob.generation,
+        }
+        for blob in blobs
+    }
+
+
+def memberCrc32(member):
+    return f"{member.CRC:08x}"
+
+
+def memberUnchanged(archive, member, existing):
+    """Return the check that found the object to hold the member's content, or None when it has to be uploaded.
+
+    Objects uploaded by this worker carry the member's zip CRC-32, for them the central directory is enough.
+    Other objects are compared by the CRC32C Cloud Storage keeps, computed over the decompressed member.
+    """
+    if existing is None or existing["size"] != member.file_size:
+        return None
+    if existing["metadata"].get(CRC32_METADATA) == memberCrc32(member):
+        return "crc32"
+    if not existing["crc32c"]:
+        return None
+    import google_crc32c
+
+    checksum = google_crc32c.Checksum()
+    with archive.open(member) as datafile:
+        for chunk in iter(lambda: datafile.read(1024 * 1024), b""):
+            checksum.update(chunk)
+    if base64.b64encode(checksum.digest()).decode("ascii") == existing["crc32c"]:
+        return "crc32c"
+    return None
+
+
+def skipMember(member, existing, check, job):
+    unchanged.labels(check).inc()
+    unchanged_bytes.inc(member.file_size)
+    job.progress()
+    return {"name": existing["name"], "size": existing["size"], "generation": existing["generation"]}
+
+
+def unpackedMembers(archive, dst_object_prefix):
+    """Yield the members to unpack and their object names."""
+    for member in archive.infolist():
+        # Only top level files are unpacked, nested directories are skipped
+        if member.is_dir() or "/" in member.filename:
+            continue
+        # A member named like the manifest would overwrite it, or be read as the manifest of a replay
+        if member.filename == MANIFEST_NAME:
+            print(f"Skipping member {member.filename}, the name is reserved for the manifest")
+            continue
+        if dst_object_prefix:
+            yield member, f"{dst_object_prefix}/{member.filename}"
+        else:
+            yield member, member.filename
+
 
+def uploadMember(archive, member, blob, job, existing=None):
+    check = memberUnchanged(archive, member, existing)
+    if check is not None:
+        return skipMember(member, dict(existing, name=blob.name), check, job)
+    content_type, _ = mimetypes.guess_type(member.filename)
+    blob.metadata = {CRC32_METADATA: memberCrc32(member)}
+    for attempt in range(upload_retries + 1):
+        job.check()
+        try:
+            with archive.open(member) as datafile:
+                blob.upload_from_file(datafile, size=member.file_size, content_type=content_type)
+            break
+        except Exception as e:
+            if attempt == upload_retries:
+                raise
+            print(f"Upload of gs://{blob.bucket.name}/{blob.name} failed: {e}, retrying..")
+            time.sleep(0.5 * 2 ** attempt)
+    bytes_out.inc(member.file_size)
+    # Outside the retries, the JobCancelled of a cancelled job is not taken for a failed upload
+    job.progress()
+    return {"name": blob.name, "size": blob.size, "generation": blob.generation}
 
-def unpackArchive(src_bucket_name, src_object_name, dst_bucket_name, dst_object_prefix):
+
+def unpackArchive(
+    src_bucket_name, src_object_name, dst_bucket_name, dst_object_prefix, job=None, publish=True, generation=None
+):
+    """Unpack the archive and return the future of the message published to the unpack topic.
+
+    With publish=False (backfills) nothing is published, the returned future is done and holds the message data.
+    generation, if given, is the archive generation to read, otherwise the current one is.
+    """
+    # Without a job from the subscriber callback nobody watches the progress
+    job = job or Job(None)
     print(f"Extracting gs://{src_bucket_name}/{src_object_name} to gs://{dst_bucket_name}/{dst_object_prefix}")
-    storage_client = storage.Client()
+    storage_client = stage.getStorageClient()
     src_bucket = storage_client.bucket(src_bucket_name)
-    blob = src_bucket.blob(src_object_name)
-    with tempfile.TemporaryDirectory() as tmpdir:
-        local_file = os.path.join(tmpdir, "data.zip")
-        blob.download_to_filename(local_file)
-        with ZipFile(local_file) as archive:
-            archive.extractall(path=tmpdir)
-        os.remove(local_file)
-        dst_bucket = storage_client.bucket(dst_bucket_name)
-        for datafile in os.listdir(tmpdir):
-            if os.path.isfile(os.path.join(tmpdir,datafile)):
-                if dst_object_prefix:
-                    dst_object_name = f"{dst_object_prefix}/{datafile}"
-                else:
-                    dst_object_name = datafile
+    # The generation the notification is about is read, not an archive uploaded to the same name since
+    blob = src_bucket.blob(src_object_name, generation=generation)
+    dst_bucket = storage_client.bucket(dst_bucket_name)
+    with stage.timedPhase("download"):
+        try:
+            blob.reload()
+        except Exception as e:
+            if generation and isNotFound(e):
+                raise ArchiveGone(f"generation {generation} no longer exists") from e
+            raise
+        if blob.size <= spool_threshold:
+            buffer = io.BytesIO()
+        else:
+            buffer = tempfile.TemporaryFile()
+        blob.download_to_file(ProgressWriter(buffer, job))
+    size = job.size = blob.size
+    bytes_in.inc(size)
+    generation = str(blob.generation)
+    existing = {}
+    if unchanged_members == "skip":
+        with stage.timedPhase("list"):
+            existing = existingObjects(dst_bucket, dst_object_prefix)
+    with buffer:
+        buffer.seek(0)
+        with ZipFile(buffer) as archive:
+            futures = []
+            for member, dst_object_name in unpackedMembers(archive, dst_object_prefix):
                 blob = dst_bucket.blob(dst_object_name)
-                blob.upload_from_filename(os.path.join(tmpdir, datafile))
-    publisher_client = PublisherClient()
+                futures.append(
+                    upload_executor.submit(uploadMember, archive, member, blob, job, existing.get(dst_object_name))
+                )
+            # The archive is done only when every member is uploaded, the first failure fails the message
+            with stage.timedPhase("upload"):
+                done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+                for future in not_done:
+                    future.cancel()
+                wait(not_done)
+            for future in done:
+                future.result()
+            objects = [future.result() for future in futures]
+    data, manifest = unpackMessage(dst_object_prefix, objects, size)
+    if manifest is not None:
+        manifest_name, manifest_data = manifest
+        dst_bucket.blob(manifest_name).upload_from_string(manifest_data, content_type="application/json")
+    if not publish:
+        future = Future()
+        future.set_result(data)
+        return future
+    # A job cancelled after its last upload must not publish, its message was already nacked
+    job.check()
+    return publishUnpacked(data, generation)
+
+
+def unpackMessage(dst_object_prefix, objects, size):
+    """Return the data of the unpack message and the (name, data) of the manifest to write first, or None."""
+    # The manifest lets the transform worker read the members without listing the prefix. The archive size lets
+    # it estimate the work of the messages it holds
+    data = {"bucket": destination_bucket, "path": dst_object_prefix, "size": size}
+    data_str = json.dumps({**data, "objects": objects})
+    if len(data_str) <= manifest_inline_max_bytes:
+        return data_str.encode("utf-8"), None
+    manifest_name = f"{dst_object_prefix}/{MANIFEST_NAME}" if dst_object_prefix else MANIFEST_NAME
+    data_str = json.dumps({**data, "manifest": manifest_name})
+    return data_str.encode("utf-8"), (manifest_name, json.dumps({"objects": objects}))
+
+
+def publishUnpacked(data, generation):
+    publisher_client = stage.getPublisherClient()
     topic_path = publisher_client.topic_path(project_id, topic_id)
-    data = {"bucket": destination_bucket, "path": dst_object_prefix}
-    data_str = json.dumps(data)
-    data = data_str.encode("utf-8")
-    future = publisher_client.publish(topic_path, data)
-    print(f"Published message ID: {future.result()}")
+    publish_start = time.perf_counter()
+    # The generation lets the transform worker tell a re-uploaded archive from a redelivery
+    future = publisher_client.publish(topic_path, data, generation=generation)
+    # Publishing completes on the publisher's thread, so it is only recorded in the histogram
+    future.add_done_callback(lambda f: stage.phase_seconds.labels("publish").observe(time.perf_counter() - publish_start))
+    return future
 
 
+async def existingObjectsAsync(storage_client, dst_bucket_name, dst_object_prefix):
+    """existingObjects for the asyncio runtime."""
+    params = {"delimiter": "/", "fields": "items(name,size,crc32c,metadata,generation),nextPageToken"}
+    if dst_object_prefix:
+        params["prefix"] = f"{dst_object_prefix}/"
+    objects = {}
+    while True:
+        async with worker_common.request_slots:
+            page = await storage_client.list_objects(dst_bucket_name, params=params)
+        for item in page.get("items", []):
+            objects[item["name"]] = {
+                "size": int(item["size"]), "crc32c": item.get("crc32c"), "metadata": item.get("metadata", {}),
+                "generation": int(item["generation"]),
+            }
+        if not page.get("nextPageToken"):
+            return objects
+        params["pageToken"] = page["nextPageToken"]
 
-def callback(message):
-    if message.attributes.get("eventType") == "OBJECT_FINALIZE":
-        source_bucket = message.attributes.get("bucketId")
-        source_object = message.attributes.get("objectId")
-        destination_prefix = Path(source_object).stem
-        unpackArchive(source_bucket, source_object, destination_bucket, destination_prefix)
+
+async def uploadMemberAsync(storage_client, archive, member, dst_bucket_name, dst_object_name, job, existing=None):
+    if existing is not None:
+        # Reading a member for its CRC32C is CPU work, it is kept off the event loop
+        check = await asyncio.to_thread(memberUnchanged, archive, member, existing)
+        if check is not None:
+            return skipMember(member, dict(existing, name=dst_object_name), check, job)
+    content_type, _ = mimetypes.guess_type(member.filename)
+    for attempt in range(upload_retries + 1):
+        job.check()
+        try:
+            async with worker_common.request_slots:
+                # Members are read once a request slot is free, so only the ones being uploaded are held in memory.
+                # Decompressing is CPU work, it is kept off the event loop
+                data = await asyncio.to_thread(archive.read, member)
+                result = await storage_client.upload(
+                    dst_bucket_name, dst_object_name, data, content_type=content_type,
+                    metadata={"metadata": {CRC32_METADATA: memberCrc32(member)}},
+                )
+            break
+        except Exception as e:
+            if attempt == upload_retries:
+                raise
+            print(f"Upload of gs://{dst_bucket_name}/{dst_object_name} failed: {e}, retrying..")
+            await asyncio.sleep(0.5 * 2 ** attempt)
+    bytes_out.inc(member.file_size)
+    # Outside the retries, the JobCancelled of a cancelled job is not taken for a failed upload
+    job.progress()
+    return {"name": result["name"], "size": int(result["size"]), "generation": int(result["generation"])}
+
+
+async def unpackArchiveAsync(
+    src_bucket_name, src_object_name, dst_bucket_name, dst_object_prefix, job=None, generation=None
+):
+    """unpackArchive for the asyncio runtime, the same objects and message with Cloud Storage calls on the event loop."""
+    job = job or Job(None)
+    print(f"Extracting gs://{src_bucket_name}/{src_object_name} to gs://{dst_bucket_name}/{dst_object_prefix}")
+    storage_client = await stage.getAioStorageClient()
+    with stage.timedPhase("download"):
+        async with worker_common.request_slots:
+            # The generation the notification is about is read, not an archive uploaded to the same name since.
+            # download_metadata takes no generation, the request is made like it does
+            params = {"alt": "json"}
+            if generation:
+                params["generation"] = str(generation)
+            try:
+                metadata = json.loads(await storage_client._download(src_bucket_name, src_object_name, params=params))
+            except Exception as e:
+                if generation and isNotFound(e):
+                    raise ArchiveGone(f"generation {generation} no longer exists") from e
+                raise
+        generation = str(metadata["generation"])
+        size = int(metadata["size"])
+        if size <= spool_threshold:
+            buffer = io.BytesIO()
+        else:
+            buffer = tempfile.TemporaryFile()
+        async with worker_common.request_slots:
+            # The public download methods take no generation, it is passed like Blob.download_to_file does
+            stream = await storage_client._download_stream(
+                src_bucket_name, src_object_name, params={"alt": "media", "generation": generation}
+            )
+            async with stream:
+                while True:
+                    chunk = await stream.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    buffer.write(chunk)
+                    job.progress()
+    job.size = size
+    bytes_in.inc(size)
+    existing = {}
+    if unchanged_members == "skip":
+        with stage.timedPhase("list"):
+            existing = await existingObjectsAsync(storage_client, dst_bucket_name, dst_object_prefix)
+    with buffer:
+        buffer.seek(0)
+        with ZipFile(buffer) as archive:
+            uploads = []
+            for member, dst_object_name in unpackedMembers(archive, dst_object_prefix):
+                uploads.append(uploadMemberAsync(
+                    storage_client, archive, member, dst_bucket_name, dst_object_name, job,
+                    existing.get(dst_object_name),
+                ))
+            with stage.timedPhase("upload"):
+                objects = await gatherAll(uploads)
+    data, manifest = unpackMessage(dst_object_prefix, objects, size)
+    if manifest is not None:
+        manifest_name, manifest_data = manifest
+        async with worker_common.request_slots:
+            await storage_client.upload(dst_bucket_name, manifest_name, manifest_data, content_type="application/json")
+    # A job cancelled after its last upload must not publish, its message was already nacked
+    job.check()
+    return publishUnpacked(data, generation)
+
+
+def claimMessage(message):
+    """Return the dedup key of the archive once it is claimed, None if the message was settled without work."""
+    if draining.is_set():
+        # The worker is shutting down, the message is redelivered to another one
+        message.nack()
+        stage.messages.labels("nacked").inc()
+        return None
+    if message.attributes.get("eventType") != "OBJECT_FINALIZE":
+        message.ack()
+        stage.messages.labels("acked").inc()
+        return None
+    source_bucket = message.attributes.get("bucketId")
+    source_object = message.attributes.get("objectId")
+    if not source_object.endswith(".zip"):
+        # Anything else in the bucket never opens as an archive, nacking it would only redeliver it forever
+        print(f"gs://{source_bucket}/{source_object} is not a .zip archive, skipping")
+        message.ack()
+        stage.messages.labels("acked").inc()
+        return None
+    key = (source_bucket, source_object, message.attributes.get("objectGeneration", ""))
+    skipped = stage.claim(key)
+    if not skipped:
+        return key
+    stage.duplicates.labels(skipped).inc()
+    if skipped == "in-progress":
+        # Acking would lose the message if the running attempt fails, so it is redelivered later instead
+        print(f"gs://{source_bucket}/{source_object} is being unpacked, message will be redelivered")
+        message.nack()
+        stage.messages.labels("nacked").inc()
+        return None
+    print(f"gs://{source_bucket}/{source_object} was already unpacked ({skipped}), skipping")
+    duplicate_bytes.inc(archiveSize(message))
     message.ack()
+    stage.messages.labels("acked").inc()
+    return None
+
+
+def callback(message):
+    key = claimMessage(message)
+    if key is None:
+        return
+    source_bucket, source_object, generation = key
+    job = stage.startJob(message, [key])
+    with stage.span("unpack"):
+        try:
+            with stage.timedPhase("total"):
+                future = unpackArchive(
+                    source_bucket, source_object, destination_bucket, Path(source_object).stem, job,
+                    generation=generation or None,
+                )
+        except Exception as e:
+            print(f"Unpacking gs://{source_bucket}/{source_object} failed: {e}")
+            stage.failJob(job, e)
+            return
+    future.add_done_callback(lambda f: stage.onPublished(job, f))
+
+
+async def callbackAsync(message):
+    # Checking the dedup marker is a blocking Cloud Storage call
+    key = await asyncio.to_thread(claimMessage, message)
+    if key is None:
+        return
+    source_bucket, source_object, generation = key
+    job = stage.startJob(message, [key])
+    with stage.span("unpack"):
+        try:
+            with stage.timedPhase("total"):
+                future = await unpackArchiveAsync(
+                    source_bucket, source_object, destination_bucket, Path(source_object).stem, job,
+                    generation=generation or None,
+                )
+        except Exception as e:
+            print(f"Unpacking gs://{source_bucket}/{source_object} failed: {e}")
+            stage.failJob(job, e)
+            return
+    future.add_done_callback(lambda f: stage.onPublished(job, f))
 
 
 def main():
-    subscriber = SubscriberClient()
-    subscription_path = subscriber.subscription_path(project_id, subscription_id)
-    streaming_pull_future = subscriber.subscribe(subscription_path, callback=callback)
-    print(f"Listening for messages on {subscription_path}..\n")
-    with subscriber:
-        streaming_pull_future.result()
+    if worker_processes > 1:
+        stage.supervise(os.path.abspath(__file__))
+        return
+    stage.run(subscription_id, callback, callbackAsync)
+
 
 if __name__ == "__main__":
     main()
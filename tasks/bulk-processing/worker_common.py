@@ -0,0 +1,807 @@
+"""Code shared by the unpack and transform workers.
+
+The settings both workers read from the environment, the lease watchdog, the dedup cache, the asyncio runtime's
+event loop and the supervisor. A worker creates one Stage at import, it holds the clients, metrics, running jobs
+and dedup keys of the worker, so unpack.py and transform.py can be imported by the same process.
+"""
+import asyncio
+import json
+import math
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, generate_latest, multiprocess
+
+
+def getEnvVar(var_name, def_value):
+    result = def_value
+    if var_name in os.environ and os.environ[var_name]:
+        result = os.environ[var_name]
+    return result
+
+project_id = getEnvVar("PROJECT_ID", None)
+if not project_id:
+    print("PROJECT_ID environment variable is not set")
+    sys.exit(1)
+
+# Messages are handled by callback_workers threads, flow control limits how many are leased at once
+callback_workers = int(getEnvVar("CALLBACK_WORKERS", "10"))
+flow_max_messages = int(getEnvVar("FLOW_MAX_MESSAGES", str(2 * callback_workers)))
+flow_max_bytes = int(getEnvVar("FLOW_MAX_BYTES", str(100 * 1024 * 1024)))
+flow_max_lease_seconds = int(getEnvVar("FLOW_MAX_LEASE_SECONDS", "3600"))
+# Outgoing messages are batched, a batch is sent when any of the limits is reached
+publish_max_messages = int(getEnvVar("PUBLISH_MAX_MESSAGES", "100"))
+publish_max_bytes = int(getEnvVar("PUBLISH_MAX_BYTES", str(1024 * 1024)))
+publish_max_latency = float(getEnvVar("PUBLISH_MAX_LATENCY_MS", "10")) / 1000
+# Metrics are served on http://localhost:METRICS_PORT/metrics, 0 disables the endpoint
+metrics_port = int(getEnvVar("METRICS_PORT", "8000"))
+# none: metrics only, otel: also export a span per message with OpenTelemetry (OTLP exporter settings from OTEL_* variables)
+tracing = getEnvVar("TRACING", "none")
+if tracing not in ("none", "otel"):
+    print(f"Unsupported TRACING: {tracing}")
+    sys.exit(1)
+# threads: messages run on the CALLBACK_WORKERS threads with blocking Cloud Storage calls. asyncio: every message
+# is a task on one event loop calling Cloud Storage through the aiohttp based gcloud-aio-storage client, at most
+# ASYNC_MAX_REQUESTS requests are in flight and FLOW_MAX_MESSAGES bounds the messages in flight
+runtime = getEnvVar("RUNTIME", "threads")
+if runtime not in ("threads", "asyncio"):
+    print(f"Unsupported RUNTIME: {runtime}")
+    sys.exit(1)
+async_max_requests = int(getEnvVar("ASYNC_MAX_REQUESTS", "100"))
+# While a message makes progress its ack deadline is extended every LEASE_CHECK_SECONDS. A message without
+# progress for LEASE_STALL_SECONDS or running for more than LEASE_MAX_SECONDS is nacked and its work cancelled
+lease_check_seconds = int(getEnvVar("LEASE_CHECK_SECONDS", "10"))
+lease_stall_seconds = int(getEnvVar("LEASE_STALL_SECONDS", "300"))
+lease_max_seconds = int(getEnvVar("LEASE_MAX_SECONDS", str(flow_max_lease_seconds)))
+# Pub/Sub accepts ack deadlines from 10 to 600 seconds, a deadline has to outlast at least two checks
+MIN_ACK_DEADLINE = max(10, 2 * lease_check_seconds)
+MAX_ACK_DEADLINE = 600
+# With WORKER_PROCESSES above 1 this process is a supervisor running that many worker processes, each with its
+# own subscriber stream. METRICS_PORT then serves the metrics of all of them and a /healthz endpoint
+worker_processes = int(getEnvVar("WORKER_PROCESSES", "1"))
+# On SIGTERM a worker stops taking messages and waits up to DRAIN_SECONDS for the running ones, the rest are nacked
+drain_seconds = int(getEnvVar("DRAIN_SECONDS", "60"))
+# A worker process that exits is restarted after RESTART_MIN_BACKOFF seconds, doubling up to RESTART_MAX_BACKOFF
+# while it keeps exiting within RESTART_RESET_SECONDS of its start
+RESTART_MIN_BACKOFF = 1
+RESTART_MAX_BACKOFF = 60
+RESTART_RESET_SECONDS = 60
+# Unix time the instance booted, the startup script sets it. The time to the first message is measured from it,
+# or from the start of the process when it is not set
+boot_time = float(getEnvVar("BOOT_TIME", "0")) or time.time()
+# Finished work is remembered in an LRU of DEDUP_CACHE_SIZE keys and, when DEDUP_BUCKET is set, as marker
+# objects in that bucket, so every instance skips redeliveries of work that is already done
+dedup_cache_size = int(getEnvVar("DEDUP_CACHE_SIZE", "10000"))
+dedup_bucket = getEnvVar("DEDUP_BUCKET", None)
+# Every BACKLOG_METRIC_INTERVAL seconds (0 turns it off) the worker writes the estimated seconds of work in its
+# subscription's backlog to Cloud Monitoring, for the managed instance group's autoscaler to target
+backlog_metric_interval = int(getEnvVar("BACKLOG_METRIC_INTERVAL", "0"))
+BACKLOG_METRIC = "custom.googleapis.com/bulk_processing/backlog_seconds"
+# Worker processes on this instance, the supervisor sets it for the one process that writes the backlog metric
+instance_processes = int(getEnvVar("INSTANCE_PROCESSES", "1"))
+
+# Markers are written in the background, so the publisher's callback thread never waits for Cloud Storage
+marker_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="marker")
+# The asyncio runtime's event loop runs on its own thread, the semaphore bounds its Cloud Storage requests
+event_loop = None
+request_slots = asyncio.Semaphore(async_max_requests)
+# Futures of the messages handed to the event loop, a draining worker also waits for the ones not started yet
+scheduled = set()
+scheduled_lock = threading.Lock()
+# Set on SIGTERM, new messages are nacked while the running ones finish
+draining = threading.Event()
+
+# unpack.py writes the manifest of a big archive into its prefix under this name, which no member may take
+MANIFEST_NAME = ".manifest.json"
+PHASE_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def fitWorkModel(samples):
+    """Fit seconds = a + b * size to (size, seconds) samples, return (a, b, mean size) or None without samples."""
+    if not samples:
+        return None
+    count = len(samples)
+    mean_size = sum(size for size, _ in samples) / count
+    mean_seconds = sum(seconds for _, seconds in samples) / count
+    variance = sum((size - mean_size) ** 2 for size, _ in samples)
+    covariance = sum((size - mean_size) * (seconds - mean_seconds) for size, seconds in samples)
+    b = max(0.0, covariance / variance) if variance else 0.0
+    a = mean_seconds - b * mean_size
+    if a < 0:
+        # Small archives were not slower than their size says, there is no fixed cost per message
+        a, b = 0.0, mean_seconds / mean_size
+    return a, b, mean_size
+
+
+def backlogSeconds(undelivered, running, samples, capacity):
+    """Seconds one instance working on `capacity` messages at once needs for the subscription's backlog.
+
+    `running` holds the (size, elapsed seconds) of the messages this instance is working on. Other
+    undelivered messages are assumed to be of the recent mean size. Returns None before any message finished.
+    """
+    model = fitWorkModel(samples)
+    if model is None:
+        return None
+    a, b, mean_size = model
+    work = sum(max(0.0, a + b * size - elapsed) for size, elapsed in running)
+    work += max(0, undelivered - len(running)) * (a + b * mean_size)
+    return work / capacity
+
+
+def metadataValue(path):
+    import requests
+
+    response = requests.get(
+        f"http://metadata.google.internal/computeMetadata/v1/{path}", headers={"Metadata-Flavor": "Google"}, timeout=5
+    )
+    response.raise_for_status()
+    return response.text
+
+
+def latestPoints(session, metric_filter, seconds):
+    """Return the time series of Cloud Monitoring matching the filter with points in the last `seconds`."""
+    end = time.time()
+    response = session.get(
+        f"https://monitoring.googleapis.com/v3/projects/{project_id}/timeSeries",
+        params={
+            "filter": metric_filter,
+            "interval.startTime": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(end - seconds)),
+            "interval.endTime": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(end)),
+        },
+        timeout=30,
+    )
+    response.raise_for_status()
+    return response.json().get("timeSeries", [])
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class ArchiveGone(Exception):
+    """The archive generation of a notification was overwritten or deleted, no redelivery can read it."""
+
+
+def isNotFound(e):
+    # google.api_core exceptions carry the HTTP status as code, aiohttp's as status
+    return getattr(e, "code", None) == 404 or getattr(e, "status", None) == 404
+
+
+class MessageGroup:
+    """The messages of a batch, they are leased, acked and nacked together."""
+
+    def __init__(self, messages):
+        self.messages = messages
+
+    @property
+    def message_id(self):
+        return ",".join(message.message_id for message in self.messages)
+
+    def modify_ack_deadline(self, seconds):
+        for message in self.messages:
+            message.modify_ack_deadline(seconds)
+
+    def ack(self):
+        for message in self.messages:
+            message.ack()
+
+    def nack(self):
+        for message in self.messages:
+            message.nack()
+
+
+def archiveSize(message):
+    """Bytes of the archives behind a message, from the JSON_API_V1 notification or the size sent by unpack.py."""
+    if isinstance(message, MessageGroup):
+        return sum(archiveSize(grouped) for grouped in message.messages)
+    # Other notification payload formats have no size
+    try:
+        return int(json.loads(message.data)["size"])
+    except (AttributeError, ValueError, KeyError, TypeError):
+        return 0
+
+
+class Job:
+    """Progress of one message, watched by the lease watchdog."""
+
+    def __init__(self, message, keys=()):
+        self.message = message
+        # Dedup keys claimed for the message, they are released when it is cancelled
+        self.keys = keys
+        # Archive bytes, from the message until the worker reads the archive's metadata
+        self.size = archiveSize(message)
+        self.started = self.last_progress = time.monotonic()
+        self.cancel_reason = None
+
+    def progress(self):
+        self.last_progress = time.monotonic()
+        self.check()
+
+    def check(self):
+        # Work on a cancelled job stops at the next check, the message was already nacked
+        if self.cancel_reason:
+            raise JobCancelled(f"cancelled, {self.cancel_reason}")
+
+
+class ProgressWriter:
+    """File wrapper that reports every write as progress of the job."""
+
+    def __init__(self, file, job):
+        self.file = file
+        self.job = job
+
+    def write(self, data):
+        self.job.progress()
+        return self.file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+
+async def gatherAll(coroutines):
+    """Run the coroutines concurrently and return their results, the first failure cancels the others."""
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+def startEventLoop():
+    global event_loop, request_slots
+    event_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(event_loop)
+    # Before Python 3.10 a semaphore is bound to the current event loop when it is created
+    request_slots = asyncio.Semaphore(async_max_requests)
+    threading.Thread(target=event_loop.run_forever, name="event-loop", daemon=True).start()
+
+
+def unschedule(future):
+    with scheduled_lock:
+        scheduled.discard(future)
+
+
+def scheduleOnEventLoop(callback_async):
+    """Return a subscriber callback running callback_async(message) as a task on the event loop."""
+
+    def scheduleCallback(message):
+        # The subscriber's thread only hands the message over, it stays leased until the task settles it
+        future = asyncio.run_coroutine_threadsafe(callback_async(message), event_loop)
+        with scheduled_lock:
+            scheduled.add(future)
+        future.add_done_callback(unschedule)
+
+    return scheduleCallback
+
+
+def flowControl():
+    from google.cloud.pubsub_v1.types import FlowControl
+
+    return FlowControl(
+        max_messages=flow_max_messages, max_bytes=flow_max_bytes, max_lease_duration=flow_max_lease_seconds
+    )
+
+
+class WorkerProcess:
+    """A worker process run by the supervisor."""
+
+    def __init__(self):
+        self.process = None
+        self.started = 0.0
+        self.next_start = 0.0
+        self.failures = 0
+        self.restarts = 0
+
+    def running(self):
+        return self.process is not None and self.process.poll() is None
+
+
+def serveSupervisor(registry, workers, stopping):
+    """Serve the aggregated metrics on /metrics and the state of the worker processes on /healthz."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/healthz":
+                now = time.monotonic()
+                processes = [
+                    {
+                        "pid": worker.process.pid if worker.running() else None,
+                        "uptime_seconds": round(now - worker.started) if worker.running() else 0,
+                        "restarts": worker.restarts,
+                    }
+                    for worker in workers
+                ]
+                healthy = not stopping.is_set() and all(worker.running() for worker in workers)
+                body = json.dumps({"healthy": healthy, "processes": processes}).encode("utf-8")
+                self.send_response(200 if healthy else 503)
+                self.send_header("Content-Type", "application/json")
+            elif self.path.split("?")[0] == "/metrics":
+                body = generate_latest(registry)
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE_LATEST)
+            else:
+                body = b""
+                self.send_response(404)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("", metrics_port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="supervisor-http", daemon=True).start()
+
+
+class Stage:
+    """The clients, metrics, running jobs and dedup keys of a worker, its metrics are prefixed with its name."""
+
+    def __init__(self, name, http_pool_size):
+        self.name = name
+        # Storage calls come from the subscriber callback threads and the worker's transfer pool
+        self.http_pool_size = http_pool_size
+        self.tracer = None
+        self.phase_seconds = Histogram(
+            f"{name}_phase_seconds", "Time spent per message in each phase", ["phase"], buckets=PHASE_BUCKETS
+        )
+        self.messages = Counter(f"{name}_messages", "Messages handled", ["result"])
+        self.duplicates = Counter(
+            f"{name}_duplicates", "Redelivered messages that were not processed again", ["source"]
+        )
+        self.lease_extensions = Counter(
+            f"{name}_lease_extensions", "Ack deadline extensions of messages making progress"
+        )
+        self.cancelled = Counter(
+            f"{name}_cancelled", "Messages nacked before they finished, by the lease watchdog or on shutdown",
+            ["reason"],
+        )
+        self.ack_deadline = Gauge(
+            f"{name}_ack_deadline_seconds", "Ack deadline set on messages making progress",
+            multiprocess_mode="liveall",
+        )
+        self.backlog_seconds = Gauge(
+            f"{name}_backlog_seconds", "Estimated seconds of backlog work per instance, as written to Cloud Monitoring",
+            multiprocess_mode="max",
+        )
+        # Clients are created once and shared by all messages handled by the process. The client libraries are
+        # imported with them rather than at module load, which keeps the supervisor and restarted processes
+        # quick to start
+        self.clients = {}
+        self.clients_lock = threading.Lock()
+        # Jobs of the messages being processed
+        self.jobs = set()
+        self.jobs_lock = threading.Lock()
+        # Processing times of the most recent messages, the ack deadline follows their 99th percentile
+        self.processing_times = deque(maxlen=1000)
+        # Archive sizes and processing times of the most recent messages, the backlog estimate is fitted to them
+        self.recent_work = deque(maxlen=1000)
+        # Keys of work in progress and of the last dedup_cache_size keys that were done and published
+        self.processed = OrderedDict()
+        self.in_progress = set()
+        self.dedup_lock = threading.Lock()
+        # Taken by the first message the process receives, it is never released
+        self.first_message = threading.Lock()
+
+    def recordPhase(self, phase, seconds):
+        self.phase_seconds.labels(phase).observe(seconds)
+        if self.tracer is not None:
+            from opentelemetry import trace
+            trace.get_current_span().set_attribute(f"{phase}_seconds", seconds)
+
+    @contextmanager
+    def timedPhase(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.recordPhase(phase, time.perf_counter() - start)
+
+    def setupTracing(self):
+        # OpenTelemetry is optional and only imported when tracing is enabled
+        from opentelemetry import trace
+        from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        provider = TracerProvider(resource=Resource.create({"service.name": self.name}))
+        provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+        trace.set_tracer_provider(provider)
+        self.tracer = trace.get_tracer(self.name)
+
+    def span(self, name):
+        return self.tracer.start_as_current_span(name) if self.tracer is not None else nullcontext()
+
+    def getStorageClient(self):
+        with self.clients_lock:
+            if "storage" not in self.clients:
+                from google.cloud import storage
+                from requests.adapters import HTTPAdapter
+
+                storage_client = storage.Client()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.http_pool_size)
+                storage_client._http.mount("https://", adapter)
+                storage_client._http.mount("http://", adapter)
+                self.clients["storage"] = storage_client
+            return self.clients["storage"]
+
+    def getPublisherClient(self):
+        with self.clients_lock:
+            if "publisher" not in self.clients:
+                from google.cloud.pubsub import PublisherClient
+                from google.cloud.pubsub_v1.types import BatchSettings
+
+                batch_settings = BatchSettings(
+                    max_messages=publish_max_messages, max_bytes=publish_max_bytes, max_latency=publish_max_latency
+                )
+                self.clients["publisher"] = PublisherClient(batch_settings=batch_settings)
+            return self.clients["publisher"]
+
+    async def getAioStorageClient(self):
+        # gcloud-aio-storage is only needed (and only imported) with RUNTIME=asyncio, it is created on the event loop
+        if "aio-storage" not in self.clients:
+            import aiohttp
+            from gcloud.aio.storage import Storage
+            session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=async_max_requests))
+            self.clients["aio-storage"] = Storage(session=session)
+        return self.clients["aio-storage"]
+
+    def countSettled(self, message, result):
+        self.messages.labels(result).inc(len(message.messages) if isinstance(message, MessageGroup) else 1)
+
+    def startJob(self, message, keys):
+        job = Job(message, keys)
+        with self.jobs_lock:
+            self.jobs.add(job)
+        return job
+
+    def finishJob(self, job, succeeded):
+        with self.jobs_lock:
+            self.jobs.discard(job)
+            if succeeded:
+                self.processing_times.append(time.monotonic() - job.started)
+                self.recent_work.append((job.size, time.monotonic() - job.started))
+
+    def ackDeadline(self):
+        """Return the ack deadline for messages making progress, the 99th percentile of recent processing times."""
+        with self.jobs_lock:
+            durations = sorted(self.processing_times)
+        if not durations:
+            return MAX_ACK_DEADLINE
+        p99 = durations[int(0.99 * (len(durations) - 1))]
+        return min(MAX_ACK_DEADLINE, max(MIN_ACK_DEADLINE, math.ceil(p99)))
+
+    def checkLeases(self, now=None):
+        """Extend the leases of jobs making progress, nack and cancel stalled jobs and jobs over the hard cap."""
+        now = time.monotonic() if now is None else now
+        deadline = self.ackDeadline()
+        self.ack_deadline.set(deadline)
+        with self.jobs_lock:
+            running = list(self.jobs)
+        for job in running:
+            if now - job.started > lease_max_seconds:
+                reason = f"running for more than {lease_max_seconds}s"
+                self.cancelled.labels("expired").inc()
+            elif now - job.last_progress > lease_stall_seconds:
+                reason = f"no progress for {lease_stall_seconds}s"
+                self.cancelled.labels("stalled").inc()
+            else:
+                job.message.modify_ack_deadline(deadline)
+                self.lease_extensions.inc()
+                continue
+            self.cancelJob(job, reason)
+
+    def cancelJob(self, job, reason):
+        """Nack the message of the job, its work stops at the next progress check."""
+        print(f"Nacking message {job.message.message_id}: {reason}")
+        job.cancel_reason = reason
+        self.finishJob(job, succeeded=False)
+        # The redelivery may be processed by this process again
+        for key in job.keys:
+            self.release(key, done=False)
+        job.message.nack()
+        self.countSettled(job.message, "nacked")
+
+    def failJob(self, job, e):
+        """Nack the message of a job that failed, so it is redelivered, or ack it if its archive is gone."""
+        # A cancelled job was already released and its message nacked by the lease watchdog
+        if isinstance(e, JobCancelled):
+            return
+        for key in job.keys:
+            self.release(key, done=False)
+        self.finishJob(job, succeeded=False)
+        if isinstance(e, ArchiveGone):
+            # An overwritten archive has a notification of its own, a deleted one has no work left
+            job.message.ack()
+            self.countSettled(job.message, "acked")
+        else:
+            job.message.nack()
+            self.countSettled(job.message, "nacked")
+
+    def ackOnPublish(self, message, future):
+        # The inbound message is acknowledged only once the outgoing one is published
+        try:
+            print(f"Published message ID: {future.result()}")
+            message.ack()
+            self.countSettled(message, "acked")
+        except Exception as e:
+            print(f"Publishing failed, message will be redelivered: {e}")
+            message.nack()
+            self.countSettled(message, "nacked")
+
+    def onPublished(self, job, future):
+        for key in job.keys:
+            self.release(key, done=future.exception() is None)
+        self.ackOnPublish(job.message, future)
+        # The job is finished last, a draining worker only stops its stream once the ack is queued
+        self.finishJob(job, succeeded=future.exception() is None)
+
+    def drain(self):
+        """Wait up to drain_seconds for the running and scheduled messages, then nack the running ones left."""
+        deadline = time.monotonic() + drain_seconds
+        while time.monotonic() < deadline:
+            # A scheduled message has no job until its coroutine starts, then it is nacked as the worker drains
+            with scheduled_lock:
+                pending = len(scheduled)
+            with self.jobs_lock:
+                if not self.jobs and not pending:
+                    return
+            time.sleep(0.1)
+        with self.jobs_lock:
+            running = list(self.jobs)
+        for job in running:
+            self.cancelled.labels("shutdown").inc()
+            self.cancelJob(job, "worker shutting down")
+
+    def watchLeases(self):
+        while True:
+            time.sleep(lease_check_seconds)
+            try:
+                self.checkLeases()
+            except Exception as e:
+                print(f"Checking leases failed: {e}")
+
+    def writeBacklog(self, session, subscription_id, instance_id, zone):
+        series = latestPoints(
+            session,
+            'metric.type="pubsub.googleapis.com/subscription/num_undelivered_messages" '
+            f'AND resource.labels.subscription_id="{subscription_id}"',
+            # Pub/Sub samples the backlog every minute and reports it with a few minutes of delay
+            600,
+        )
+        if not series:
+            return
+        # Points are newest first
+        undelivered = int(series[0]["points"][0]["value"]["int64Value"])
+        with self.jobs_lock:
+            now = time.monotonic()
+            running = [(job.size, now - job.started) for job in self.jobs]
+            samples = list(self.recent_work)
+        capacity = (flow_max_messages if runtime == "asyncio" else callback_workers) * instance_processes
+        seconds = backlogSeconds(undelivered, running, samples, capacity)
+        if seconds is None:
+            return
+        # The autoscaler sums the per-instance values, so every instance writes its share of the backlog
+        writers = {
+            item["resource"]["labels"]["instance_id"]
+            for item in latestPoints(
+                session, f'metric.type="{BACKLOG_METRIC}" AND metric.labels.subscription_id="{subscription_id}"',
+                3 * backlog_metric_interval,
+            )
+        }
+        share = seconds / len(writers | {instance_id})
+        self.backlog_seconds.set(share)
+        response = session.post(
+            f"https://monitoring.googleapis.com/v3/projects/{project_id}/timeSeries",
+            json={"timeSeries": [{
+                "metric": {"type": BACKLOG_METRIC, "labels": {"subscription_id": subscription_id}},
+                "resource": {
+                    "type": "gce_instance",
+                    "labels": {"project_id": project_id, "instance_id": instance_id, "zone": zone},
+                },
+                "points": [{
+                    "interval": {"endTime": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())},
+                    "value": {"doubleValue": share},
+                }],
+            }]},
+            timeout=30,
+        )
+        response.raise_for_status()
+
+    def exportBacklog(self, subscription_id):
+        """Write this instance's share of the backlog seconds to Cloud Monitoring every backlog_metric_interval."""
+        import google.auth
+        from google.auth.transport.requests import AuthorizedSession
+
+        credentials, _ = google.auth.default(scopes=["https://www.googleapis.com/auth/monitoring"])
+        session = AuthorizedSession(credentials)
+        instance_id = metadataValue("instance/id")
+        zone = metadataValue("instance/zone").rsplit("/", 1)[-1]
+        while True:
+            time.sleep(backlog_metric_interval)
+            try:
+                self.writeBacklog(session, subscription_id, instance_id, zone)
+            except Exception as e:
+                print(f"Writing the backlog metric failed: {e}")
+
+    def markerName(self, key):
+        bucket_name, name, generation = key
+        return f"{self.name}/{bucket_name}/{name}@{generation}"
+
+    def claim(self, key):
+        """Return None if the work has to be done, else why it is skipped: cache, marker or in-progress."""
+        with self.dedup_lock:
+            if key in self.processed:
+                self.processed.move_to_end(key)
+                return "cache"
+            if key in self.in_progress:
+                return "in-progress"
+            self.in_progress.add(key)
+        if dedup_bucket:
+            try:
+                found = self.getStorageClient().bucket(dedup_bucket).blob(self.markerName(key)).exists()
+            except Exception as e:
+                print(f"Checking dedup marker {self.markerName(key)} failed: {e}")
+                found = False
+            if found:
+                self.release(key, done=True, write_marker=False)
+                return "marker"
+        return None
+
+    def release(self, key, done, write_marker=True):
+        """Finish the work on a claimed key, keys that were done are remembered."""
+        with self.dedup_lock:
+            self.in_progress.discard(key)
+            if done:
+                self.processed[key] = True
+                self.processed.move_to_end(key)
+                while len(self.processed) > dedup_cache_size:
+                    self.processed.popitem(last=False)
+        if done and write_marker and dedup_bucket:
+            marker_executor.submit(self.writeMarker, key)
+
+    def writeMarker(self, key):
+        try:
+            self.getStorageClient().bucket(dedup_bucket).blob(self.markerName(key)).upload_from_string(b"")
+        except Exception as e:
+            print(f"Writing dedup marker {self.markerName(key)} failed: {e}")
+
+    def reportFirstMessage(self, message_callback):
+        """Wraps message_callback to report the seconds from boot to the first message this process receives."""
+
+        def wrapper(message):
+            # Only the first message takes the lock
+            if self.first_message.acquire(blocking=False):
+                seconds = time.time() - boot_time
+                # Created here rather than at import, so processes that have not received a message yet do not
+                # report 0 to the min over the worker processes
+                Gauge(
+                    f"{self.name}_time_to_first_message_seconds",
+                    "Seconds from instance boot to the first message received", multiprocess_mode="min",
+                ).set(seconds)
+                print(f"First message received {seconds:.1f} seconds after boot")
+            message_callback(message)
+
+        return wrapper
+
+    def supervise(self, script):
+        """Run worker_processes copies of the worker script and restart the ones that exit until SIGTERM."""
+        # Workers write their metrics to files in metrics_dir, the supervisor serves them summed up
+        metrics_dir = tempfile.mkdtemp(prefix=f"{self.name}-metrics-")
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry, path=metrics_dir)
+        restarts = Counter(
+            f"{self.name}_worker_restarts", "Worker processes restarted by the supervisor", registry=registry
+        )
+        running = Gauge(f"{self.name}_worker_processes", "Worker processes running", registry=registry)
+        env = {**os.environ, "WORKER_PROCESSES": "1", "METRICS_PORT": "0", "PROMETHEUS_MULTIPROC_DIR": metrics_dir}
+        workers = [WorkerProcess() for _ in range(worker_processes)]
+        stopping = threading.Event()
+        signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+        if metrics_port:
+            serveSupervisor(registry, workers, stopping)
+        print(f"Supervising {worker_processes} worker processes")
+        while not stopping.is_set():
+            now = time.monotonic()
+            for index, worker in enumerate(workers):
+                if worker.running():
+                    continue
+                if worker.process is not None:
+                    multiprocess.mark_process_dead(worker.process.pid, metrics_dir)
+                    # A worker that ran for a while restarts quickly, one that keeps crashing backs off
+                    if now - worker.started >= RESTART_RESET_SECONDS:
+                        worker.failures = 0
+                    backoff = min(RESTART_MAX_BACKOFF, RESTART_MIN_BACKOFF * 2 ** worker.failures)
+                    print(f"Worker process {worker.process.pid} exited with {worker.process.returncode}, "
+                          f"restarting in {backoff}s")
+                    worker.failures += 1
+                    worker.restarts += 1
+                    worker.next_start = now + backoff
+                    worker.process = None
+                    restarts.inc()
+                if now >= worker.next_start:
+                    # The first process writes the backlog metric for the whole instance
+                    if index == 0:
+                        process_env = {**env, "INSTANCE_PROCESSES": str(worker_processes)}
+                    else:
+                        process_env = {**env, "BACKLOG_METRIC_INTERVAL": "0"}
+                    worker.process = subprocess.Popen([sys.executable, script], env=process_env)
+                    worker.started = now
+            running.set(sum(1 for worker in workers if worker.running()))
+            stopping.wait(0.5)
+
+        # Workers drain their running messages on SIGTERM, the ones still running after that are killed
+        print("SIGTERM received, stopping worker processes..")
+        for worker in workers:
+            if worker.running():
+                worker.process.terminate()
+        deadline = time.monotonic() + drain_seconds + 10
+        for worker in workers:
+            if worker.process is None:
+                continue
+            try:
+                worker.process.wait(timeout=max(0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                worker.process.kill()
+                worker.process.wait()
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+
+    def run(self, subscription_id, callback, callback_async, before_drain=None):
+        """Pull messages from the subscription until SIGTERM, then drain the running ones.
+
+        callback handles a message on a subscriber thread, callback_async is the coroutine function the asyncio
+        runtime runs on the event loop instead. before_drain is called once SIGTERM stops new messages.
+        """
+        if metrics_port:
+            start_http_server(metrics_port)
+        if tracing == "otel":
+            self.setupTracing()
+        threading.Thread(target=self.watchLeases, name="lease-watchdog", daemon=True).start()
+        if backlog_metric_interval:
+            threading.Thread(
+                target=self.exportBacklog, args=(subscription_id,), name="backlog-metric", daemon=True
+            ).start()
+        from google.cloud.pubsub import SubscriberClient
+        from google.cloud.pubsub_v1.subscriber.scheduler import ThreadScheduler
+
+        subscriber = SubscriberClient()
+        subscription_path = subscriber.subscription_path(project_id, subscription_id)
+        if runtime == "asyncio":
+            startEventLoop()
+            # Messages are only handed to the event loop, one callback thread is enough
+            scheduler = ThreadScheduler(ThreadPoolExecutor(max_workers=1, thread_name_prefix="callback"))
+            message_callback = scheduleOnEventLoop(callback_async)
+        else:
+            scheduler = ThreadScheduler(ThreadPoolExecutor(max_workers=callback_workers, thread_name_prefix="callback"))
+            message_callback = callback
+        streaming_pull_future = subscriber.subscribe(
+            subscription_path, callback=self.reportFirstMessage(message_callback), flow_control=flowControl(),
+            scheduler=scheduler,
+        )
+        signal.signal(signal.SIGTERM, lambda signum, frame: draining.set())
+        print(f"Listening for messages on {subscription_path}..\n")
+        with subscriber:
+            while not draining.wait(1):
+                if streaming_pull_future.done():
+                    # Raises the error that ended the stream
+                    streaming_pull_future.result()
+                    return
+            # The stream stays open while draining, so the acks of the running messages are still sent
+            print("SIGTERM received, draining..")
+            if before_drain is not None:
+                before_drain()
+            self.drain()
+            streaming_pull_future.cancel()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""Requests/sec and latency of the Cloud Function handler against a local MySQL server.
+
+Starts a MySQL 8.0 container (docker run mysql:8.0) unless --host is given,
+then calls main.handler from --concurrency threads for --duration seconds,
+once for every pool size. The threads stand in for the concurrent requests
+one function instance serves, so pool size 1 shows requests queueing for the
+single connection the function used to share, and a pool as large as the
+concurrency shows every request getting its own connection.
+
+With --latency-ms the container's traffic is slowed down with tc (needs
+NET_ADMIN), to see how the pool behaves at Cloud SQL round-trip times.
+
+The response cache is bypassed so every request queries the database,
+unless --cache-seconds is given; the cache hits, misses and coalesced misses
+are then reported too.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+WEBSITE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONTAINER = "bench-mysql"
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def startMysql(port, password, latency_ms):
+    subprocess.run(["docker", "rm", "-f", CONTAINER], capture_output=True)
+    command = ["docker", "run", "-d", "--rm", "--name", CONTAINER, "-p", f"{port}:3306",
+               "-e", f"MYSQL_ROOT_PASSWORD={password}"]
+    if latency_ms:
+        command += ["--cap-add", "NET_ADMIN"]
+    subprocess.run(command + ["mysql:8.0"], check=True, capture_output=True)
+    if latency_ms:
+        # The image has no tc, install it and delay every packet the server sends
+        subprocess.run(["docker", "exec", CONTAINER, "sh", "-c",
+                        "microdnf install -y iproute-tc >/dev/null && "
+                        f"tc qdisc add dev eth0 root netem delay {latency_ms}ms"], check=True)
+
+    def stop():
+        subprocess.run(["docker", "stop", CONTAINER], capture_output=True)
+    return stop
+
+
+def waitForMysql(host, port, user, password, timeout=120):
+    import mysql.connector
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            mysql.connector.connect(host=host, port=port, user=user, password=password).close()
+            return
+        except mysql.connector.Error:
+            time.sleep(1)
+    print(f"MySQL at {host}:{port} did not come up in {timeout}s")
+    sys.exit(1)
+
+
+def runSetting(main, pool_size, concurrency, duration, connect_args, cache_seconds):
+    """Call the handler from `concurrency` threads for `duration` seconds with a fresh pool."""
+    main.db_pool = main.ConnectionPool(pool_size, main.db_pool_timeout, **connect_args)
+    main.response_cache = main.ResponseCache(cache_seconds or 0)
+    if cache_seconds is None:
+        main.response_cache.get = lambda key, loader: (loader(), 0)
+    latencies = []
+    errors = []
+    stop = threading.Event()
+
+    def client():
+        while not stop.is_set():
+            start = time.perf_counter()
+            body, status, headers = main.handler(None)
+            elapsed = time.perf_counter() - start
+            if status != 200:
+                errors.append(status)
+            else:
+                latencies.append(elapsed)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    stop.wait(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    connections = main.db_pool.idle.qsize()
+    while not main.db_pool.idle.empty():
+        main.db_pool.idle.get_nowait().close()
+    return {
+        "pool_size": pool_size,
+        "requests": len(latencies),
+        "errors": len(errors),
+        "requests_per_sec": round(len(latencies) / elapsed, 1),
+        "latency_ms": {f"p{pct}": round(percentile(latencies, pct) * 1000, 2) for pct in (50, 95, 99)},
+        "connections": connections,
+        "cache": main.response_cache.stats(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", help="MySQL server to use instead of starting a container")
+    parser.add_argument("--port", type=int, default=3306)
+    parser.add_argument("--user", default="root")
+    parser.add_argument("--password", default="bench")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent requests, the function's concurrency")
+    parser.add_argument("--pool-sizes", default="1,4,8", help="comma separated DB_POOL_SIZE values")
+    parser.add_argument("--duration", type=float, default=20, help="seconds per pool size")
+    parser.add_argument("--cache-seconds", type=int, help="RESPONSE_CACHE_SECONDS, the cache is bypassed if not set")
+    parser.add_argument("--latency-ms", type=float, default=0, help="delay added to the container's traffic")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    stop_mysql = None
+    if not args.host:
+        stop_mysql = startMysql(args.port, args.password, args.latency_ms)
+    host = args.host or "127.0.0.1"
+    try:
+        waitForMysql(host, args.port, args.user, args.password)
+        os.environ["DB_CREDS"] = json.dumps({"host": host, "username": args.user, "password": args.password})
+        sys.path.insert(0, WEBSITE_DIR)
+        import main as website
+
+        connect_args = {**website.db_pool.connect_args, "port": args.port}
+        results = [
+            runSetting(website, int(pool_size), args.concurrency, args.duration, connect_args, args.cache_seconds)
+            for pool_size in args.pool_sizes.split(",")
+        ]
+    finally:
+        if stop_mysql:
+            stop_mysql()
+
+    print(f"{args.concurrency} concurrent requests, {args.duration:g}s per pool size")
+    print(f"{'pool':>6}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}{'cache misses':>14}")
+    for result in results:
+        pcts = result["latency_ms"]
+        print(f"{result['pool_size']:>6}{result['requests_per_sec']:>10}{pcts['p50']:>10}{pcts['p95']:>10}"
+              f"{pcts['p99']:>10}{result['errors']:>8}{result['cache']['misses']:>14}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "concurrency": args.concurrency, "duration": args.duration, "latency_ms": args.latency_ms,
+                "cache_seconds": args.cache_seconds, "results": results,
+            }, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""Import time of the Cloud Function, from `python3 -X importtime`.
+
+Every run imports main.py in a fresh interpreter, as a new function instance does before its first request,
+and reports the median cumulative import time over --runs with the heaviest packages. DB_CREDS points at an
+unroutable address, so an import that opened a database connection would fail instead of passing quietly.
+The script exits with 1 when the median is above --max-import-ms.
+
+No MySQL server is needed.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+
+WEBSITE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# TEST-NET-1, nothing answers there
+DB_CREDS = {"host": "192.0.2.1", "username": "bench", "password": "bench"}
+
+
+def importOnce():
+    """Import main in a new interpreter, return {module: (self_us, cumulative_us)}."""
+    env = dict(os.environ, DB_CREDS=json.dumps(DB_CREDS), DB_CONNECT_TIMEOUT="1", PYTHONPATH=WEBSITE_DIR)
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"], env=env, capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        print(result.stderr.splitlines()[-1])
+        sys.exit(1)
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        if self_us.strip().isdigit():
+            modules[name.strip()] = (int(self_us), int(cumulative_us))
+    return modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="imports, the median is reported")
+    parser.add_argument("--top", type=int, default=8, help="heaviest packages to report")
+    parser.add_argument("--max-import-ms", type=float, help="fail when the median import takes longer")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    totals = []
+    packages = defaultdict(list)
+    for _ in range(args.runs):
+        modules = importOnce()
+        totals.append(modules["main"][1] / 1000)
+        per_package = defaultdict(int)
+        for name, (self_us, _) in modules.items():
+            per_package[name.split(".")[0]] += self_us
+        for name, self_us in per_package.items():
+            packages[name].append(self_us / 1000)
+    heaviest = sorted(((statistics.median(ms), name) for name, ms in packages.items()), reverse=True)[:args.top]
+    result = {
+        "import_ms": round(statistics.median(totals), 1),
+        "import_ms_min": round(min(totals), 1),
+        "modules": len(modules),
+        "heaviest_ms": {name: round(ms, 1) for ms, name in heaviest},
+    }
+
+    print(f"main: {result['import_ms']} ms median, {result['import_ms_min']} ms min, {result['modules']} modules")
+    for name, ms in result["heaviest_ms"].items():
+        print(f"  {name:<24}{ms:>8.1f} ms")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"python": sys.version.split()[0], "result": result}, f, indent=2)
+    if args.max_import_ms is not None and result["import_ms"] > args.max_import_ms:
+        print(f"Slower than --max-import-ms {args.max_import_ms}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,194 @@
 import os
 import json
+import hashlib
+import math
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+
 import mysql.connector
 
 db_creds = json.loads(os.environ["DB_CREDS"])
-db_conn = mysql.connector.connect(
-    host=db_creds["host"], user=db_creds["username"], password=db_creds["password"]
+# One connection per concurrent request, the deploy script sets DB_POOL_SIZE to the function's concurrency
+db_pool_size = int(os.environ.get("DB_POOL_SIZE", "1"))
+# Seconds a request waits for a free connection before it fails with 503
+db_pool_timeout = float(os.environ.get("DB_POOL_TIMEOUT", "10"))
+db_connect_timeout = int(os.environ.get("DB_CONNECT_TIMEOUT", "5"))
+db_statement_timeout_ms = int(os.environ.get("DB_STATEMENT_TIMEOUT_MS", "5000"))
+# Seconds a database result is served from memory, and how long the CDN and browsers may keep it
+response_cache_seconds = int(os.environ.get("RESPONSE_CACHE_SECONDS", "1"))
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """At most `size` MySQL connections, opened on first use and pinged before every checkout.
+
+    The pool lives as long as the function instance, so warm requests skip the TCP and TLS handshake and the
+    MySQL login. A connection Cloud SQL closed while idle is reconnected by the ping instead of failing the
+    request, and a connection that raised an error is closed rather than returned to the pool.
+    """
+
+    def __init__(self, size, timeout, **connect_args):
+        self.timeout = timeout
+        self.connect_args = connect_args
+        self.slots = threading.BoundedSemaphore(size)
+        # Most recently used first, so the connections kept busy are the ones known to be alive
+        self.idle = queue.LifoQueue()
+
+    def acquire(self):
+        if not self.slots.acquire(timeout=self.timeout):
+            raise PoolTimeout(f"No database connection free after {self.timeout}s")
+        try:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                return mysql.connector.connect(**self.connect_args)
+            # Reconnects (and runs init_command again) when the server dropped the connection
+            try:
+                conn.ping(reconnect=True, attempts=1)
+            except BaseException:
+                # A connection that could not be reconnected is closed, not left open outside the pool
+                try:
+                    conn.close()
+                except mysql.connector.Error:
+                    pass
+                raise
+            return conn
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def release(self, conn, broken=False):
+        try:
+            if broken:
+                conn.close()
+            else:
+                self.idle.put(conn)
+        except mysql.connector.Error:
+            pass
+        finally:
+            self.slots.release()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        except mysql.connector.Error:
+            self.release(conn, broken=True)
+            raise
+        except BaseException:
+            self.release(conn)
+            raise
+        self.release(conn)
+
+
+db_pool = ConnectionPool(
+    db_pool_size,
+    db_pool_timeout,
+    host=db_creds["host"],
+    user=db_creds["username"],
+    password=db_creds["password"],
+    connection_timeout=db_connect_timeout,
+    # Without autocommit a pooled connection would keep its snapshot open between requests
+    autocommit=True,
+    # max_execution_time applies to SELECT statements, the server aborts them after the timeout
+    init_command=f"SET SESSION max_execution_time={db_statement_timeout_ms}",
 )
 
 
+class ResponseCache:
+    """Keeps each result for `ttl` seconds, concurrent misses of a key wait for a single loader call.
+
+    get returns the result and the seconds it is still kept for. Failures are not cached, but the requests that
+    waited for the failed call get its exception too, so a database outage is not hit once per waiting request.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entries = {}
+        self.loading = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # Misses that waited for another request's loader call instead of querying themselves
+        self.coalesced = 0
+
+    def get(self, key, loader):
+        with self.lock:
+            entry = self.entries.get(key)
+            now = time.monotonic()
+            if entry is not None and entry[1] > now:
+                self.hits += 1
+                return entry[0], entry[1] - now
+            self.misses += 1
+            future = self.loading.get(key)
+            if future is not None:
+                self.coalesced += 1
+            else:
+                loading = self.loading[key] = Future()
+        if future is not None:
+            value, expires = future.result()
+            return value, max(0.0, expires - time.monotonic())
+        future = loading
+        try:
+            value = loader()
+        except BaseException as e:
+            with self.lock:
+                del self.loading[key]
+            future.set_exception(e)
+            raise
+        expires = time.monotonic() + self.ttl
+        with self.lock:
+            self.entries[key] = (value, expires)
+            del self.loading[key]
+        future.set_result((value, expires))
+        return value, self.ttl
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "coalesced": self.coalesced}
+
+
+response_cache = ResponseCache(response_cache_seconds)
+
+
+def queryDbTime():
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT NOW();")
+        (now,) = cursor.fetchone()
+        cursor.close()
+    body = str(now)
+    return body, '"' + hashlib.sha1(body.encode()).hexdigest()[:16] + '"'
+
+
 def handler(request):
-    cursor = db_conn.cursor()
-    cursor.execute("SELECT NOW();")
-    for x in cursor.fetchone():
-        return str(x)
+    if request is not None and request.path.rstrip("/").endswith("/cache-stats"):
+        return json.dumps(response_cache.stats()), 200, {
+            "Content-Type": "application/json", "Cache-Control": "no-store",
+        }
+    try:
+        (body, etag), seconds_left = response_cache.get("db_time", queryDbTime)
+    except PoolTimeout as e:
+        print(e)
+        return "Database busy", 503, {"Cache-Control": "no-store"}
+    except mysql.connector.Error as e:
+        print(f"Database error: {e}")
+        return "Database unavailable", 503, {"Cache-Control": "no-store"}
+    # Cloud CDN and browsers keep the page about as long as this instance still does, then revalidate with the ETag.
+    # Rounded up, a result with less than a second left would otherwise never be cached downstream
+    headers = {"Cache-Control": f"public, max-age={math.ceil(seconds_left)}", "ETag": etag}
+    if_none_match = request.headers.get("If-None-Match", "") if request is not None else ""
+    if if_none_match == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return "", 304, headers
+    return body, 200, headers
 
 
 if __name__ == "__main__":
-    print(handler())
+    print(handler(None))